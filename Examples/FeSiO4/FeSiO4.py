@@ -13,7 +13,13 @@ common_params={
                         'O_ATOM_9':['p'], 'O_ATOM_10':['p'], 'O_ATOM_11':['p'], 'O_ATOM_13':['p'], 'O_ATOM_14':['p'], 'O_ATOM_15':['p'],
                         'O_ATOM_16':['p'], 'O_ATOM_18':['p'], 'O_ATOM_19':['p'], 'O_ATOM_20':['p'], 'O_ATOM_21':['p']}},
     'kpoints': 1, # 0 means auto      
-    'debugMode': True
+    'debugMode': True,
+    'maxParallelStages': 2, # DOS and Bandstructure are independent and can run at the same time
+    #'scheduler': 'slurm', # submit commands with 'run-cluster' prefix with sbatch and track them by job id ('local' - run them here)
+    #'machines': 'auto', # write .machines for every stage: {'hosts': [...], 'coresPerHost': N} or 'auto' (slurm nodes or this host)
+    #'trace': 'trace.json', # spans of commands, w2web calls and stages (Chrome trace format) and trace_summary.txt
+    #'plotBackend': 'native', # DOS, band structure and Wannier figures with matplotlib in one batch after the stages instead of dos.pl, band.pl and gnuplot
+    #'plotWorkers': 4, # processes drawing the figures of plotBackend 'native'
     }
                  
 
@@ -22,9 +28,11 @@ SCFparams ={
     'struct_file': 'FeSiO4.struct',
     'runParallel': runParallel,
     'runCommandPrefix': runCommandPrefix,
-    'lapwParams': {'iterNum':100, 'ec':0.0001},
+    'lapwParams': {'iterNum':100, 'ec':0.0001}, # also 'monitor': False or SCFMonitor params, 'maxRestarts': 2
+    #'init': 'w2web', # structure and init steps through the w2web CGI scripts instead of in-process ('native'; structure of .cif files always through w2web)
     'lstart_energy': -10.5, # 0 means that will be used default value: -9.0 Ry
     'RKmax': 6, #0  means default value
+    #'lmax': 12, 'emax': 2.5, 'mix': 0.1, # set by init phase 15: lmax and de of emax=Ef+de (Ry) in case.in1c, mixing factor in case.inm
     'efmod': 'GAUSS', # default value should be 'TETRA'
     'ef_eval': 0.003 # default value should be None
     }
@@ -48,6 +56,7 @@ Wannierparams={
     'runParallel': runParallel,
     'runCommandPrefix': runCommandPrefix,
     'wannierRunCommandPrefix': 'run-cluster-and-wait -m 3000 -n 6 ',
+    #'strictWindow': True, # search an energy window with the right band count at all k-points also when energyInterval gives it only at some
     'wannierName': 'wannier'
     }
                  
@@ -55,7 +64,8 @@ XTLSparams={
     'run': False,
     'hopMatBorder' : 3,
     'XTLSinput': 'Fe_2plus_XAS',
-    'Xtls_path': '/opt/Xtls'
+    'Xtls_path': '/opt/Xtls',
+    #'nativeHamiltonian': True, # block norms and HopMat of the rows from <wannierName>_hr.dat in-process instead of local_Hamilton
     }
 
 params={
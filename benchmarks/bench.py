@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# Benchmarks of w2auto's own overhead, apart from the compute time of WIEN2k.
+#
+# WIEN2k, w2web and XTLS are replaced by wien2kstub.py with configurable latency and output/file sizes.
+# Two parts:
+#   scaling - cache lookup, saveState snapshots, copyAllFiles and parsing are timed for growing cache size,
+#             file size and atom count; the slope of log(time) over log(size) must stay under its limit
+#   e2e     - runWien2k with SCF, DOS, Bandstructure, Wannier and XTLS on the stubs, cold and with all caches warm;
+#             overhead is the wall time minus the time spent inside the stubs (start-up of the stubs counts as overhead)
+# With --baseline every time is also compared to a saved run (--save-baseline) and must not be slower than tolerance times.
+# Exit code is 1 if there are regressions.
+#
+#   python benchmarks/bench.py --quick
+#   python benchmarks/bench.py --save-baseline base.json
+#   python benchmarks/bench.py --baseline base.json --latency 0.05 --file-size 4000000
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+import w2auto
+
+join = os.path.join
+stubFile = join(benchDir, 'wien2kstub.py')
+exampleDir = join(os.path.dirname(benchDir), 'Examples', 'Fe3O4')
+
+stubPrograms = ['x', 'run_lapw', 'setrmt_lapw', 'instgen_lapw', 'local_Hamilton', 'configure_int_lapw', 'prepare_w2wdir',
+                'write_inwf', 'write_win', 'wannier90.x', 'gnuplot', 'lapw1']
+w2webScripts = ['session/new.cgi', 'session/save.cgi', 'util/structstart.pl', 'util/structgen.pl', 'util/structsave.pl',
+                'util/structrmt.pl', 'util/structend.pl', 'util/structask.pl', 'exec/initlapw.pl', 'exec/dos.pl', 'exec/band.pl']
+
+# fake WIENROOT (programs and SRC_w2web/htdocs) and XTLS folder, all links to the stub
+def makeStubTree(root):
+    wienroot = join(root, 'WIEN2k')
+    xtls = join(root, 'Xtls')
+    links = [join(wienroot, p) for p in stubPrograms] + [join(wienroot, 'SRC_w2web', 'htdocs', s) for s in w2webScripts]
+    links += [join(xtls, 'bin', 'x925'), join(xtls, 'bin', 'xc')]
+    for link in links:
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        if not os.path.lexists(link): os.symlink(stubFile, link)
+    os.makedirs(join(xtls, 'xc', 'spc'), exist_ok=True)
+    with open(join(xtls, 'xc', 'spc', 'spcana.x'), 'w') as f: f.write('spcana of the stub\n')
+    return wienroot, xtls
+
+# seconds per call: calls are repeated until they take minTime, the best of repeats is taken
+def measure(function, repeats=5, minTime=0.05):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        function()
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number): function()
+            elapsed = time.perf_counter() - start
+            if elapsed >= minTime or number >= 1<<16: break
+            number *= 4
+        best = elapsed/number
+        for _ in range(repeats-1):
+            start = time.perf_counter()
+            for _ in range(number): function()
+            best = min(best, (time.perf_counter() - start)/number)
+    return best
+
+def slope(sizes, times):
+    return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+def makeOld(path):
+    # the stat cache doesn't trust files modified in the last 2 seconds
+    past = time.time() - 3600
+    os.utime(path, (past, past))
+
+def writeRandom(path, size, seed=0):
+    with open(path, 'wb') as f: f.write(np.random.RandomState(seed).bytes(size))
+    makeOld(path)
+
+# ======================================= scaling =======================================
+
+def cacheLookup(root, lines):
+    workDir = join(root, 'cache'+str(lines))
+    os.makedirs(workDir, exist_ok=True)
+    outputHash = w2auto.BlobStore(join(workDir, w2auto.outputsDirName)).put(b'output')
+    with open(join(workDir, '.cache'), 'w') as f:
+        for i in range(lines):
+            f.write(json.dumps({'cmd':'x lapw1', 'inState':'s'+str(i), 'outState':'o'+str(i), 'outputHash':outputHash, 'inHash':'h'+str(i), 'backend':'manifest'}) + '\n')
+    w2auto.caches.clear()
+    cache = w2auto.getCache(workDir)
+    def lookup():
+        w2auto.getCache(workDir).findSameState('x lapw1', 'h'+str(lines//2))
+        w2auto.getCache(workDir).findSameState('x lapw1', 'missing')
+    return lookup
+
+def cacheLoad(root, lines):
+    cacheLookup(root, lines)
+    workDir = join(root, 'cache'+str(lines))
+    return lambda: w2auto.Cache(workDir)
+
+def stateDir(root, name, size, files=8):
+    workDir = join(root, name+str(size))
+    os.makedirs(workDir, exist_ok=True)
+    for i, ext in enumerate(['clmsum', 'vsp', 'vns', 'vector', 'energy', 'qtl', 'struct', 'in1'][:files]):
+        writeRandom(join(workDir, 'case.'+ext), size, i)
+    w2auto.hashCaches.clear()
+    return workDir
+
+def saveStateUnchanged(root, size):
+    workDir = stateDir(root, 'unchanged', size)
+    w2auto.saveState(workDir, 'bench', 'output')
+    return lambda: w2auto.saveState(workDir, 'bench', 'input')
+
+def saveStateTouched(root, size):
+    workDir = stateDir(root, 'touched', size)
+    w2auto.saveState(workDir, 'bench', 'output')
+    def save():
+        # new mtime: the file has to be hashed again, its object is already stored
+        makeOld(join(workDir, 'case.vector'))
+        w2auto.saveState(workDir, 'bench', 'output')
+    return save
+
+def copyFiles(root, size, readOnly):
+    srcDir = stateDir(root, 'copy'+str(readOnly), size)
+    dstDir = join(root, 'copy'+str(readOnly)+'dst'+str(size))
+    def copy():
+        w2auto.rmAllExceptIgnore(dstDir)
+        os.makedirs(dstDir, exist_ok=True)
+        w2auto.copyAllFiles(srcDir, dstDir, ['*'] if readOnly else [])
+    return copy
+
+# struct file in the format of case.struct_st: atoms [(name, multiplicity)]
+def structText(atoms, lattice='P', title='bench'):
+    text = '{0}\n{1}   LATTICE,NONEQUIV.ATOMS:{2:3} 1_P1\nMODE OF CALC=RELA unit=bohr\n 15.868030 15.868030 15.868030 90.000000 90.000000 90.000000\n'.format(title, lattice, len(atoms))
+    for i, (name, mult) in enumerate(atoms):
+        text += 'ATOM  -{0}: X=0.12500000 Y=0.12500000 Z=0.12500000\n          MULT={1:2}          ISPLIT= 8\n'.format(i+1, mult)
+        text += ''.join('      -{0}: X=0.{1:08} Y=0.12500000 Z=0.12500000\n'.format(i+1, 12500000+k) for k in range(1, mult))
+        text += '{0:<10} NPT=  781  R0=0.00005000 RMT=    1.9100   Z: 26.000\n'.format(name)
+        text += 'LOCAL ROT MATRIX:    1.0000000 0.0000000 0.0000000\n                     0.0000000 1.0000000 0.0000000\n                     0.0000000 0.0000000 1.0000000\n'
+    return text + '   0      NUMBER OF SYMMETRY OPERATIONS\n'
+
+def parseStruct(root, atoms):
+    fileName = join(root, 'atoms'+str(atoms)+'.struct')
+    with open(fileName, 'w') as f: f.write(structText([('A'+str(i+1), 1) for i in range(atoms)]))
+    return lambda: w2auto.parseStructFile(fileName)
+
+def parseSCF(root, iterations):
+    workDir = join(root, 'scf'+str(iterations))
+    os.makedirs(workDir, exist_ok=True)
+    with open(join(workDir, 'case.scf'), 'w') as f:
+        for i in range(iterations):
+            f.write(':ITE{0:03}:  {0}. ITERATION\n'.format(i+1) + ':NEC01: NUCLEAR AND ELECTRONIC CHARGE    52.00000   51.99999\n'*20)
+            f.write(':ENE  : ********** TOTAL ENERGY IN Ry =       -1234.{0:05}\n'.format(i))
+            f.write(':DIS  :  CHARGE DISTANCE       ( 0.0001000 for atom    1 spin 1)    {0:.7f}\n'.format(0.1/(i+1)))
+            f.write(':FER  : F E R M I - ENERGY(TETRAH.M.)=   0.4500000000\n')
+    def parse():
+        monitor = w2auto.SCFMonitor(workDir, 'case', minIterations=10**9)
+        monitor.offset = 0
+        monitor.poll()
+    return parse
+
+# name, parameter, values of quick and full runs, setup(root, value) -> function to time, max slope
+scalingCases = [
+    ('cache lookup', 'cache lines', [1000, 4000], [1000, 4000, 16000, 64000], cacheLookup, 0.3),
+    ('cache load', 'cache lines', [1000, 4000], [1000, 4000, 16000, 64000], cacheLoad, 1.3),
+    ('saveState unchanged', 'file size', [1<<18, 1<<21], [1<<18, 1<<21, 1<<24], saveStateUnchanged, 0.3),
+    ('saveState touched', 'file size', [1<<18, 1<<21], [1<<18, 1<<21, 1<<24], saveStateTouched, 1.3),
+    ('copyAllFiles read-only', 'file size', [1<<18, 1<<21], [1<<18, 1<<21, 1<<24], lambda root, size: copyFiles(root, size, True), 0.3),
+    ('copyAllFiles', 'file size', [1<<18, 1<<21], [1<<18, 1<<21, 1<<24], lambda root, size: copyFiles(root, size, False), 1.3),
+    ('parseStructFile', 'atoms', [16, 64], [16, 64, 256, 1024], parseStruct, 1.3),
+    ('SCFMonitor parse', 'iterations', [50, 200], [50, 200, 800], parseSCF, 1.3),
+    ]
+
+def runScaling(root, quick):
+    results = {}
+    regressions = []
+    print('{0:<24} {1:<12} {2:>10} {3:>14}'.format('benchmark', 'parameter', 'value', 'time, ms'))
+    for name, parameter, quickValues, values, setup, maxSlope in scalingCases:
+        values = quickValues if quick else values
+        times = []
+        for value in values:
+            caseRoot = tempfile.mkdtemp(dir=root)
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): function = setup(caseRoot, value)
+            times.append(measure(function))
+            print('{0:<24} {1:<12} {2:>10} {3:>14.3f}'.format(name, parameter, value, times[-1]*1e3))
+            shutil.rmtree(caseRoot)
+        s = slope(values, times)
+        print('{0:<24} slope {1:.2f} (limit {2})'.format(name, s, maxSlope))
+        results[name] = {'parameter':parameter, 'values':values, 'times':times, 'slope':s}
+        if s > maxSlope: regressions.append('{0}: time grows as {1}^{2:.2f}, limit {3}'.format(name, parameter, s, maxSlope))
+    return results, regressions
+
+# ======================================= end to end =======================================
+
+def e2eParams(runDir, wienroot, xtls, energyInterval, nativeHamiltonian=False, plotBackend='w2web', init='native'):
+    return {'WIENROOT': wienroot,
+            'SCF': {'run':True, 'struct_file':'Fe3O4.struct', 'runParallel':False, 'runCommandPrefix':'', 'lapwParams':{'iterNum':40, 'ec':0.0001},
+                    'lstart_energy':-9.0, 'RKmax':7, 'efmod':'TETRA', 'ef_eval':None, 'init':init},
+            'DOS': {'run':True, 'runParallel':False, 'runCommandPrefix':'', 'xmin':-10},
+            'BAND': {'run':True, 'runParallel':False, 'runCommandPrefix':'', 'klist_band':'Fe3O4.klist_band'},
+            'Wannier': {'run':True, 'runParallel':False, 'runCommandPrefix':'', 'wannierRunCommandPrefix':'', 'wannierName':'wannier'},
+            'XTLS': {'run':True, 'hopMatBorder':3, 'XTLSinput':'Fe_2plus_XAS', 'Xtls_path':xtls, 'nativeHamiltonian':nativeHamiltonian},
+            'common': {'dosInfo':{'energyInterval':energyInterval, 'atomOrbitals':{'FeM':['d'], 'FeT':['d'], 'O':['p']}},
+                       'kpoints':0, 'debugMode':False, 'maxParallelStages':1, 'workingFolder':runDir, 'plotBackend':plotBackend}}
+
+# programs w2auto runs without the cache (tryFast=False), every other one must be a cache hit in the warm run
+warmUncached = ['prepare_w2wdir']
+
+def stubCalls(logFile):
+    if not os.path.exists(logFile): return []
+    with open(logFile, 'r') as f: return [json.loads(line) for line in f if line.strip() != '']
+
+def runE2E(root, args):
+    wienroot, xtls = makeStubTree(root)
+    runDir = join(root, 'run')
+    os.makedirs(runDir, exist_ok=True)
+    for fileName in ['Fe3O4.klist_band', 'Fe_2plus_XAS']: shutil.copy(join(exampleDir, fileName), runDir)
+    with open(join(runDir, 'Fe3O4.struct'), 'w') as f: f.write(structText([('FeT', 2), ('FeM', 4), ('O', 8)], 'F', 'Fe3O4'))
+    cwd = os.getcwd()
+    os.chdir(runDir)
+    structInfo = w2auto.parseStructFile('Fe3O4.struct')
+    params = e2eParams(runDir, wienroot, xtls, args.energy_interval, args.native_hamiltonian, args.plot_backend, args.init)
+    atomOrbitals = params['common']['dosInfo']['atomOrbitals']
+    bands = sum({'s':1, 'p':3, 'd':5}[orb]*structInfo['atomCounts'][a] for a in atomOrbitals for orb in atomOrbitals[a])
+    os.environ.update({'W2AUTO_STUB_LATENCY':str(args.latency), 'W2AUTO_STUB_OUTPUT':str(args.output_size), 'W2AUTO_STUB_FILESIZE':str(args.file_size),
+                       'W2AUTO_STUB_ITERATIONS':str(args.iterations), 'W2AUTO_STUB_BANDS':str(bands)})
+    results = {}
+    regressions = []
+    try:
+        for run in ['cold', 'warm']:
+            logFile = join(root, 'stub_'+run+'.jsonl')
+            os.environ['W2AUTO_STUB_LOG'] = logFile
+            params['common']['trace'] = join(root, 'trace_'+run+'.json')
+            # every run is a new process for w2auto: caches are loaded from disk again
+            w2auto.caches.clear()
+            w2auto.hashCaches.clear()
+            start = time.time()
+            with open(join(root, run+'.log'), 'w') as log, contextlib.redirect_stdout(log):
+                try: w2auto.runWien2k(params)
+                finally: w2auto.tracerGlobal = None
+            wall = time.time() - start
+            calls = stubCalls(logFile)
+            stubTime = sum(c['time'] for c in calls)
+            results[run] = {'wall':wall, 'stubCalls':len(calls), 'stubTime':stubTime, 'overhead':wall-stubTime}
+            print('{0}: wall {1:.2f} s, {2} stub calls, {3:.2f} s in stubs, overhead {4:.2f} s'.format(run, wall, len(calls), stubTime, wall-stubTime))
+            with open(join(root, 'trace_'+run+'_summary.txt'), 'r') as f: print(f.read())
+            if run == 'warm':
+                rerun = sorted(set(c['program'] for c in calls))
+                print('warm run called the stubs: ' + (', '.join(rerun) if len(rerun) > 0 else 'none'))
+                missed = [p for p in rerun if p not in warmUncached]
+                if len(missed) > 0: regressions.append('e2e warm: cache misses, the stubs were called again: ' + ', '.join(missed))
+    except Exception as e:
+        regressions.append('e2e: runWien2k failed: ' + repr(e) + ', see ' + root)
+    finally: os.chdir(cwd)
+    return results, regressions
+
+# ======================================= baseline =======================================
+
+def compareBaseline(results, baseline, tolerance):
+    regressions = []
+    for name, r in results.get('scaling', {}).items():
+        if name not in baseline.get('scaling', {}): continue
+        b = baseline['scaling'][name]
+        for value, t in zip(r['values'], r['times']):
+            if value in b['values'] and t > tolerance*b['times'][b['values'].index(value)]:
+                regressions.append('{0} at {1}={2}: {3:.3f} ms, baseline {4:.3f} ms'.format(name, r['parameter'], value, t*1e3, b['times'][b['values'].index(value)]*1e3))
+    for run, r in results.get('e2e', {}).items():
+        if run not in baseline.get('e2e', {}): continue
+        b = baseline['e2e'][run]
+        # small overheads are dominated by noise, half a second is allowed anyway
+        if r['overhead'] > tolerance*b['overhead'] + 0.5:
+            regressions.append('e2e {0}: overhead {1:.2f} s, baseline {2:.2f} s'.format(run, r['overhead'], b['overhead']))
+        if r['stubCalls'] > b['stubCalls']:
+            regressions.append('e2e {0}: {1} stub calls, baseline {2}'.format(run, r['stubCalls'], b['stubCalls']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of w2auto overhead on a stub WIEN2k toolchain')
+    parser.add_argument('--quick', action='store_true', help='fewer and smaller sizes')
+    parser.add_argument('--skip-scaling', action='store_true')
+    parser.add_argument('--skip-e2e', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every stub program sleeps')
+    parser.add_argument('--output-size', type=int, default=0, help='bytes of extra stdout of every stub program')
+    parser.add_argument('--file-size', type=int, default=1<<20, help='bytes of big files written by the stubs')
+    parser.add_argument('--iterations', type=int, default=3, help='SCF iterations of run_lapw')
+    parser.add_argument('--energy-interval', type=float, nargs=2, default=[-7, 2], help='Wannier energy window, eV (the bands of the stubs are in -6.5..1.5)')
+    parser.add_argument('--native-hamiltonian', action='store_true', help='XTLS block norms and HopMat in-process instead of local_Hamilton')
+    parser.add_argument('--plot-backend', choices=['w2web', 'native'], default='w2web', help='native: figures with matplotlib in one batch instead of dos.pl, band.pl and gnuplot')
+    parser.add_argument('--init', choices=['native', 'w2web'], default='native', help='w2web: structure and init steps of SCF through the CGI scripts')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    parser.add_argument('--tolerance', type=float, default=2.0, help='allowed slowdown against the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the working folder')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='w2auto-bench-')
+    results = {}
+    regressions = []
+    try:
+        if not args.skip_scaling:
+            results['scaling'], found = runScaling(root, args.quick)
+            regressions += found
+        if not args.skip_e2e:
+            results['e2e'], found = runE2E(root, args)
+            regressions += found
+    finally:
+        if not args.keep and len(regressions) == 0: shutil.rmtree(root, ignore_errors=True)
+        else: print('working folder: ' + root)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f: regressions += compareBaseline(results, json.load(f), args.tolerance)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f: json.dump(results, f, indent=1)
+    if len(regressions) > 0:
+        print('Regressions:\n' + '\n'.join(regressions))
+        sys.exit(1)
+    print('No regressions')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# Stub of the WIEN2k toolchain, w2web CGI scripts and XTLS for the benchmarks of w2auto.
+# bench.py links this file under the names of the programs (x, run_lapw, instgen_lapw, local_Hamilton, x925, ...)
+# and of the CGI scripts (SRC_w2web/htdocs/session/new.cgi, ...), the name it was called with selects what it does.
+# Every program writes the files the next steps of w2auto read, in the formats of WIEN2k, but computes nothing.
+#
+# Environment:
+#   W2AUTO_STUB_LATENCY     seconds every program sleeps (run_lapw - every iteration), default 0
+#   W2AUTO_STUB_OUTPUT      bytes of extra stdout of every program, default 0
+#   W2AUTO_STUB_FILESIZE    bytes of big files (vector, clmsum, qtl, mmn ...), default 65536
+#   W2AUTO_STUB_ITERATIONS  SCF iterations of run_lapw, default 3
+#   W2AUTO_STUB_KPOINTS     k-points written by x kgen, default 20
+#   W2AUTO_STUB_BANDS       bands of lapw1 around the Fermi energy (separated from the others by gaps), default 10
+#   W2AUTO_STUB_HOPPINGS    rows of the block norms of local_Hamilton with hoppings above the border, default 2
+#   W2AUTO_STUB_LOG         JSONL file, every call appends {'program', 'cwd', 'time'}
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import re
+import urllib.parse
+
+join = os.path.join
+
+def env(name, default):
+    return type(default)(os.environ.get(name, default))
+
+latency = env('W2AUTO_STUB_LATENCY', 0.0)
+outputSize = env('W2AUTO_STUB_OUTPUT', 0)
+fileSize = env('W2AUTO_STUB_FILESIZE', 65536)
+
+def case():
+    return os.path.basename(os.getcwd())
+
+def write(fileName, content):
+    with open(fileName, 'w') as f: f.write(content)
+
+# contents depend only on the name and the seed, so the same step gives the same files (and cache hits)
+def writeBig(fileName, seed, size=None):
+    with open(fileName, 'wb') as f: f.write(random.Random(fileName + str(seed)).randbytes(fileSize if size is None else size))
+
+def filler():
+    line = ' stub output ' + '.'*50 + '\n'
+    sys.stdout.write(line*(outputSize//len(line)))
+
+def structAtoms(structFile):
+    with open(structFile, 'r') as f: content = f.read()
+    names = re.findall(r'[\n\s]+(\D\s?\S*)\s+NPT', content)
+    mults = [int(m) for m in re.findall(r'MULT=\s*(\d+)', content)]
+    return list(zip(names, mults))
+
+# ======================================= WIEN2k programs =======================================
+
+def nn(args):
+    for i, (name, mult) in enumerate(structAtoms(case()+'.struct')):
+        print(' ATOM: {0:3} {1:<10} RMT(1)=1.91000 AND RMT(2)=1.64000  SUMS TO 3.55000 LT. NN-DIST= 3.82000'.format(i+1, name))
+    write(case()+'.outputnn', 'NN output of the stub\n')
+
+def sgroup(args):
+    shutil.copyfile(case()+'.struct', case()+'.struct_sgroup')
+    write(case()+'.outputsgroup', 'space group of the stub\n')
+
+def symmetry(args):
+    shutil.copyfile(case()+'.struct', case()+'.struct_st')
+    write(case()+'.outputs', 'symmetry of the stub\n')
+
+def lstart(args):
+    c = case()
+    write(c+'.in0_st', 'TOT  13  (5...CA-LDA, 13...PBE-GGA, 11...WC-GGA)\nNR2V      IFFT      (R2V)\n   60   60   60    2.00  1    min IFFT-parameters, enhancement factor\n')
+    write(c+'.in1_st', 'WFFIL  EF=.5   (WFFIL, WFPRI, ENFIL, SUPWF)\n  7.00       10    4 (R-MT*K-MAX; MAX L IN WF, V-NMT)\nK-VECTORS FROM UNIT:4   -9.0       1.5  100   emin / de (emax=Ef+de) / nband\n')
+    write(c+'.in2_st', 'TOT             (TOT,FOR,QTL,EFG,FERMI)\n  -9.0    16.0   0.50 0.05  1   EMIN, NE, ESEPERMIN, ESEPER0, iqtlsave\nTETRA    0.000   (GAUSS,ROOT,TEMP,TETRA,ALL      eval)\n')
+    write(c+'.inc_st', '  0  0.00  0      NUMBER OF ORBITALS (EXCLUDING SPIN), SHIFT, IPRINT\n')
+    write(c+'.inm_st', 'MSR1   0.0   YES  (BROYD/PRATT, extra charge (+1 for additional e), norm)\n0.20            mixing FACTOR for BROYD/PRATT scheme\n1.00  1.00      PW and CLM-scaling factors\n9999  8         idum, HISTORY\n')
+    write(c+'.outputst', 'lstart of the stub\n')
+
+def kgen(args):
+    kpoints = env('W2AUTO_STUB_KPOINTS', 20)
+    lines = ['{0:10}{1:10}{2:10}{3:10}{4:10}{5:5.1f}'.format(k+1, k, 0, 0, kpoints, 1.0) for k in range(kpoints)]
+    write(case()+'.klist', '\n'.join(lines) + '\nEND\n')
+    write(case()+'.outputkgen', 'kgen of the stub\n')
+
+def dstart(args):
+    c = case()
+    writeBig(c+'.clmsum', 0)
+    shutil.copyfile(c+'.in0_st', c+'.in0_std')
+    write(c+'.outputd', 'dstart of the stub\n')
+
+def lapw1(args):
+    c = case()
+    klist = c + ('.klist_band' if '-band' in args else '.klist')
+    kpoints = 0
+    if os.path.exists(klist):
+        with open(klist, 'r') as f: kpoints = len([l for l in f if l.strip() != '' and not l.startswith('END')])
+    writeBig(c+'.vector', '-band' in args)
+    # case.energy: per k-point a line with k and the number of bands, then "band energy(Ry)" lines
+    lines = []
+    for k in range(kpoints):
+        energies = bandEnergies(k)
+        lines.append('{0:19.12e}{1:19.12e}{2:19.12e}{3:>10}{4:6}{5:6}{6:5.1f}'.format(0.01*k, 0.0, 0.0, str(k+1), 100, len(energies), 1.0))
+        lines += ['{0:12}{1:22.15f}'.format(b+1, e) for b, e in enumerate(energies)]
+    write(c+'.energy', '\n'.join(lines) + '\n')
+    write(c+'.output1', '       MATRIX SIZE  800  LOs:  40  RKM= 7.00  WEIGHT= 2.00  PGR:\n')
+    write('lapw1.error', '')
+
+fermiEnergy = 0.45
+rydbergToEv = 13.605693
+
+# bands of k-point k in Ry: 10 semicore bands, W2AUTO_STUB_BANDS bands in -6.5..1.5 eV around the Fermi energy, 10 bands above
+def bandEnergies(k):
+    bands = env('W2AUTO_STUB_BANDS', 10)
+    eV = [-20.0 + 0.5*b for b in range(10)] + [-6.5 + 8.0*b/max(1, bands-1) for b in range(bands)] + [4.0 + 0.6*b for b in range(10)]
+    return [fermiEnergy + (e + 0.2*((k*7 + b*3) % 5)/5)/rydbergToEv for b, e in enumerate(eV)]
+
+def lapw2(args):
+    writeBig(case()+'.qtl', '-band' in args)
+    write(case()+'.scf2', ':FER  : F E R M I - ENERGY(TETRAH.M.)=   0.4500000000\n')
+    write('lapw2.error', '')
+
+def tetra(args):
+    c = case()
+    with open(c+'.int', 'r') as f: lines = f.read().split('\n')
+    ndos = int(lines[2].split()[0])
+    labels = [l.split()[2] for l in lines[3:3+ndos]]
+    energies = [-1.5 + 0.0015*i for i in range(2000)]
+    for suffix, scale in [('', 1.0), ('ev', 13.605693)]:
+        for k, start in enumerate(range(0, ndos, 7)):
+            part = labels[start:start+7]
+            text = '# {0}\n#  EF=  0.45000   NDOS= {1}   DELTA=  0.00300\n#ENERGY '.format(c, len(part)) + ' '.join(part) + '\n'
+            text += ''.join('{0:10.5f}'.format(e*scale) + ''.join('{0:12.5f}'.format(abs((e*(j+start+1)) % 1.0)) for j in range(len(part))) + '\n' for e in energies)
+            write(c+'.dos'+str(k+1)+suffix, text)
+
+def spaghetti(args):
+    c = case()
+    lines = ['{0:10.5f}{1:10.5f}{2:10.5f}{3:10.5f}{4:14.6f}{5:6}'.format(0.01*k, 0, 0, 0.01*k, -5.0 + 0.1*b + 0.01*k, b) for b in range(40) for k in range(100)]
+    write(c+'.spaghetti_ene', '\n'.join(lines) + '\n')
+    write(c+'.spaghetti_ps', '%!PS stub\n')
+    write(c+'.bands.agr', '# stub\n')
+
+# x findbands -all e1 e2: bands in [e1, e2] eV relative to the Fermi energy at every k-point of case.energy
+def findbands(args):
+    c = case()
+    e1, e2 = [fermiEnergy + float(e)/rydbergToEv for e in args[-2:]]
+    with open(c+'.energy', 'r') as f: lines = f.read().split('\n')
+    kpoints = []
+    for line in lines:
+        words = line.split()
+        if len(words) == 2:
+            if words[0] == '1': kpoints.append([])
+            kpoints[-1].append((int(words[0]), float(words[1])))
+    text = ' At least bands in energy range\n   k-point  first   last   #states\n'
+    for k, energies in enumerate(kpoints):
+        inside = [b for b, e in energies if e1 <= e <= e2]
+        first, last = (inside[0], inside[-1]) if len(inside) > 0 else (0, -1)
+        text += '{0:10}{1:8}{2:8}{3:8}\n'.format(k+1, first, last, len(inside))
+    write(c+'.outputfind', text + ' \n \n')
+
+def wannier90(args):
+    c = case()
+    if '-pp' in args:
+        write(c+'.nnkp', 'begin projections\nend projections\n')
+        return
+    with open(c+'.win', 'r') as f: bands = int(re.search(r'num_wann\s*=\s*(\d+)', f.read()).group(1))
+    rng = random.Random(bands)
+    nrpts = 7
+    # like local_Hamilton of the stub: the first W2AUTO_STUB_HOPPINGS d blocks overlap with the last two p blocks
+    hoppings = env('W2AUTO_STUB_HOPPINGS', 2)
+    strong = lambda m, n: m < 5*hoppings and n >= bands-6
+    text = ' written by the stub\n{0:12}\n{1:12}\n'.format(bands, nrpts) + '    1'*nrpts + '\n'
+    for r in range(nrpts):
+        text += ''.join('{0:5}{1:5}{2:5}{3:5}{4:5}{5:12.6f}{6:12.6f}\n'.format(r-3, 0, 0, m+1, n+1,
+                        1.0 if r == 3 and (strong(m, n) or strong(n, m)) else rng.uniform(-0.1, 0.1), 0.0) for n in range(bands) for m in range(bands))
+    write(c+'_hr.dat', text)
+    write(c+'_band.dat', ''.join('{0:12.6f}{1:12.6f}\n'.format(0.01*k, -5.0 + 0.1*b) for b in range(bands) for k in range(100)))
+    write(c+'.wout', 'wannier90 of the stub\n')
+
+def w2w(args):
+    c = case()
+    writeBig(c+'.mmn', 0)
+    writeBig(c+'.amn', 0, fileSize//8)
+    write(c+'.eig', '1 1 -1.0\n')
+
+def x(args):
+    programs = {'nn':nn, 'sgroup':sgroup, 'symmetry':symmetry, 'lstart':lstart, 'kgen':kgen, 'dstart':dstart, 'lapw1':lapw1, 'lapw2':lapw2,
+                'tetra':tetra, 'spaghetti':spaghetti, 'findbands':findbands, 'wannier90':wannier90, 'w2w':w2w}
+    if args[0] not in programs: raise Exception('x: unknown program ' + args[0])
+    time.sleep(latency)
+    programs[args[0]](args[1:])
+    print('STOP  {0} END'.format(args[0].upper()))
+
+def run_lapw(args):
+    c = case()
+    iterations = min(int(args[args.index('-i')+1]) if '-i' in args else 40, env('W2AUTO_STUB_ITERATIONS', 3))
+    with open(c+'.scf', 'a') as scf:
+        for i in range(iterations):
+            print('    cycle {0} \t{1}\t(40/99 to go)'.format(i+1, time.strftime('%c')))
+            sys.stdout.flush()
+            time.sleep(latency)
+            for program in ['lapw1', 'lapw2']: globals()[program]([])
+            writeBig(c+'.clmsum', i+1)
+            writeBig(c+'.vsp', i+1, fileSize//4)
+            writeBig(c+'.vns', i+1, fileSize//4)
+            scf.write(':ITE{0:03}:  {1}. ITERATION\n'.format(i+1, i+1))
+            scf.write(':ENE  : ********** TOTAL ENERGY IN Ry =       -1234.{0:05}\n'.format(i))
+            scf.write(':DIS  :  CHARGE DISTANCE       ( 0.0001000 for atom    1 spin 1)    {0:.7f}\n'.format(0.1/(i+1)))
+            scf.write(':FER  : F E R M I - ENERGY(TETRAH.M.)=   0.4500000000\n')
+            scf.flush()
+            if os.path.exists('.stop'): break
+    print('ec cc and fc_conv 1 1 1')
+
+# setrmt_lapw <case> -r <reduction>: case.struct with RMTs of the stub as case.struct_setrmt
+def setrmt_lapw(args):
+    with open(args[0]+'.struct', 'r') as f: content = f.read()
+    write(args[0]+'.struct_setrmt', re.sub(r'RMT=\s*[\d.]+', 'RMT=    1.8500', content))
+    print('setrmt of the stub')
+
+def instgen_lapw(args):
+    atoms = structAtoms(case()+'.struct')
+    write(case()+'.inst', ''.join('{0}\nAr 3\n3, 2, 0.0  N\n3, 2, 0.0  N\n'.format(name) for name, mult in atoms) + '****\n****\n')
+
+def configure_int_lapw(args):
+    # -b total <atom> <tot,s,p,d> ... end
+    labels = ['total']
+    i = 2
+    while i+1 < len(args) and args[i] != 'end':
+        labels += [orbital+'-'+args[i] for orbital in args[i+1].split(',')]
+        i += 2
+    text = '{0}            #Title\n  -0.50000   0.00200   1.50000   0.00300   #Emin, DE, Emax, Gauss-broadening(>de)\n'.format(case())
+    text += '    {0}     N   #number of DOS\n'.format(len(labels))
+    text += ''.join('    0    {0}   {1}\n'.format(j+1, l) for j, l in enumerate(labels))
+    write(case()+'.int', text)
+
+def prepare_w2wdir(args):
+    c = case()
+    name = args[0]
+    for fileName in os.listdir('.'):
+        base, ext = os.path.splitext(fileName)
+        if base == c and not re.match(r'\.(vector|qtl|dos|spaghetti|output)', ext):
+            shutil.copyfile(fileName, join(name, name+ext))
+
+def write_inwf(args):
+    lines = sys.stdin.read().split('\n')
+    first, last = [int(w) for w in lines[0].split()[:2]]
+    projections = sum({'s':1, 'p':3, 'd':5}[l.split(':')[1].strip()] for l in lines[1:] if ':' in l)
+    write(case()+'.inwf', 'BOTH\n{0} {1}\n{2} {2}\n'.format(first, last, projections))
+    print('{0} bands, {1} initial projections'.format(last-first+1, projections))
+
+def write_win(args):
+    with open(case()+'.inwf', 'r') as f: first, last = [int(w) for w in f.read().split('\n')[1].split()]
+    write(case()+'.win', 'num_bands = {0}\nnum_wann = {0}\nhr_plot                = .true.\n'.format(last-first+1))
+
+# parallel run: wannier90.x <case>.win
+def wannier90_x(args):
+    wannier90([])
+
+def gnuplot(args):
+    script = sys.stdin.read()
+    output = re.search(r"set output '(.*?)'", script)
+    if output is not None: write(output.group(1), '')
+
+# local_Hamilton <case>_hr.dat <n> <count1> <orbitals1> ... <blocks> <row> <rows...>
+# first call (1 1) prints the block norms, the others write HopMat.dat of the row and its overlapping rows
+def local_Hamilton(args):
+    n = int(args[1])
+    pairs = [(int(args[2+2*i]), int(args[3+2*i])) for i in range(n)]
+    sizes = [orbitals for count, orbitals in pairs for _ in range(count)]
+    rest = [int(a) for a in args[2+2*n:]]
+    if rest == [1, 1]:
+        hoppings = env('W2AUTO_STUB_HOPPINGS', 2)
+        m = len(sizes)
+        # rows with hoppings overlap with the last two blocks (the ligands)
+        norms = [[10.0 if i == j else (4.0 if j < hoppings and i >= m-2 else 1.0 + 0.01*((i*7+j*3) % 100)) for j in range(m)] for i in range(m)]
+        print(' Block Norms Max ')
+        for row in norms: print(' ' + ' '.join('{0:.3f}'.format(v) for v in row))
+        print(' Block Norms 2nd max ')
+        return
+    blocks = [rest[1]] + rest[2:]
+    size = sum(sizes[b-1] for b in blocks)
+    rng = random.Random(' '.join(args))
+    A = [[0.0]*size for _ in range(size)]
+    for i in range(size):
+        for j in range(i, size): A[i][j] = A[j][i] = rng.uniform(-1, 1) + (3.0 if i == j else 0.0)
+    write('HopMat.dat', ''.join(' '.join('{0:10.5f}'.format(v) for v in row) + '\n' for row in A))
+    print('HopMat of blocks ' + ' '.join(str(b) for b in blocks))
+
+def x925(args):
+    name = args[-1]
+    write(join('..', 'xobjs', name+'.obj'), 'obj of the stub\n')
+    print('x925 of the stub: ' + name)
+
+def xc(args):
+    sys.stdin.read()
+    write('spectrum.ps', '%!PS stub\n')
+    print(''.join('{0:10.3f}{1:10.3f}\n'.format(e*0.1, 1.0/(1+(e*0.1)**2)) for e in range(-100, 100)))
+
+# ======================================= w2web CGI scripts =======================================
+
+def cgiParams():
+    if os.environ.get('REQUEST_METHOD') == 'POST': query = sys.stdin.read(int(os.environ.get('CONTENT_LENGTH', '0')))
+    else: query = os.environ.get('QUERY_STRING', '')
+    return dict(urllib.parse.parse_qsl(query, keep_blank_values=True))
+
+def sessionDir(SID):
+    with open(join(os.environ['W2WEB'], 'sessions', SID), 'r') as f: return f.read().strip()
+
+def structForm(workDir, SID):
+    c = os.path.basename(workDir)
+    atoms = structAtoms(join(workDir, c+'.struct'))
+    html = '<FORM ACTION=/util/structsave.pl METHOD=POST>\n<INPUT TYPE=hidden NAME="SID" VALUE="{0}">\n'.format(SID)
+    html += '<INPUT TYPE=text NAME="title" VALUE="{0}">\n<SELECT NAME="s_lattice">\n<OPTION value=F selected>F</OPTION>\n</SELECT>\n'.format(c)
+    for i, (name, mult) in enumerate(atoms):
+        html += '<INPUT TYPE=text NAME="name{0}" VALUE="{1}">\n<INPUT TYPE=text NAME="rmt{0}" VALUE=1.91 >\n'.format(i+1, name)
+        html += ''.join('<INPUT TYPE=text NAME="pos{0}_{1}" VALUE="0.12500000 0.12500000 0.12500000">\n'.format(i+1, k+1) for k in range(mult))
+    html += 'Lattice parameters in <SELECT NAME="unit">\n<OPTION value="bohr" selected>bohr</OPTION>\n</SELECT>\n</FORM>\n'
+    return html
+
+def w2web(script):
+    params = cgiParams()
+    w2webDir = os.environ['W2WEB']
+    SID = params.get('SID', '')
+    print('Content-type: text/html\n')
+    if script == 'session/new.cgi':
+        SID = str(random.randrange(10**8))
+        write(join(w2webDir, 'sessions', SID), '')
+        print('<A HREF="/util/dir.pl?SID={0}&">{1}</A>'.format(SID, params.get('NEWNAME', '')))
+    elif script == 'session/save.cgi':
+        write(join(w2webDir, 'sessions', SID), params['dir'])
+        print('session {0} saved'.format(SID))
+    elif script == 'util/structgen.pl':
+        print(structForm(sessionDir(SID), SID))
+    elif script in ['util/structstart.pl', 'util/structsave.pl', 'util/structrmt.pl', 'util/structend.pl', 'util/structask.pl']:
+        workDir = sessionDir(SID)
+        c = os.path.basename(workDir)
+        # RMTs of setrmt_lapw go to case.struct, the end of StructGen removes case.struct_setrmt
+        if script == 'util/structrmt.pl':
+            os.chdir(workDir)
+            setrmt_lapw([c, '-r', params.get('reduc', '0')])
+            shutil.copyfile(c+'.struct_setrmt', c+'.struct')
+        if script == 'util/structend.pl' and os.path.exists(join(workDir, c+'.struct_setrmt')): os.remove(join(workDir, c+'.struct_setrmt'))
+        print('<H2>{0} of the stub</H2>'.format(script))
+    elif script == 'exec/initlapw.pl':
+        workDir = sessionDir(SID)
+        c = os.path.basename(workDir)
+        if params.get('phase') == '15':
+            for st, dst in {'in0_st':'in0', 'in1_st':'in1c', 'in2_st':'in2c', 'inc_st':'inc', 'inm_st':'inm'}.items():
+                shutil.copyfile(join(workDir, c+'.'+st), join(workDir, c+'.'+dst))
+        print('<H2>init phase {0} of the stub</H2>'.format(params.get('phase')))
+    elif script in ['exec/dos.pl', 'exec/band.pl']:
+        workDir = sessionDir(SID)
+        if params.get('next') == 'continue':
+            write(join(workDir, os.path.basename(workDir)+'.insp'), 'frame\n0.xxxx  eF\n')
+            print('<H2>insp of the stub</H2>')
+        else:
+            picture = '/tmp/{0}_{1}.{2}'.format(SID, script[5:-3], 'png' if script == 'exec/dos.pl' else 'jpg')
+            write(w2webDir + picture, 'picture of the stub\n')
+            write(w2webDir + os.path.splitext(picture)[0] + '.ps', '%!PS stub\n')
+            print('<IMG SRC={0}>'.format(picture))
+    else: raise Exception('w2web: unknown script ' + script)
+
+def main():
+    start = time.time()
+    path = os.path.abspath(sys.argv[0])
+    program = os.path.basename(path)
+    args = sys.argv[1:]
+    if os.sep + 'htdocs' + os.sep in path:
+        time.sleep(latency)
+        w2web(path.split(os.sep + 'htdocs' + os.sep)[-1])
+    elif program == 'x': x(args)
+    else:
+        time.sleep(latency if program != 'run_lapw' else 0)
+        globals()[program.replace('.', '_')](args)
+    filler()
+    sys.stdout.flush()
+    if 'W2AUTO_STUB_LOG' in os.environ:
+        with open(os.environ['W2AUTO_STUB_LOG'], 'a') as f: f.write(json.dumps({'program':program, 'cwd':os.getcwd(), 'time':time.time()-start}) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import os, sys
+import pytest
+
+rootDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, rootDir)
+import w2auto
+
+exampleDir = os.path.join(rootDir, 'Examples')
+
+# caches, hash caches and the tracer are per process in w2auto, every test starts without them
+@pytest.fixture(autouse=True)
+def freshProcess(monkeypatch):
+    w2auto.caches.clear()
+    w2auto.hashCaches.clear()
+    monkeypatch.setattr(w2auto, 'tracerGlobal', None)
+    # set by setupRun
+    monkeypatch.setattr(w2auto, 'debugMode', False, raising=False)
+    monkeypatch.setattr(w2auto, 'globalCacheDirGlobal', None)
+    monkeypatch.setattr(w2auto, 'chunkStoreRootGlobal', None)
+    yield
+    w2auto.caches.clear()
+    w2auto.hashCaches.clear()
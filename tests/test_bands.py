@@ -0,0 +1,43 @@
+import numpy as np
+import w2auto
+
+# case.energy: lattice lines, then per k-point a header line and "band energy" lines
+def energyFile(kpoints):
+    lines = ['       0.10000000000000       0.30000000000000       0.50000000000000'] * 2
+    for k, energies in enumerate(kpoints):
+        lines.append(' 0.000000000000E+00 0.000000000000E+00 0.{0:012d}E+00{1:>10}{2:>6}  1.0'.format(k, k+1, len(energies)))
+        lines += ['{0:12d}  {1:.12E}'.format(i+1, e) for i, e in enumerate(energies)]
+    return '\n'.join(lines) + '\n'
+
+def test_read_band_energies(tmp_path):
+    (tmp_path / 'case.energy').write_text(energyFile([[-1.0, 0.5, 0.7], [-0.9, 0.6]]))
+    energies = w2auto.readBandEnergies(str(tmp_path), 'case')
+    assert energies.shape == (2, 3)
+    assert np.allclose(energies[0], [-1.0, 0.5, 0.7])
+    assert np.allclose(energies[1, :2], [-0.9, 0.6]) and np.isnan(energies[1, 2])
+
+# k-parallel lapw1 writes case.energy_1, case.energy_2 ...
+def test_read_parallel_band_energies(tmp_path):
+    (tmp_path / 'case.energy').write_text('')
+    for i, k in enumerate([[[-1.0, 0.5]], [[-1.1, 0.4]], [[-1.2, 0.3]]], 1): (tmp_path / 'case.energy_{0}'.format(i)).write_text(energyFile(k))
+    (tmp_path / 'case.energy_so').write_text(energyFile([[5.0, 6.0]]))
+    energies = w2auto.readBandEnergies(str(tmp_path), 'case')
+    assert np.allclose(energies, [[-1.0, 0.5], [-1.1, 0.4], [-1.2, 0.3]])
+
+def test_band_windows():
+    # band 3 overlaps band 2: only bands 2-3 are a window of 2 bands
+    energies = np.array([[-5.0, -4.0, -2.5, 3.0],
+                         [-6.0, -2.0, 0.0, 2.0]])
+    windows = w2auto.bandWindows(energies, 2)
+    assert [w[0] for w in windows] == [2]
+    first, e1, e2, gap = windows[0]
+    assert (e1, e2, gap) == (-4.5, 1.0, 1.0)
+    assert [w[0] for w in w2auto.bandWindows(energies, 1)] == [1, 4]
+    # no band below or above: 1 of margin
+    assert w2auto.bandWindows(energies, 4) == [(1, -7.0, 4.0, np.inf)]
+    assert w2auto.bandWindows(energies, 5) == []
+
+def test_band_windows_need_all_kpoints():
+    energies = np.array([[-5.0, -1.0, 1.0],
+                         [-5.0, np.nan, np.nan]])
+    assert [w[0] for w in w2auto.bandWindows(energies, 1)] == [1]
@@ -0,0 +1,172 @@
+import os, json, multiprocessing
+import w2auto
+
+def write(path, text):
+    with open(str(path), 'w') as f: f.write(text)
+
+def read(path):
+    with open(str(path)) as f: return f.read()
+
+# the command counts its runs outside of workDir
+def countedCommand(tmp_path):
+    return 'echo run >> ' + str(tmp_path / 'runs') + '; cat in.txt > out.txt; echo done'
+
+def runs(tmp_path):
+    return read(tmp_path / 'runs').count('run') if (tmp_path / 'runs').exists() else 0
+
+def test_fingerprint_ignores_hidden_files(tmp_path):
+    work = tmp_path / 'work'
+    work.mkdir()
+    write(work / 'a', '1')
+    fingerprint = w2auto.treeFingerprint(str(work))
+    write(work / '.hidden', 'x')
+    write(work / ':log', 'x')
+    (work / '.snapshots').mkdir()
+    write(work / '.snapshots' / 'b', 'x')
+    assert w2auto.treeFingerprint(str(work)) == fingerprint
+    write(work / 'a', '2')
+    assert w2auto.treeFingerprint(str(work)) != fingerprint
+    os.chmod(str(work / 'a'), 0o755)
+    write(work / 'a', '1')
+    assert w2auto.treeFingerprint(str(work)) != fingerprint
+
+def test_same_input_is_a_cache_hit(tmp_path):
+    work = tmp_path / 'work'
+    work.mkdir()
+    write(work / 'in.txt', 'input 1')
+    cmd = countedCommand(tmp_path)
+    assert w2auto.runCommand(cmd, str(work)).strip() == 'done'
+    assert read(work / 'out.txt') == 'input 1'
+    # back to the input state: the output state is restored without running the command
+    os.remove(str(work / 'out.txt'))
+    assert w2auto.runCommand(cmd, str(work)).strip() == 'done'
+    assert read(work / 'out.txt') == 'input 1'
+    assert runs(tmp_path) == 1
+    # other input: the command runs again
+    os.remove(str(work / 'out.txt'))
+    write(work / 'in.txt', 'input 2')
+    w2auto.runCommand(cmd, str(work))
+    assert read(work / 'out.txt') == 'input 2'
+    assert runs(tmp_path) == 2
+
+def test_cache_is_found_by_input_hash(tmp_path):
+    work = tmp_path / 'work'
+    work.mkdir()
+    write(work / 'in.txt', 'input')
+    inHash = w2auto.treeFingerprint(str(work))
+    w2auto.runCommand(countedCommand(tmp_path), str(work))
+    cache = w2auto.getCache(str(work))
+    assert cache.findSameState(countedCommand(tmp_path), inHash) is not None
+    assert cache.findSameState('other command', inHash) is None
+    assert cache.findSameState(countedCommand(tmp_path), 'f'*40) is None
+
+def test_journal_drops_torn_line(tmp_path):
+    cache = w2auto.Cache(str(tmp_path))
+    cache.add(w2auto.CacheLine('cmd1', None, 'state1', 'output1', 'hash1'))
+    cache.add(w2auto.CacheLine('cmd2', None, 'state2', 'output2', 'hash2'))
+    with open(cache.cacheFile, 'a') as f: f.write('{"cmd": "cmd3", "inSt')
+    cache = w2auto.Cache(str(tmp_path))
+    assert sorted(l.cmd for l in cache.cache) == ['cmd1', 'cmd2']
+    assert cache.index[('cmd2', 'hash2')].output == 'output2'
+    # the torn line is gone after the compaction on load
+    assert all(json.loads(line) for line in read(cache.cacheFile).splitlines())
+
+def test_journal_is_shared(tmp_path):
+    first = w2auto.Cache(str(tmp_path))
+    second = w2auto.Cache(str(tmp_path))
+    first.add(w2auto.CacheLine('cmd', None, 'state', 'output', 'hash'))
+    assert ('cmd', 'hash') not in second.index
+    second.refresh()
+    assert second.index[('cmd', 'hash')].outState == 'state'
+
+def test_superseded_lines_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto.Cache, 'needCompaction', lambda self: self.superseded > 2)
+    cache = w2auto.Cache(str(tmp_path))
+    for i in range(3): cache.add(w2auto.CacheLine('cmd', None, 'state'+str(i), 'output', 'hash'))
+    assert len(read(cache.cacheFile).splitlines()) == 3
+    cache.add(w2auto.CacheLine('cmd', None, 'state3', 'output', 'hash'))
+    assert len(read(cache.cacheFile).splitlines()) == 1
+    assert w2auto.Cache(str(tmp_path)).index[('cmd', 'hash')].outState == 'state3'
+
+def test_own_lines_are_not_read_again(tmp_path):
+    cache = w2auto.Cache(str(tmp_path), compaction=False)
+    cache.add(w2auto.CacheLine('cmd', None, 'state0', 'output', 'hash'))
+    cache.add(w2auto.CacheLine('cmd', None, 'state1', 'output', 'hash'))
+    assert cache.superseded == 1 and cache.offset == os.path.getsize(cache.cacheFile)
+    cache.refresh()
+    assert cache.superseded == 1 and len(cache.cache) == 2
+    assert cache.index[('cmd', 'hash')].outState == 'state1'
+
+# every process rewrites its own key, so compactions run while the others append
+def appendLines(workDir, worker):
+    cache = w2auto.Cache(workDir)
+    for i in range(30):
+        cache.add(w2auto.CacheLine('cmd'+str(worker), None, 'state'+str(i), 'output', 'hash'))
+        cache.add(w2auto.CacheLine('cmd'+str(worker)+'_'+str(i), None, 'state', 'output', 'hash'))
+
+def test_lines_are_not_lost_by_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto.Cache, 'needCompaction', lambda self: self.superseded > 2)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=appendLines, args=(str(tmp_path), w)) for w in range(4)]
+    for p in workers: p.start()
+    for p in workers: p.join()
+    assert all(p.exitcode == 0 for p in workers)
+    cache = w2auto.Cache(str(tmp_path))
+    for w in range(4):
+        assert cache.index[('cmd'+str(w), 'hash')].outState == 'state29'
+        assert all(('cmd'+str(w)+'_'+str(i), 'hash') in cache.index for i in range(30))
+
+# caches of old versions: one JSON list, outputs inline, no input hashes
+def test_old_cache_format(tmp_path):
+    write(tmp_path / '.cache', json.dumps([{'cmd': 'cmd', 'inState': 'commit1', 'outState': 'commit2', 'output': 'old output'}]))
+    cache = w2auto.Cache(str(tmp_path))
+    assert len(cache.legacy) == 1 and len(cache.index) == 0
+    assert cache.legacy[0].output == 'old output' and cache.legacy[0].inlineOutput is None
+    assert json.loads(read(tmp_path / '.cache').splitlines()[0])['outputHash'] == cache.legacy[0].outputHash
+    assert len(w2auto.Cache(str(tmp_path)).legacy) == 1
+
+def test_blob_store(tmp_path):
+    store = w2auto.BlobStore(str(tmp_path))
+    data = b'output line\n' * 1000
+    blobHash = store.put(data)
+    assert store.put(data) == blobHash
+    assert store.get(blobHash) == data
+    assert os.path.getsize(store.path(blobHash)) < len(data)
+    assert len(list(tmp_path.rglob('*.tmp'))) == 0
+
+def test_output_is_read_on_demand(tmp_path):
+    cache = w2auto.Cache(str(tmp_path))
+    cache.add(w2auto.CacheLine('cmd', None, 'state', 'output', 'hash'))
+    record = json.loads(read(cache.cacheFile).splitlines()[0])
+    assert 'output' not in record
+    assert w2auto.Cache(str(tmp_path)).index[('cmd', 'hash')].output == 'output'
+
+def test_global_cache_is_shared_by_workdirs(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto, 'globalCacheDirGlobal', str(tmp_path / 'global'))
+    monkeypatch.setattr(w2auto, 'globalCaches', {})
+    cmd = countedCommand(tmp_path)
+    for name in ['first', 'second']:
+        work = tmp_path / name
+        work.mkdir()
+        write(work / 'in.txt', 'input')
+        assert w2auto.runCommand(cmd, str(work)).strip() == 'done'
+        assert read(work / 'out.txt') == 'input'
+    assert runs(tmp_path) == 1
+
+# side effects are absolute paths, such commands stay in the cache of their workDir
+def test_side_effects_are_not_global(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto, 'globalCacheDirGlobal', str(tmp_path / 'global'))
+    monkeypatch.setattr(w2auto, 'globalCaches', {})
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    cmd = 'echo run >> ' + str(tmp_path / 'runs') + '; cp in.txt ' + str(outside / 'pic.png')
+    for name in ['first', 'second']:
+        work = tmp_path / name
+        work.mkdir()
+        write(work / 'in.txt', name)
+        w2auto.runCommand(cmd, str(work), sideEffectDirs=[str(outside)])
+    assert runs(tmp_path) == 2
+    os.remove(str(outside / 'pic.png'))
+    w2auto.runCommand(cmd, str(tmp_path / 'first'), sideEffectDirs=[str(outside)])
+    assert runs(tmp_path) == 2
+    assert read(outside / 'pic.png') == 'first'
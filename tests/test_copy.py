@@ -0,0 +1,44 @@
+import os
+import w2auto
+
+def write(path, text):
+    with open(str(path), 'w') as f: f.write(text)
+
+def read(path):
+    with open(str(path)) as f: return f.read()
+
+def scfFolder(root):
+    scf = root / 'scf'
+    (scf / 'sub').mkdir(parents=True)
+    for name in ['case.clmsum', 'case.in1', 'case.vector', 'case.energy', '.session', ':log', 'sub/case.vsp']: write(scf / name, name)
+    return scf
+
+def test_copy_all_files(tmp_path):
+    scf = scfFolder(tmp_path)
+    dst = tmp_path / 'dos'
+    dst.mkdir()
+    w2auto.copyAllFiles(str(scf), str(dst), w2auto.scfReadOnlyPatterns, w2auto.scfRegeneratedPatterns)
+    assert sorted(os.listdir(str(dst))) == ['case.clmsum', 'case.in1', 'sub']
+    assert read(dst / 'sub' / 'case.vsp') == 'sub/case.vsp'
+    # a stage may write its inputs, they never share data with the SCF
+    write(dst / 'case.in1', 'changed')
+    assert read(scf / 'case.in1') == 'case.in1'
+
+def test_read_only_files_without_hard_links(tmp_path, monkeypatch):
+    scf = scfFolder(tmp_path)
+    dst = tmp_path / 'dos'
+    dst.mkdir()
+    monkeypatch.setattr(w2auto, 'reflinkFile', lambda src, dst: open(dst, 'w').close() or False)
+    def noLinks(src, dst): raise PermissionError(1, 'Operation not permitted')
+    monkeypatch.setattr(os, 'link', noLinks)
+    w2auto.copyAllFiles(str(scf), str(dst), w2auto.scfReadOnlyPatterns)
+    assert read(dst / 'case.clmsum') == 'case.clmsum'
+
+def test_full_copies(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto, 'cloneModeGlobal', 'copy')
+    scf = scfFolder(tmp_path)
+    dst = tmp_path / 'dos'
+    dst.mkdir()
+    w2auto.copyAllFiles(str(scf), str(dst), w2auto.scfReadOnlyPatterns)
+    assert os.stat(str(dst / 'case.clmsum')).st_ino != os.stat(str(scf / 'case.clmsum')).st_ino
+    assert read(dst / 'case.vector') == 'case.vector'
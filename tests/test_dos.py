@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import w2auto
+
+# x tetra of 2 atoms: total + tot,s,p,d of each atom, split into case.dos1 and case.dos2 (and *ev)
+def writeTetraFiles(folder, suffix):
+    energies = np.linspace(-1.0, 1.0, 5)
+    labels = ['total'] + ['{0}:{1}'.format(a, o) for a in (1, 2) for o in ('tot', 's', 'p', 'd')]
+    chunks = [labels[:3], labels[3:6], labels[6:]]
+    column = 0
+    for k, chunk in enumerate(chunks, 1):
+        with open(os.path.join(folder, 'case.dos{0}{1}'.format(k, suffix)), 'w') as f:
+            f.write('# case title\n#  EF= 0.50000   NDOS= {0}   NENRG= 5  ENERGY UNIT\n'.format(len(chunk)))
+            f.write('# ENERGY ' + ' '.join(chunk) + '\n')
+            for e in energies: f.write(' '.join('{0:12.6f}'.format(v) for v in [e] + [column + i + e/10 for i in range(len(chunk))]) + '\n')
+        column += len(chunk)
+    return labels
+
+def test_read_dos_files(tmp_path):
+    for suffix in ['', 'ev']: labels = writeTetraFiles(str(tmp_path), suffix)
+    dosFiles = w2auto.readDOSFiles(str(tmp_path), 'case')
+    assert sorted(dosFiles['data']) == ['', 'ev'] and len(dosFiles['original']) == 6
+    header, readLabels, data = dosFiles['data']['ev']
+    assert readLabels == labels and data.shape == (5, 10)
+    assert np.allclose(data[:, 1:] - data[:, :1]/10, np.arange(9))
+    assert 'NDOS= 3' in header[1]
+
+def test_dos_view_of_one_atom(tmp_path):
+    for suffix in ['', 'ev']: writeTetraFiles(str(tmp_path), suffix)
+    dosFiles = w2auto.readDOSFiles(str(tmp_path), 'case')
+    original = {f: open(f).read() for f in dosFiles['original']}
+    # total + tot,s,p,d of atom 2, as x tetra gives for this atom alone
+    w2auto.writeDOSView(str(tmp_path), 'case', dosFiles, [0, 5, 6, 7, 8])
+    assert sorted(os.listdir(str(tmp_path))) == ['case.dos1', 'case.dos1ev']
+    view = w2auto.readDOSFiles(str(tmp_path), 'case')
+    header, labels, data = view['data']['ev']
+    assert labels == ['total', '2:tot', '2:s', '2:p', '2:d'] and 'NDOS= 5' in header[1]
+    assert np.allclose(data[:, 1:] - data[:, :1]/10, [0, 5, 6, 7, 8])
+    w2auto.restoreDOSFiles(str(tmp_path), dosFiles)
+    assert {f: open(f).read() for f in original} == original
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import w2auto
+
+# _hr.dat of wannier90: comment, size, number of R, degeneracies (15 per line), then R1 R2 R3 m n re im
+def writeHr(fileName, H, R, degeneracy):
+    count, size = H.shape[:2]
+    lines = ['written by the test', str(size), str(count)]
+    lines += [' '.join(str(d) for d in degeneracy[i:i+15]) for i in range(0, count, 15)]
+    for r in range(count):
+        for n in range(size):
+            for m in range(size):
+                lines.append('{0} {1} {2} {3} {4} {5:.10f} {6:.10f}'.format(*R[r], m+1, n+1, H[r, m, n].real, H[r, m, n].imag))
+    with open(fileName, 'w') as f: f.write('\n'.join(lines) + '\n')
+
+def randomModel(count=17, size=5, seed=0):
+    rng = np.random.default_rng(seed)
+    R = np.array([[i-count//2, 0, 0] for i in range(count)])
+    H = np.round(rng.normal(size=(count, size, size)) + 1j*rng.normal(size=(count, size, size)), 6)
+    degeneracy = rng.integers(1, 4, count)
+    return R, degeneracy, H
+
+def test_parse_divides_by_degeneracy(tmp_path):
+    R, degeneracy, H = randomModel()
+    fileName = str(tmp_path / 'case_hr.dat')
+    writeHr(fileName, H, R, degeneracy)
+    h = w2auto.WannierHamiltonian.parse(fileName)
+    assert np.array_equal(h.R, R) and np.array_equal(h.degeneracy, degeneracy)
+    assert np.allclose(h.H, H / degeneracy[:, None, None])
+    assert h.index[(0, 0, 0)] == 8
+
+def test_parse_rejects_truncated_file(tmp_path):
+    R, degeneracy, H = randomModel(count=3, size=2)
+    fileName = str(tmp_path / 'case_hr.dat')
+    writeHr(fileName, H, R, degeneracy)
+    with open(fileName) as f: lines = f.readlines()
+    with open(fileName, 'w') as f: f.writelines(lines[:-1])
+    try:
+        w2auto.WannierHamiltonian.parse(fileName)
+    except Exception as e:
+        assert 'hopping lines' in str(e)
+    else:
+        assert False
+
+def test_save_and_load(tmp_path):
+    R, degeneracy, H = randomModel()
+    h = w2auto.WannierHamiltonian(R, degeneracy, H)
+    h.save(str(tmp_path / 'h'))
+    loaded = w2auto.WannierHamiltonian.load(str(tmp_path / 'h'))
+    assert np.array_equal(loaded.R, R) and np.array_equal(loaded.degeneracy, degeneracy)
+    assert np.array_equal(np.asarray(loaded.H), H)
+
+def test_block_norms():
+    R, degeneracy, H = randomModel()
+    h = w2auto.WannierHamiltonian(R, degeneracy, H)
+    blockSizes = [1, 3, 1]
+    starts = [0, 1, 4]
+    norms, second, cells = h.blockNorms(blockSizes, chunk=4)
+    for a in range(3):
+        for b in range(3):
+            byR = sorted(np.linalg.norm(H[r, starts[a]:starts[a]+blockSizes[a], starts[b]:starts[b]+blockSizes[b]]) for r in range(len(R)))
+            assert np.isclose(norms[a, b], byR[-1]) and np.isclose(second[a, b], byR[-2])
+            assert np.isclose(np.linalg.norm(H[cells[a, b], starts[a]:starts[a]+blockSizes[a], starts[b]:starts[b]+blockSizes[b]]), byR[-1])
+
+def test_block_norms_need_all_orbitals():
+    h = w2auto.WannierHamiltonian(*randomModel())
+    try:
+        h.blockNorms([1, 3])
+    except Exception as e:
+        assert '4 orbitals in blocks, but 5' in str(e)
+    else:
+        assert False
+
+def test_local_hamiltonian():
+    R, degeneracy, H = randomModel()
+    h = w2auto.WannierHamiltonian(R, degeneracy, H)
+    blockSizes = [1, 3, 1]
+    norms, second, cells = h.blockNorms(blockSizes)
+    matrix = h.localHamiltonian(blockSizes, [0, 2], cells)
+    assert matrix.shape == (2, 2)
+    assert np.allclose(matrix, matrix.T)
+    home = h.index[(0, 0, 0)]
+    assert np.isclose(matrix[0, 0], H[home, 0, 0].real)
+    # block 2 sits in the cell of its largest hopping from block 0
+    r = R[cells[0, 2]]
+    assert np.isclose(matrix[0, 1], (H[cells[0, 2], 0, 4].real + H[h.index[tuple((-r).tolist())], 4, 0].real) / 2)
+
+def test_read_wannier_hamiltonian_cache(tmp_path):
+    R, degeneracy, H = randomModel()
+    fileName = str(tmp_path / 'case_hr.dat')
+    writeHr(fileName, H, R, degeneracy)
+    cacheDir = str(tmp_path / 'cache')
+    w2auto.hamiltonians.clear()
+    first = w2auto.readWannierHamiltonian(fileName, cacheDir)
+    assert w2auto.readWannierHamiltonian(fileName, cacheDir) is first
+    # no temporary files are left
+    assert len(os.listdir(cacheDir)) == 2 and not [f for f in os.listdir(cacheDir) if '.tmp' in f]
+    # the next run loads the .npy files instead of parsing
+    w2auto.hamiltonians.clear()
+    os.remove(fileName)
+    writeHr(fileName, H, R, degeneracy)
+    loaded = w2auto.readWannierHamiltonian(fileName, cacheDir)
+    assert loaded is not first and isinstance(loaded.H, np.memmap)
+    assert np.allclose(loaded.H, first.H)
+    w2auto.hamiltonians.clear()
+
+def test_format_block_norms():
+    text = w2auto.formatBlockNorms(np.array([[1.0, 0.25], [0.25, 2.0]]), np.array([[0.5, 0.125], [0.125, 1.0]]))
+    assert text == ' Block Norms Max \n 1.000 0.250\n 0.250 2.000\n Block Norms 2nd max \n 0.500 0.125\n 0.125 1.000\n'
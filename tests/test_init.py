@@ -0,0 +1,66 @@
+import os, json
+import pytest
+import w2auto
+from benchmarks import bench
+
+# inputs as x lstart writes them
+in1 = 'WFFIL  EF=.5   (WFFIL, WFPRI, ENFIL, SUPWF)\n  7.00       10    4 (R-MT*K-MAX; MAX L IN WF, V-NMT)\n  0.30    4  0      (GLOBAL E-PARAMETER WITH n OTHER CHOICES, global APW/LAPW)\nK-VECTORS FROM UNIT:4   -9.0       1.5  100   emin / de (emax=Ef+de) / nband\n'
+inm = 'MSR1   0.0   YES  (BROYD/PRATT, extra charge (+1 for additional e), norm)\n0.20            mixing FACTOR for BROYD/PRATT scheme\n1.00  1.00      PW and CLM-scaling factors\n'
+
+def test_set_input_field():
+    assert w2auto.setInputField('  7.00       10    4 (R-MT*K-MAX)', 0, 7.5) == '   7.5       10    4 (R-MT*K-MAX)'
+    assert w2auto.setInputField('  7.00       10    4 (R-MT*K-MAX)', 1, 12) == '  7.00       12    4 (R-MT*K-MAX)'
+    # longer than the old field: still separated from the previous one
+    assert w2auto.setInputField('A 1 B', 1, 123.25) == 'A 123.25 B'
+    with pytest.raises(Exception, match='field 9'): w2auto.setInputField('A 1 B', 8, 1)
+
+def test_edit_init_inputs(tmp_path):
+    (tmp_path / 'case.in1c').write_text(in1)
+    (tmp_path / 'case.inm').write_text(inm)
+    w2auto.editInitInputs(str(tmp_path), 'case')
+    assert (tmp_path / 'case.in1c').read_text() == in1 and (tmp_path / 'case.inm').read_text() == inm
+    w2auto.editInitInputs(str(tmp_path), 'case', rkmax=6.5, lmax=12, emax=2.5, mix=0.1)
+    lines = (tmp_path / 'case.in1c').read_text().split('\n')
+    assert lines[1].split()[:3] == ['6.5', '12', '4'] and len(lines[1]) == len(in1.split('\n')[1])
+    assert lines[3] == 'K-VECTORS FROM UNIT:4   -9.0       2.5  100   emin / de (emax=Ef+de) / nband'
+    assert (tmp_path / 'case.inm').read_text().split('\n')[1].split()[0] == '0.1'
+    assert lines[0] == in1.split('\n')[0] and lines[2] == in1.split('\n')[2]
+
+def test_edit_init_inputs_needs_in1(tmp_path):
+    with pytest.raises(Exception, match='no case.in1c'): w2auto.editInitInputs(str(tmp_path), 'case', rkmax=7)
+
+def test_native_init_phases(tmp_path):
+    for st in w2auto.initInputs: (tmp_path / ('case.'+st)).write_text(st + '\n')
+    w2auto.nativeInitPhase(str(tmp_path), 'case', '10')
+    with pytest.raises(Exception, match='case.klist'): w2auto.nativeInitPhase(str(tmp_path), 'case', '15')
+    (tmp_path / 'case.klist').write_text('k\n')
+    w2auto.nativeInitPhase(str(tmp_path), 'case', '15')
+    for st, dst in w2auto.initInputs.items(): assert (tmp_path / ('case.'+dst)).read_text() == st + '\n'
+    with pytest.raises(Exception, match='case.clmsum'): w2auto.nativeInitPhase(str(tmp_path), 'case', '20')
+
+# SCF on the stubs of WIEN2k and w2web: the native structure and init steps give the same files as the CGI scripts
+def runSCF(root, init):
+    os.makedirs(root)
+    context = w2auto.prepareW2WebEmulation(root)
+    workDir = w2auto.SCF(os.path.join(os.path.dirname(root), 'Fe3O4.struct'), context, False, '', {'iterNum':5, 'ec':0.0001, 'monitor':False}, 0,
+                         rkmax=6.5, lstart_energy=-9.0, init=init, lmax=12, emax=2.5, mix=0.1)
+    return workDir, {f: open(os.path.join(workDir, f), 'rb').read() for f in w2auto.listStateFiles(workDir)}
+
+def test_native_init_matches_w2web(tmp_path, monkeypatch):
+    wienroot, xtls = bench.makeStubTree(str(tmp_path))
+    monkeypatch.setenv('WIENROOT', wienroot)
+    monkeypatch.setenv('PATH', wienroot + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('W2AUTO_STUB_LOG', str(tmp_path / 'stub.jsonl'))
+    (tmp_path / 'Fe3O4.struct').write_text(bench.structText([('FeT', 2), ('FeM', 4), ('O', 8)], 'F', 'Fe3O4'))
+    w2webDir, w2webFiles = runSCF(str(tmp_path / 'w2web'), 'w2web')
+    nativeDir, nativeFiles = runSCF(str(tmp_path / 'native'), 'native')
+    assert sorted(nativeFiles) == sorted(w2webFiles) and len(nativeFiles) > 20
+    assert [f for f in nativeFiles if nativeFiles[f] != w2webFiles[f]] == []
+    assert b'RMT=    1.8500' in nativeFiles['Fe3O4.struct'] and 'Fe3O4.struct_setrmt' not in nativeFiles
+    assert nativeFiles['Fe3O4.in1c'].split(b'\n')[1].split()[:2] == [b'6.5', b'12']
+    # no CGI script and no w2web session for the native SCF
+    with open(str(tmp_path / 'stub.jsonl')) as f: calls = [json.loads(line) for line in f]
+    nativeCalls = calls[[i for i, c in enumerate(calls) if c['program'] == 'run_lapw'][0]+1:]
+    assert 'initlapw.pl' in [c['program'] for c in calls] and 'setrmt_lapw' in [c['program'] for c in nativeCalls]
+    assert [c['program'] for c in nativeCalls if c['program'].endswith('.pl') or c['program'].endswith('.cgi')] == []
+    assert not os.path.exists(os.path.join(nativeDir, '.session'))
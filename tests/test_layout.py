@@ -0,0 +1,53 @@
+import collections
+import w2auto
+from conftest import exampleDir
+
+def write(path, text):
+    with open(str(path), 'w') as f: f.write(text)
+
+def coresUsed(layout):
+    jobs = collections.Counter(host for host, mpi in layout['jobs'])
+    return {host: n*layout['mpi']*layout['omp'] for host, n in jobs.items()}
+
+def test_many_kpoints_small_matrix():
+    layout = w2auto.planLayout(100, 1000, ['n1', 'n2'], 16)
+    assert (len(layout['jobs']), layout['mpi'], layout['omp']) == (32, 1, 1)
+    assert coresUsed(layout) == {'n1': 16, 'n2': 16}
+    assert 'lapw0' not in layout
+
+def test_few_kpoints_big_matrix():
+    layout = w2auto.planLayout(2, 8000, ['n1'], 16)
+    assert (len(layout['jobs']), layout['mpi'], layout['omp']) == (2, 4, 2)
+    assert coresUsed(layout) == {'n1': 16}
+    assert layout['lapw0'] == [('n1', 16)]
+    assert 'lapw0' not in w2auto.planLayout(2, 8000, ['n1'], 16, 'DOS')
+
+def test_idle_cores_get_threads():
+    layout = w2auto.planLayout(1, 100, ['n1'], 8)
+    assert (len(layout['jobs']), layout['mpi'], layout['omp'], layout['w2wThreads']) == (1, 1, 4, 8)
+
+def test_cores_are_never_oversubscribed():
+    for kpoints in [1, 3, 7, 50, 1000]:
+        for size in [100, 3000, 6000, 20000]:
+            for hosts in [['n1'], ['n1', 'n2', 'n3']]:
+                for cores in [1, 4, 12, 32]:
+                    layout = w2auto.planLayout(kpoints, size, hosts, cores)
+                    assert len(layout['jobs']) <= kpoints
+                    assert max(coresUsed(layout).values()) <= max(cores, layout['omp'])
+
+def test_write_machines(tmp_path):
+    w2auto.writeMachines(str(tmp_path), w2auto.planLayout(2, 8000, ['n1', 'n2'], 8))
+    lines = (tmp_path / '.machines').read_text().split('\n')
+    assert lines[1:] == ['granularity:1', '1:n1:4', '1:n2:4', 'lapw0:n1:8 n2:8', 'omp_global:2', 'extrafine:1', '']
+
+def test_kpoints_and_matrix_size(tmp_path):
+    write(tmp_path / 'case.klist', '         1         0         0         0        40  1.0 -7.0  1.5         0 k, div: ( 10 10 10)\n         2        4         0         0        40  6.0\nEND\n')
+    assert w2auto.countKpoints(str(tmp_path / 'case.klist')) == 2
+    assert w2auto.countKpoints(str(tmp_path / 'missing.klist')) == 0
+    # estimate from RKmax, RMT and the volume of the primitive cell
+    with open(exampleDir + '/Fe3O4/Fe3O4.struct') as f: write(tmp_path / 'case.struct', f.read())
+    write(tmp_path / 'case.in1c', 'WFFIL  EF=.5   (WFFIL, WFPRI, ENFIL, SUPWF)\n  7.00       10    4 (R-MT*K-MAX; MAX L IN WF, V-NMT\n')
+    estimate = w2auto.matrixSize(str(tmp_path), 'case')
+    assert 1000 < estimate < 3000
+    write(tmp_path / 'case.output1', '      MATRIX SIZE  1234LOs:  80  RKM= 7.00  WEIGHT= 1.00  PGR:\n')
+    assert w2auto.matrixSize(str(tmp_path), 'case') == 1234
@@ -0,0 +1,49 @@
+import os, time
+import pytest
+import w2auto
+
+def capture(chunks, headSize, tailSize, keepSpill):
+    c = w2auto.OutputCapture(headSize, tailSize)
+    for chunk in chunks: c.write(chunk)
+    c.close(keepSpill)
+    return c
+
+def test_short_output_is_kept():
+    c = capture([b'line 1\n', b'line 2\n'], 100, 100, False)
+    assert c.text() == 'line 1\nline 2\n' and c.spill is None
+
+def test_head_and_tail():
+    data = b''.join(b'%05d\n' % i for i in range(1000))
+    c = capture([data[i:i+77] for i in range(0, len(data), 77)], 60, 120, False)
+    text = c.text()
+    assert text.startswith(data[:60].decode()) and text.endswith(data[-120:].decode())
+    assert '{0} bytes skipped ...'.format(len(data)-180) in text
+    # removed spill file isn't mentioned
+    assert not os.path.exists(c.spill.name) and c.spill.name not in text
+
+def test_spill_file_of_failed_command():
+    data = os.urandom(5000)
+    c = capture([data[i:i+100] for i in range(0, len(data), 100)], 100, 100, True)
+    assert c.spill.name in c.text()
+    with open(c.spill.name, 'rb') as f: assert f.read() == data
+    os.remove(c.spill.name)
+
+def test_matchers(tmp_path):
+    lines = []
+    matchers = [w2auto.OutputMatcher(r'^:ITE', callback=lines.append), w2auto.OutputMatcher('error', fatal=True)]
+    c = w2auto.OutputCapture()
+    start = time.time()
+    # the command is stopped on the fatal line, not after the sleep
+    code, fatalLine, rusage, maxRss = w2auto.streamCommand('echo :ITE001; echo :ITE002; echo "ERROR in lapw1"; sleep 30; echo :ITE003', str(tmp_path), None, c, matchers)
+    assert time.time() - start < 20
+    assert fatalLine == 'ERROR in lapw1'
+    assert lines == [':ITE001', ':ITE002']
+
+def test_last_line_without_newline(tmp_path):
+    matcher = w2auto.OutputMatcher('stop', fatal=True)
+    code, fatalLine, rusage, maxRss = w2auto.streamCommand('printf "a\\nstop here"', str(tmp_path), None, w2auto.OutputCapture(), [matcher])
+    assert fatalLine == 'stop here'
+
+def test_run_command_stopped_by_matcher(tmp_path):
+    with pytest.raises(Exception, match='was stopped on line "fatal"'):
+        w2auto.runCommand('echo fatal; sleep 30', str(tmp_path), tryFast=False, matchers=[w2auto.OutputMatcher('fatal', fatal=True)])
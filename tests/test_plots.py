@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import w2auto
+
+def test_split_bands():
+    data = np.array([[0.0, -1.0], [0.5, -0.8], [1.0, -0.5], [0.0, 1.0], [0.5, 1.2], [0.0, 2.0]])
+    bands = w2auto.splitBands(data)
+    assert [len(k) for k, e in bands] == [3, 2, 1]
+    assert np.allclose(bands[1][1], [1.0, 1.2])
+    x, y = w2auto.bandsCurve(bands)
+    assert len(x) == 9 and np.isnan(x[3]) and np.isnan(y[-1])
+
+# spaghetti_ene of spagh: bandindex lines between the bands
+def test_read_spaghetti(tmp_path):
+    lines = []
+    for band, energy in ((1, -3.0), (2, 0.5)):
+        lines.append('  bandindex:  {0}'.format(band))
+        lines += ['  0.0000 0.0000 0.0000 {0:9.5f} {1:10.5f}'.format(0.1*k, energy + 0.01*k) for k in range(4)]
+        lines.append('')
+    (tmp_path / 'case.spaghetti_ene').write_text('\n'.join(lines))
+    bands = w2auto.readSpaghetti(str(tmp_path / 'case.spaghetti_ene'))
+    assert len(bands) == 2
+    assert np.allclose(bands[0][0], [0.0, 0.1, 0.2, 0.3]) and np.allclose(bands[1][1], [0.5, 0.51, 0.52, 0.53])
+
+def test_insp_energy_range(tmp_path):
+    assert w2auto.inspEnergyRange(str(tmp_path / 'case.insp')) is None
+    (tmp_path / 'case.insp').write_text('### Figure configuration\n -14.0 3.0  2   # energy range, energy switch (1:Ry, 2:eV)\n')
+    assert w2auto.inspEnergyRange(str(tmp_path / 'case.insp')) == [-14.0, 3.0]
+    (tmp_path / 'case.insp').write_text(' -1.0 0.5  1   # energy range, energy switch (1:Ry, 2:eV)\n')
+    assert np.allclose(w2auto.inspEnergyRange(str(tmp_path / 'case.insp')), [-w2auto.rydbergToEv, 0.5*w2auto.rydbergToEv])
+    (tmp_path / 'case.insp').write_text('no range\n')
+    assert w2auto.inspEnergyRange(str(tmp_path / 'case.insp')) is None
+
+def test_stage_figures_of_skipped_stage():
+    assert w2auto.stageFigures('BAND', {'BAND':{'run':False}}, '/nonexistent') == []
+
+def test_render_figures(tmp_path):
+    pytest.importorskip('matplotlib')
+    import matplotlib
+    backend = matplotlib.get_backend()
+    x = np.linspace(-5, 5, 50)
+    figures = [{'output':str(tmp_path / '{0}.png'.format(i)), 'title':'test', 'xlim':[-5, 5], 'hlines':[0], 'vlines':[0],
+                'curves':[(x, np.sin(x+i), {'label':'sin'}), (x, np.cos(x), {})]} for i in range(2)]
+    assert w2auto.renderFigures(figures) == [f['output'] for f in figures]
+    for f in figures:
+        with open(f['output'], 'rb') as png: assert png.read(8) == b'\x89PNG\r\n\x1a\n'
+    # figures are drawn without pyplot
+    assert matplotlib.get_backend() == backend
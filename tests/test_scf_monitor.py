@@ -0,0 +1,127 @@
+import os
+import pytest
+import w2auto
+
+def write(path, text, mode='w', mtime=None):
+    with open(str(path), mode) as f: f.write(text)
+    if mtime is not None: os.utime(str(path), ns=(mtime, mtime))
+
+def iteration(n, dis):
+    return ':ITE{0:03}:  {0}. ITERATION\n:ENE  : ********** TOTAL ENERGY IN Ry = -1234.{0:05}\n:DIS  :  CHARGE DISTANCE       ( 0.0001000 for atom    1 spin 1)    {1:.7f}\n'.format(n, dis)
+
+# one iteration of run_lapw: the mixer writes case.clmsum, then the :DIS line gets to case.scf
+def runIteration(work, n, dis, t):
+    write(work / 'case.clmsum', 'density {0}\n'.format(n) * 100, mtime=t)
+    write(work / 'case.scf', iteration(n, dis), 'a', mtime=t+1000)
+
+@pytest.fixture
+def work(tmp_path):
+    write(tmp_path / 'case.inm', 'MSR1  0.0  YES  (BROYD/PRATT, extra charge (+1 for additional e), norm)\n0.20    mixing FACTOR for BROYD/PRATT scheme\n')
+    write(tmp_path / 'case.broyd1', 'history')
+    return tmp_path
+
+def monitor(work, **kwargs):
+    return w2auto.SCFMonitor(str(work), 'case', pollInterval=0.01, **kwargs)
+
+def test_checkpoint_of_best_iteration(work):
+    m = monitor(work)
+    for n, dis in enumerate([0.1, 0.01, 0.05], 1):
+        runIteration(work, n, dis, n*10**9)
+        m.poll()
+    assert m.best['iteration'] == 2 and m.checkpoint['iteration']['iteration'] == 2
+    assert (work / 'case.clmsum_best').read_text() == 'density 2\n' * 100
+    m.restartFromBest()
+    assert (work / 'case.clmsum').read_text() == 'density 2\n' * 100
+    assert (work / 'case.inm').read_text().split('\n')[1].startswith('0.100 ')
+    assert not (work / 'case.broyd1').exists()
+
+def test_no_checkpoint_after_next_mixer(work):
+    m = monitor(work)
+    runIteration(work, 1, 0.1, 10**9)
+    # the poll comes late: the mixer of iteration 2 has already written case.clmsum
+    write(work / 'case.clmsum', 'density 2\n', mtime=3*10**9)
+    m.poll()
+    assert m.checkpoint is None and not (work / 'case.clmsum_best').exists()
+    with pytest.raises(Exception, match='no valid checkpoint'):
+        m.restartFromBest()
+    # the finished iteration 2 is worse: the density of iteration 1 can't be saved any more
+    write(work / 'case.scf', iteration(2, 0.2), 'a', mtime=4*10**9)
+    m.poll()
+    assert m.pending is None and m.checkpoint is None
+
+def test_damaged_checkpoint_is_not_used(work):
+    m = monitor(work)
+    runIteration(work, 1, 0.1, 10**9)
+    m.poll()
+    assert m.validCheckpoint()
+    write(work / 'case.clmsum_best', 'density 7\n' * 100)
+    assert not m.validCheckpoint()
+
+def test_diverging_run_is_stopped(work):
+    m = monitor(work, minIterations=3, divergeIterations=3)
+    for n, dis in enumerate([0.01, 0.02, 0.2, 0.5, 0.9], 1):
+        runIteration(work, n, dis, n*10**9)
+    m.poll()
+    assert m.problem == 'diverging' and (work / '.stop').exists()
+
+def test_oscillating_run_is_stopped(work):
+    m = monitor(work, minIterations=3, oscillationWindow=6, oscillationChanges=4)
+    for n, dis in enumerate([0.01, 0.05, 0.03, 0.06, 0.03, 0.06, 0.03, 0.06], 1):
+        runIteration(work, n, dis, n*10**9)
+    m.poll()
+    assert m.problem == 'oscillating'
+
+def test_converging_run_goes_on(work):
+    m = monitor(work)
+    for n in range(1, 20): runIteration(work, n, 0.1/n, n*10**9)
+    m.poll()
+    assert m.problem is None and not (work / '.stop').exists()
+    assert m.checkpoint['iteration']['iteration'] == 19
+
+# run_lapw of the test: diverges with the mixing factor of case.inm above 0.15, converges in 3 iterations below it
+fakeRunLapw = '''#!/usr/bin/env python3
+import sys, os, time
+iterations = int(sys.argv[sys.argv.index('-i')+1])
+with open(os.environ['RUNS_FILE'], 'a') as f: f.write('run\\n')
+with open('case.inm') as f: factor = float(f.read().split('\\n')[1].split()[0])
+start = open('case.scf').read().count(':ITE') if os.path.exists('case.scf') else 0
+diverging = [0.05, 0.01, 0.02, 0.1, 0.5, 0.9, 2.0, 4.0]
+for k in range(iterations):
+    if os.path.exists('.stop'): break
+    n = start + k + 1
+    with open('case.clmsum', 'w') as f: f.write('density {0}\\n'.format(n))
+    dis = diverging[min(k, len(diverging)-1)] if factor > 0.15 else 0.001/(k+1)
+    with open('case.scf', 'a') as f: f.write(':ITE{0:03}:  {0}. ITERATION\\n:ENE  : ********** TOTAL ENERGY IN Ry = -1234.{0:05}\\n:DIS  :  CHARGE DISTANCE       ( 0.0001000 for atom    1 spin 1)    {1:.7f}\\n'.format(n, dis))
+    time.sleep(0.1)
+    if factor <= 0.15 and k == 2: break
+print('run_lapw done')
+'''
+
+def resetWork(work):
+    for f in os.listdir(str(work)):
+        if f[0] != '.': os.remove(str(work / f))
+    write(work / 'case.inm', 'MSR1  0.0  YES  (BROYD/PRATT, extra charge (+1 for additional e), norm)\n0.20    mixing FACTOR for BROYD/PRATT scheme\n')
+
+def test_restart_is_replayed_from_cache(tmp_path, monkeypatch):
+    bin = tmp_path / 'bin'
+    bin.mkdir()
+    write(bin / 'run_lapw', fakeRunLapw)
+    os.chmod(str(bin / 'run_lapw'), 0o755)
+    monkeypatch.setenv('PATH', str(bin) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setenv('RUNS_FILE', str(tmp_path / 'runs'))
+    work = tmp_path / 'work'
+    work.mkdir()
+    resetWork(work)
+    lapwParams = {'iterNum':40, 'ec':0.0001, 'monitor':{'pollInterval':0.01, 'minIterations':3, 'divergeIterations':3}}
+    output, cmd = w2auto.runLapwCycles(str(work), 'case', lapwParams, '', '')
+    assert cmd == 'run_lapw -i 35 -ec 0.0001'
+    assert (tmp_path / 'runs').read_text().count('run') == 2
+    scf = (work / 'case.scf').read_text()
+    assert scf.count(':ITE') == 8 and (work / 'case.inm').read_text().split('\n')[1].startswith('0.100 ')
+    # the warm rerun restores both run_lapw from the cache and restarts the same way
+    resetWork(work)
+    output, cmd = w2auto.runLapwCycles(str(work), 'case', lapwParams, '', '')
+    assert cmd == 'run_lapw -i 35 -ec 0.0001' and 'run_lapw done' in output
+    assert (tmp_path / 'runs').read_text().count('run') == 2
+    assert (work / 'case.scf').read_text() == scf
+    assert (work / 'case.clmsum').read_text() == 'density 8\n'
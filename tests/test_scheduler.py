@@ -0,0 +1,54 @@
+import os
+import w2auto
+
+def test_run_cluster_options():
+    assert w2auto.runClusterOptions('run-cluster-and-wait -m 3000 -n 6 ') == ['--mem=3000', '--ntasks=6']
+    assert w2auto.runClusterOptions('/opt/bin/run-cluster -p short --time=10 -c 4') == ['--partition=short', '--time=10', '--cpus-per-task=4']
+    assert w2auto.runClusterOptions('') == []
+
+def test_unknown_options_are_ignored(capsys):
+    assert w2auto.runClusterOptions('run-cluster -z 1 -n 2') == ['--ntasks=2']
+    assert '-z 1' in capsys.readouterr().out
+
+def test_local_scheduler(tmp_path):
+    manager = w2auto.makeJobManager({'type': 'local', 'maxJobs': 2, 'pollInterval': 0.01})
+    job = manager.run('echo hello; exit 3', str(tmp_path))
+    assert (job.state, job.returncode) == ('FAILED', 3)
+    assert job.output().strip() == 'hello'
+    job = manager.run('pwd', str(tmp_path), env=dict(os.environ))
+    assert (job.state, job.returncode, job.output().strip()) == ('COMPLETED', 0, str(tmp_path))
+
+def script(path, text):
+    with open(str(path), 'w') as f: f.write('#!/bin/sh\n' + text)
+    os.chmod(str(path), 0o755)
+    return str(path)
+
+# sbatch runs the job at once; the job is never in the queue
+def fakeSlurm(tmp_path, sacct):
+    bin = tmp_path / 'bin'
+    bin.mkdir()
+    sbatch = script(bin / 'sbatch', 'for a in "$@"; do case $a in --chdir=*) dir=${a#--chdir=};; esac; done\n'
+                                    'echo "$@" > "$dir/sbatch-args"\ncat > "$dir/job.sh"\n'
+                                    'cd "$dir" && SLURM_JOB_ID=42 sh job.sh > slurm-42.out 2>&1\necho "42;cluster"\n')
+    return w2auto.SlurmScheduler(['--account=a'], sbatch=sbatch, squeue=script(bin / 'squeue', ''), sacct=script(bin / 'sacct', sacct), unknownPolls=3)
+
+def test_slurm_exit_code(tmp_path):
+    manager = w2auto.JobManager(fakeSlurm(tmp_path, 'exit 1\n'), pollInterval=0.01)
+    job = manager.run('echo output; exit 3', str(tmp_path), options=['--mem=3000'])
+    assert (job.jobId, job.state, job.returncode) == ('42', 'FAILED', 3)
+    assert job.output().strip() == 'output'
+    assert not os.path.exists(job.exitFile)
+    args = (tmp_path / 'sbatch-args').read_text().split()
+    assert args[-2:] == ['--account=a', '--mem=3000']
+
+def test_slurm_accounting(tmp_path):
+    manager = w2auto.JobManager(fakeSlurm(tmp_path, 'echo "TIMEOUT|0:15"\n'), pollInterval=0.01)
+    # killed: the trap doesn't write the exit code
+    job = manager.run('kill -9 $$', str(tmp_path))
+    # ExitCode is <exit code>:<signal>, a job which didn't complete never has code 0
+    assert (job.state, job.returncode) == ('TIMEOUT', 1)
+
+def test_slurm_unknown_state(tmp_path):
+    manager = w2auto.JobManager(fakeSlurm(tmp_path, 'exit 1\n'), pollInterval=0.01)
+    job = manager.run('kill -9 $$', str(tmp_path))
+    assert (job.state, job.returncode, job.unknownPolls) == ('UNKNOWN', None, 3)
@@ -0,0 +1,100 @@
+import os, stat
+import w2auto
+
+def write(path, data):
+    with open(str(path), 'wb') as f: f.write(data)
+
+def read(path):
+    with open(str(path), 'rb') as f: return f.read()
+
+def makeTree(work):
+    (work / 'sub').mkdir(parents=True)
+    write(work / 'case.struct', b'struct')
+    write(work / 'sub' / 'case.in1', b'in1')
+    write(work / 'run.sh', b'#!/bin/sh\n')
+    os.chmod(str(work / 'run.sh'), 0o755)
+
+def test_manifest_save_restore(tmp_path):
+    work = tmp_path / 'work'
+    makeTree(work)
+    backend = w2auto.snapshotBackends['manifest']
+    state = backend.save(str(work))
+    write(work / 'case.struct', b'changed')
+    os.remove(str(work / 'sub' / 'case.in1'))
+    os.remove(str(work / 'run.sh'))
+    backend.restore(str(work), state)
+    assert read(work / 'case.struct') == b'struct'
+    assert read(work / 'sub' / 'case.in1') == b'in1'
+    assert os.stat(str(work / 'run.sh')).st_mode & stat.S_IXUSR
+    assert len([p for p in work.rglob('*.restore')]) == 0
+
+def test_restore_removes_files_the_command_removed(tmp_path):
+    work = tmp_path / 'work'
+    makeTree(work)
+    backend = w2auto.snapshotBackends['manifest']
+    # structend.pl: case.struct_setrmt is made and removed again
+    write(work / 'case.struct_setrmt', b'rmt')
+    backend.save(str(work))
+    os.remove(str(work / 'case.struct_setrmt'))
+    state = backend.save(str(work))
+    write(work / 'case.struct_setrmt', b'rmt')
+    (work / '.cache').mkdir()
+    backend.restore(str(work), state)
+    assert not (work / 'case.struct_setrmt').exists()
+    assert read(work / 'case.struct') == b'struct'
+    # not part of the state
+    assert (work / '.cache').exists()
+
+def test_objects_are_not_linked_to_working_files(tmp_path):
+    work = tmp_path / 'work'
+    makeTree(work)
+    backend = w2auto.snapshotBackends['manifest']
+    state = backend.save(str(work))
+    # WIEN2k programs rewrite files in place
+    with open(str(work / 'case.struct'), 'r+b') as f: f.write(b'STRUCT')
+    backend.restore(str(work), state)
+    assert read(work / 'case.struct') == b'struct'
+
+def test_input_state_has_no_objects(tmp_path):
+    work = tmp_path / 'work'
+    makeTree(work)
+    backend = w2auto.snapshotBackends['manifest']
+    first = backend.save(str(work), storeObjects=False)
+    assert not (work / '.snapshots' / 'objects').exists()
+    # the same files give the same manifest
+    assert backend.save(str(work)) == first
+    assert (work / '.snapshots' / 'objects').exists()
+
+def smallChunkStore(root):
+    return w2auto.ChunkStore(str(root), minSize=1<<10, avgBits=12, maxSize=1<<14)
+
+def test_chunk_store_round_trip(tmp_path):
+    store = smallChunkStore(tmp_path / 'chunks')
+    data = os.urandom(200000)
+    write(tmp_path / 'big', data)
+    recipe = store.put(str(tmp_path / 'big'))
+    assert len(recipe) > 5
+    store.get(recipe, str(tmp_path / 'copy'))
+    assert read(tmp_path / 'copy') == data
+
+def test_insertion_changes_chunks_locally(tmp_path):
+    store = smallChunkStore(tmp_path / 'chunks')
+    data = os.urandom(200000)
+    write(tmp_path / 'a', data)
+    write(tmp_path / 'b', data[:100000] + b'inserted' + data[100000:])
+    a = store.put(str(tmp_path / 'a'))
+    b = store.put(str(tmp_path / 'b'))
+    assert len(set(a) & set(b)) >= len(a) - 3
+
+def test_big_files_go_to_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto, 'chunkThresholdGlobal', 1<<12)
+    work = tmp_path / 'work'
+    makeTree(work)
+    data = os.urandom(50000)
+    write(work / 'case.vector', data)
+    store = w2auto.SnapshotStore(str(tmp_path / 'snapshots'), smallChunkStore(tmp_path / 'chunks'))
+    state = store.save(str(work))
+    assert len(list((tmp_path / 'snapshots').rglob('*.chunks'))) == 1
+    write(work / 'case.vector', b'')
+    store.restore(str(work), state)
+    assert read(work / 'case.vector') == data
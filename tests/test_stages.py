@@ -0,0 +1,95 @@
+import os, threading
+import pytest
+import w2auto
+
+def test_dependencies_get_results():
+    stages = {'SCF': ([], lambda r: 'scf'),
+              'DOS': (['SCF'], lambda r: r['SCF'] + '/dos'),
+              'BAND': (['SCF'], lambda r: r['SCF'] + '/band'),
+              'Wannier': (['BAND'], lambda r: r['BAND'] + '/wannier')}
+    assert w2auto.runStageGraph(stages) == {'SCF': 'scf', 'DOS': 'scf/dos', 'BAND': 'scf/band', 'Wannier': 'scf/band/wannier'}
+
+def test_independent_stages_overlap():
+    barrier = threading.Barrier(2, timeout=10)
+    stages = {'SCF': ([], lambda r: 'scf'),
+              'DOS': (['SCF'], lambda r: barrier.wait()),
+              'BAND': (['SCF'], lambda r: barrier.wait())}
+    assert sorted(w2auto.runStageGraph(stages, maxWorkers=2).keys()) == ['BAND', 'DOS', 'SCF']
+
+def fail(results):
+    raise ValueError('stage failed')
+
+def test_error_stops_the_graph():
+    started = []
+    stages = {'SCF': ([], fail),
+              'DOS': (['SCF'], lambda r: started.append('DOS'))}
+    with pytest.raises(ValueError):
+        w2auto.runStageGraph(stages)
+    assert started == []
+
+def test_errors_without_stopping():
+    errors = {}
+    stages = {'SCF': ([], lambda r: 'scf'),
+              'DOS': (['SCF'], fail),
+              'BAND': (['SCF'], lambda r: 'band'),
+              'PLOTS': (['DOS', 'BAND'], lambda r: 'plots'),
+              'Last': (['PLOTS'], lambda r: 'last')}
+    results = w2auto.runStageGraph(stages, stopOnError=False, errors=errors)
+    assert sorted(results.keys()) == ['BAND', 'SCF']
+    assert 'stage failed' in errors['DOS']
+    assert errors['PLOTS'] == errors['Last'] == 'skipped: dependency failed'
+
+def test_unknown_dependency():
+    with pytest.raises(Exception, match='unresolved dependencies'):
+        w2auto.runStageGraph({'DOS': (['SCF'], lambda r: 'dos')})
+
+def baseParams(structFile):
+    return {'SCF': {'run': True, 'struct_file': structFile, 'runParallel': False, 'RKmax': 7, 'efmod': 'TETRA'},
+            'DOS': {'run': True, 'xmin': -10, 'workers': 4},
+            'BAND': {'run': True, 'klist_band': 'case.klist_band'},
+            'Wannier': {'run': True, 'wannierName': 'wannier'},
+            'XTLS': {'run': True, 'hopMatBorder': 3, 'folderName': 'XTLS1'},
+            'common': {'kpoints': 0, 'dosInfo': {'energyInterval': [-8, 2], 'atomOrbitals': {'Fe': ['d']}}}}
+
+def keys(params):
+    scf = w2auto.stageKey(params, 'SCF', '')
+    band = w2auto.stageKey(params, 'BAND', scf)
+    wannier = w2auto.stageKey(params, 'Wannier', band)
+    return {'SCF': scf, 'DOS': w2auto.stageKey(params, 'DOS', scf), 'BAND': band, 'Wannier': wannier,
+            'XTLS': w2auto.stageKey(params, 'XTLS', wannier), 'PLOTS': w2auto.stageKey(params, 'PLOTS', scf)}
+
+def changed(params, path, value):
+    params = w2auto.copy.deepcopy(params)
+    w2auto.setParam(params, path, value)
+    a, b = keys(params), keys(baseParams(params['SCF']['struct_file']))
+    return sorted(stage for stage in a if a[stage] != b[stage])
+
+def test_stage_keys(tmp_path):
+    struct = tmp_path / 'case.struct'
+    struct.write_text('struct')
+    params = baseParams(str(struct))
+    assert changed(params, 'XTLS.hopMatBorder', 4) == ['XTLS']
+    assert changed(params, 'DOS.xmin', -8) == ['DOS']
+    assert changed(params, 'SCF.RKmax', 6.5) == ['BAND', 'DOS', 'PLOTS', 'SCF', 'Wannier', 'XTLS']
+    assert changed(params, 'common.dosInfo.energyInterval', [-7, 3]) == ['DOS', 'Wannier', 'XTLS']
+    # the way a stage is run doesn't change its results
+    assert changed(params, 'DOS.workers', 8) == []
+    assert changed(params, 'XTLS.folderName', 'XTLS2') == []
+    assert changed(params, 'common.plotWorkers', 4) == []
+    # w2web plots are made by DOS, Bandstructure and Wannier themselves
+    assert changed(params, 'common.plotBackend', 'native') == ['BAND', 'DOS', 'PLOTS', 'Wannier', 'XTLS']
+    before = keys(params)['SCF']
+    struct.write_text('other struct')
+    assert keys(params)['SCF'] != before
+
+def test_campaign_jobs():
+    campaign = {'params': baseParams('a.struct'),
+                'structures': ['a.struct', {'struct_file': 'b.struct', 'BAND.klist_band': 'b.klist_band'}],
+                'variants': {'SCF.RKmax': [6.5, 7], 'XTLS.hopMatBorder': [3, 4, 5]}}
+    jobs = w2auto.campaignJobs(campaign)
+    assert len(jobs) == 12
+    assert len(set((j['structure'], j['variant']['SCF.RKmax'], j['variant']['XTLS.hopMatBorder']) for j in jobs)) == 12
+    b = [j for j in jobs if j['structure'] == 'b.struct']
+    assert all(j['params']['BAND']['klist_band'] == 'b.klist_band' and j['params']['SCF']['struct_file'] == os.path.abspath('b.struct') for j in b)
+    # the base params are not changed
+    assert campaign['params']['SCF']['RKmax'] == 7 and campaign['params']['SCF']['struct_file'] == 'a.struct'
@@ -0,0 +1,48 @@
+import os
+import pytest
+import w2auto
+from conftest import exampleDir
+
+def example(name):
+    return os.path.join(exampleDir, name, name+'.struct')
+
+def test_parse_fe3o4():
+    s = w2auto.readStructure(example('Fe3O4'))
+    assert (s.title, s.lattice, s.spaceGroup, s.mode, s.unit) == ('blebleble', 'F', '227_Fd-3m', 'RELA', 'bohr')
+    assert s.cell == pytest.approx((15.86803, 15.86803, 15.86803, 90, 90, 90))
+    assert [a.mult for a in s.atoms] == [2, 4, 8]
+    assert s.atoms[2].positions[1] == pytest.approx((0.7449, 0.7449, 0.7449))
+    assert (s.atoms[2].rmt, s.atoms[2].Z) == (1.64, 8.0)
+
+# the same structInfo as XTLSparams['structInfo'] of Examples/Fe3O4/Fe3O4.py
+def test_struct_info_fe3o4():
+    info = w2auto.parseStructFile(example('Fe3O4'))
+    assert info['atomNamesList'] == ['FeT', 'FeM', 'O']
+    assert info['atomCounts'] == {'FeM': 4, 'FeT': 2, 'O': 8}
+    assert info['kpoints'] == 423
+
+def test_parse_fesio4():
+    s = w2auto.readStructure(example('FeSiO4'))
+    assert (s.lattice, s.mode, s.unit) == ('P', 'RELA', '')
+    assert len(s.atoms) == 21
+    names = s.atomNames()
+    assert names[0] == 'Fe' and names[1] == 'Si_ATOM_2' and names[2] == 'O_ATOM_3'
+    # atoms of atomOrbitals in Examples/FeSiO4/FeSiO4.py
+    assert set(['O_ATOM_3', 'O_ATOM_21', 'Fe']) <= set(names)
+    assert all(a.mult == 1 for a in s.atoms)
+
+def test_struct_info_needs_bohr():
+    with pytest.raises(Exception, match='unit=bohr'):
+        w2auto.parseStructFile(example('FeSiO4'))
+
+def test_read_structure_is_memoized(tmp_path):
+    with open(example('Fe3O4')) as f: content = f.read()
+    copy = tmp_path / 'copy.struct'
+    copy.write_text(content)
+    assert w2auto.readStructure(str(copy)) is w2auto.readStructure(example('Fe3O4'))
+    assert w2auto.parseStructFile(str(copy)) is not w2auto.parseStructFile(str(copy))
+
+def test_truncated_struct():
+    with open(example('Fe3O4')) as f: lines = f.read().split('\n')
+    with pytest.raises(Exception, match='atom 3'):
+        w2auto.Structure.parse('\n'.join(lines[:18]))
@@ -0,0 +1,38 @@
+import json, os, sys
+import pytest
+import w2auto
+
+def test_command_names():
+    assert w2auto.commandName("echo ''|x lapw1 -p") == 'x lapw1'
+    assert w2auto.commandName('run_lapw -ec 0.0001 -i 40') == 'run_lapw'
+    assert w2auto.commandName('OMP_NUM_THREADS=4 /opt/wien2k/lapw2 case') == 'lapw2'
+
+def test_trace_of_commands(tmp_path, monkeypatch):
+    tracer = w2auto.Tracer(str(tmp_path / 'trace.json'))
+    monkeypatch.setattr(w2auto, 'tracerGlobal', tracer)
+    work = tmp_path / 'work'
+    work.mkdir()
+    with w2auto.traceSpan('SCF', 'stage'):
+        for i in range(2): w2auto.runCommand('echo hello > out.txt; rm out.txt; echo done', str(work))
+    tracer.close()
+    with open(str(tmp_path / 'trace.json')) as f: events = json.load(f)['traceEvents']
+    commands = [e for e in events if e['cat'] == 'command']
+    assert [e['args']['cache'] for e in commands] == ['miss', 'local']
+    assert commands[0]['args']['outputBytes'] == 5
+    stage = [e for e in events if e['cat'] == 'stage'][0]
+    assert stage['name'] == 'SCF' and stage['dur'] >= sum(e['dur'] for e in commands)
+    assert commands[0]['args']['snapshotTime'] > 0
+    summary = (tmp_path / 'trace_summary.txt').read_text()
+    assert 'rss, MB' in summary and 'echo' in summary
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='peak memory is read from /proc')
+def test_peak_memory_of_command_tree(tmp_path, monkeypatch):
+    monkeypatch.setattr(w2auto, 'rssPollInterval', 0.05)
+    # the memory of the command is in a child of the shell
+    cmd = '{0} -c "import time; x = bytearray(100<<20); time.sleep(1)"; echo done'.format(sys.executable)
+    code, fatalLine, rusage, maxRss = w2auto.streamCommand(cmd, str(tmp_path), None, w2auto.OutputCapture())
+    assert code == 0
+    assert 100 < maxRss/1024 < 200
+    # too short to be seen, w2auto's own memory is never counted
+    code, fatalLine, rusage, maxRss = w2auto.streamCommand('true', str(tmp_path), None, w2auto.OutputCapture())
+    assert maxRss is None or maxRss/1024 < 20
@@ -0,0 +1,65 @@
+import numpy as np
+import w2auto
+
+def randomHopMat(n, seed=0):
+    rng = np.random.RandomState(seed)
+    A = rng.normal(size=(n, n))
+    return (A + A.T)/2
+
+def test_givens_rotate_is_dense_product():
+    n = 12
+    A = randomHopMat(n)
+    x = np.random.RandomState(1).uniform(-np.pi, np.pi, len(w2auto.givensPlanes(n)))
+    D = A.copy()
+    for (i, j), c, s in zip(w2auto.givensPlanes(n), np.cos(x), np.sin(x)): w2auto.givensRotate(D, i, j, c, s)
+    V = w2auto.constructV(x, n)
+    assert np.allclose(D, V.T.dot(A).dot(V))
+
+def test_gradient_is_finite_differences():
+    for n, seed in [(10, 0), (13, 1), (16, 2)]:
+        A = randomHopMat(n, seed)
+        x = np.random.RandomState(seed+10).uniform(-np.pi, np.pi, len(w2auto.givensPlanes(n)))
+        f, grad = w2auto.targetF(x, A)
+        h = 1e-6
+        numeric = np.zeros(len(x))
+        for k in range(len(x)):
+            dx = np.zeros(len(x))
+            dx[k] = h
+            numeric[k] = (w2auto.targetF(x+dx, A)[0] - w2auto.targetF(x-dx, A)[0])/(2*h)
+        assert np.allclose(grad, numeric, rtol=1e-5, atol=1e-6*max(1, f))
+
+def test_minimize_lowers_target():
+    A = randomHopMat(12)
+    K = len(w2auto.givensPlanes(12))
+    f0 = w2auto.targetF(np.zeros(K), A)[0]
+    f, x = w2auto.minimizeTriDiag(A, np.zeros(K))
+    assert f < f0
+    assert np.isclose(w2auto.targetF(x, A)[0], f)
+
+def test_start_points():
+    A = randomHopMat(12)
+    K = len(w2auto.givensPlanes(12))
+    solver = w2auto.TriDiagSolver()
+    points = solver.startPoints('0'*64, A)
+    assert len(points) == 1 and not np.any(points[0])
+    # one start: the remembered solution instead of zero angles
+    remembered = np.full(K, 0.3)
+    solver.solutions['1'*64] = (randomHopMat(12, 5), remembered, 0.0)
+    solver.solutions['2'*64] = (randomHopMat(10, 5), np.full(len(w2auto.givensPlanes(10)), 0.1), 0.0)
+    points = solver.startPoints('0'*64, A)
+    assert len(points) == 1 and np.array_equal(points[0], remembered)
+    # more starts: zero angles, the remembered solution and random angles
+    solver.starts = 4
+    points = solver.startPoints('0'*64, A)
+    assert len(points) == 4 and not np.any(points[0]) and np.array_equal(points[1], remembered)
+
+def test_solutions_are_memoized(tmp_path):
+    A = randomHopMat(12)
+    solver = w2auto.TriDiagSolver(str(tmp_path))
+    x = solver.solve(A, A)
+    assert len(list(tmp_path.glob('*.npz'))) == 1
+    assert w2auto.targetF(x, A)[0] <= w2auto.minimizeTriDiag(A, np.zeros(len(x)))[0] + 1e-12
+    # a new run finds it on disk, without minimizing
+    again = w2auto.TriDiagSolver(str(tmp_path))
+    again.startPoints = None
+    assert np.array_equal(again.solve(A, A), x)
@@ -0,0 +1,16 @@
+import numpy as np
+import w2auto
+
+def test_small_hopping_matrix_is_skipped(tmp_path):
+    np.savetxt(str(tmp_path / 'HopMat.dat'), np.eye(6))
+    (tmp_path / 'info.txt').write_text('')
+    result = w2auto.XTLSRow(3, 'Fe1 d', str(tmp_path), None, '/nonexistent', '/nonexistent')
+    assert result['row'] == 3 and result['orbital'] == 'Fe1 d'
+    assert result['status'] == 'skipped' and result['error'] == ''
+    assert 'Size of HopMat < 10' in (tmp_path / 'info.txt').read_text()
+
+# a failed row is reported in its result, the other rows go on
+def test_failed_row_is_reported(tmp_path, capsys):
+    result = w2auto.XTLSRow(1, 'O1 p', str(tmp_path), None, '/nonexistent', '/nonexistent')
+    assert result['status'] == 'failed' and 'HopMat.dat' in result['error']
+    assert 'XTLS row 1 (O1 p) failed' in capsys.readouterr().out
@@ -1,5 +1,5 @@
 #!/opt/anaconda/bin/python -u
-import sys, os, subprocess, shutil, tempfile, socket, copy, re, urllib, glob, random, string, json
+import sys, os, subprocess, shutil, tempfile, socket, copy, re, urllib, glob, random, string, json, hashlib, time, stat, threading, zlib, fcntl, fnmatch, concurrent.futures, multiprocessing, asyncio, signal, collections, contextlib, resource, shlex
 import numpy as np
 import pandas as pd
 import scipy, scipy.optimize
@@ -30,132 +30,1133 @@ def notEmpty(filename):
     if os.path.exists(filename): return os.path.getsize(filename)>0
     else: return False
 
-class Cache:
+# ===================================================================================================================
+# Tracing: runCommand, runW2webCommand, snapshots, copying and stages record spans (wall time, child CPU time, peak RSS,
+# output size, cache hits). Spans are appended to a JSONL file as they end, so forked workers can write too;
+# a .json trace file is converted to the Chrome trace format (chrome://tracing, Perfetto) at the end of the run.
+# runWien2k takes the file name from params['common']['trace'].
+class Tracer:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.eventsFile = fileName if fileName.endswith('.jsonl') else os.path.splitext(fileName)[0] + '.jsonl'
+        self.origin = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.file = None
+        self.pid = None
+        open(self.eventsFile, 'w').close()
+
+    def write(self, event):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.file = open(self.eventsFile, 'a', buffering=1)
+                self.pid = os.getpid()
+            self.file.write(json.dumps(event, default=str) + '\n')
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(args)
+        start = time.time()
+        try: yield args
+        finally:
+            duration = time.time() - start
+            stack.pop()
+            # time of snapshots, copying, ... is summed up in the enclosing span too
+            if len(stack) > 0 and category != 'command': stack[-1][category+'Time'] = stack[-1].get(category+'Time', 0.0) + duration
+            self.write({'name':name, 'cat':category, 'ph':'X', 'ts':int((start-self.origin)*1e6), 'dur':int(duration*1e6), 'pid':os.getpid(), 'tid':threading.get_ident(), 'args':args})
+
+    # sets a value of the innermost span of this thread
+    def set(self, key, value):
+        stack = self.local.__dict__.get('stack', [])
+        if len(stack) > 0: stack[-1][key] = value
+
+    def events(self):
+        with open(self.eventsFile, 'r') as f: return [json.loads(line) for line in f if line.strip() != '']
+
+    def summary(self):
+        rows = {}
+        for e in self.events():
+            row = rows.setdefault((e['cat'], e['name']), {'count':0, 'wall':0.0, 'cpu':0.0, 'rss':0, 'hits':0, 'snapshot':0.0, 'bytes':0})
+            args = e['args']
+            row['count'] += 1
+            row['wall'] += e['dur']/1e6
+            row['cpu'] += args.get('childCpu') or 0.0
+            row['rss'] = max(row['rss'], args.get('maxRss') or 0)
+            row['hits'] += 1 if args.get('cache') in ['local', 'global'] else 0
+            row['snapshot'] += args.get('snapshotTime', 0.0)
+            row['bytes'] += args.get('outputBytes', 0)
+        text = '{0:<9} {1:<30} {2:>6} {3:>10} {4:>10} {5:>9} {6:>5} {7:>10} {8:>9}\n'.format('category', 'name', 'count', 'wall, s', 'cpu, s', 'rss, MB', 'hits', 'snap., s', 'out, KB')
+        for (category, name), r in sorted(rows.items(), key=lambda item: (item[0][0], -item[1]['wall'])):
+            text += '{0:<9} {1:<30} {2:>6} {3:>10.2f} {4:>10.2f} {5:>9.1f} {6:>5} {7:>10.2f} {8:>9.1f}\n'.format(category, name[:30], r['count'], r['wall'], r['cpu'], r['rss']/1024, r['hits'], r['snapshot'], r['bytes']/1024)
+        return text
+
+    def close(self):
+        if self.file is not None: self.file.close()
+        self.file = None
+        self.pid = None
+        if not self.fileName.endswith('.jsonl'):
+            with open(self.fileName, 'w') as f: json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+        summary = self.summary()
+        with open(os.path.splitext(self.fileName)[0] + '_summary.txt', 'w') as f: f.write(summary)
+        print('Trace summary:\n' + summary)
+
+tracerGlobal = None
+
+def traceSpan(name, category, **args):
+    if tracerGlobal is None: return contextlib.nullcontext(args)
+    return tracerGlobal.span(name, category, **args)
+
+def traceSet(key, value):
+    if tracerGlobal is not None: tracerGlobal.set(key, value)
+
+# Short name of a command for the summary: the program of the last part of a pipe ('x lapw1', 'run_lapw')
+def commandName(cmd):
+    words = [w for w in cmd.split('|')[-1].split() if '=' not in w]
+    if len(words) == 0: return cmd.strip()[:30]
+    name = os.path.basename(words[0])
+    if name == 'x' and len(words) > 1: name += ' ' + words[1]
+    return name
+
+hashCacheFileName = '.hashcache'
+outputsDirName = '.outputs'
+snapshotsDirName = '.snapshots'
+
+# Per-file content hashes keyed on (mtime, size, inode), so unchanged files are never re-read
+class FileHashCache:
     def __init__(self, workDir):
+        self.workDir = workDir
+        self.hashCacheFile = join(workDir, hashCacheFileName)
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(self.hashCacheFile):
+            try:
+                with open(self.hashCacheFile, 'r') as f: self.entries = json.load(f)
+            except ValueError: self.entries = {}
+
+    def fileHash(self, relPath, st):
+        key = [st.st_mtime_ns, st.st_size, st.st_ino]
+        entry = self.entries.get(relPath)
+        if entry is not None and entry[:3] == key: return entry[3]
+        h = hashlib.sha1()
+        with open(join(self.workDir, relPath), 'rb') as f:
+            for block in iter(lambda: f.read(1<<20), b''): h.update(block)
+        fileHash = h.hexdigest()
+        # file modified within the timestamp granularity can change again unnoticed, don't trust its stat
+        if time.time_ns() - st.st_mtime_ns > 2*10**9:
+            self.entries[relPath] = key + [fileHash]
+            self.changed = True
+        return fileHash
+
+    def save(self, existing):
+        for relPath in list(self.entries.keys()):
+            if relPath not in existing:
+                del self.entries[relPath]
+                self.changed = True
+        if not self.changed: return
+        tmp = self.hashCacheFile + '.tmp'
+        with open(tmp, 'w') as f: json.dump(self.entries, f)
+        os.replace(tmp, self.hashCacheFile)
+        self.changed = False
+
+hashCaches = {}
+hashCachesLock = threading.Lock()
+def getFileHashCache(workDir):
+    key = os.path.realpath(workDir)
+    with hashCachesLock:
+        if key not in hashCaches: hashCaches[key] = FileHashCache(workDir)
+        return hashCaches[key]
+
+# Files starting with '.' or ':' are not part of the state (see .gitignore made by prepareDirectory)
+def listStateFiles(workDir):
+    files = {}
+    for root, dirs, fileNames in os.walk(workDir):
+        dirs[:] = [d for d in dirs if d[0] not in ['.',':']]
+        for name in fileNames:
+            if name[0] in ['.',':']: continue
+            path = join(root, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode): continue
+            files[os.path.relpath(path, workDir)] = st
+    return files
+
+def treeFileHashes(workDir):
+    hashCache = getFileHashCache(workDir)
+    files = listStateFiles(workDir)
+    hashes = {}
+    for relPath, st in files.items():
+        hashes[relPath] = (hashCache.fileHash(relPath, st), bool(st.st_mode & stat.S_IXUSR))
+    hashCache.save(files)
+    return hashes
+
+def treeFingerprint(workDir):
+    h = hashlib.sha1()
+    for relPath, (fileHash, executable) in sorted(treeFileHashes(workDir).items()):
+        h.update('{0}\0{1}\0{2}\n'.format(relPath, fileHash, int(executable)).encode('utf8'))
+    return h.hexdigest()
+
+# Journal of cache lines: one JSON record per line, appended and fsynced on every add.
+# A torn last line (crash while writing) is dropped on load, superseded lines are removed by compaction.
+# Other processes (XTLS workers) append to the same journal: appends and compaction hold flock of .cache.lock,
+# which, unlike the journal, is never replaced.
+class Cache:
+    def __init__(self, workDir, compaction=True):
         self.workDir = workDir
         self.cacheFile = self.workDir + '/.cache'
+        self.lockFileName = self.cacheFile + '.lock'
+        self.blobStore = BlobStore(join(self.workDir, outputsDirName))
+        self.compaction = compaction
+        self.lock = threading.RLock()
+        self.lockFile = None
+        self.journal = None
         self.load()
+
+    # flock of the journal, reentrant in the thread holding self.lock
+    @contextlib.contextmanager
+    def fileLock(self):
+        with self.lock:
+            if self.lockFile is not None:
+                yield
+                return
+            with open(self.lockFileName, 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                self.lockFile = f
+                try: yield
+                finally: self.lockFile = None
         
     def load(self):
+        self.cache = []
+        self.index = {}
+        # lines without input hash (saved by old versions), a miss has to check them one by one
+        self.legacy = []
+        self.superseded = 0
+        self.offset = 0
+        self.fileId = None
+        if self.journal is not None: self.journal.close()
+        self.journal = None
         if os.path.exists(self.cacheFile):
-            self.cache = self.from_JSON()
+            self.openJournal()
+            content = self.journal.read()
+            if content.lstrip().startswith(b'['):
+                # old format: the whole cache as one JSON list
+                records = json.loads(content.decode('utf8'))
+                needCompaction = True
+                self.offset = len(content)
+            else:
+                records, needCompaction = self.parseRecords(content)
+            for record in records:
+                cacheLine = CacheLine.from_JSON(record, self.blobStore)
+                if cacheLine.inlineOutput is not None:
+                    # output saved inline by older versions
+                    cacheLine.storeOutput(self.blobStore)
+                    needCompaction = True
+                self.addToList(cacheLine)
+            if self.compaction and (needCompaction or self.needCompaction()): self.compact()
+
+    # the journal stays open, so a journal written by compaction can't get its inode while this process reads it
+    def openJournal(self):
+        if self.journal is not None: self.journal.close()
+        self.journal = open(self.cacheFile, 'rb')
+        self.fileId = os.fstat(self.journal.fileno()).st_ino
+
+    def parseRecords(self, content):
+        end = content.rfind(b'\n') + 1
+        self.offset += end
+        records = []
+        broken = end < len(content)
+        for line in content[:end].split(b'\n'):
+            if line.strip() == b'': continue
+            try: records.append(json.loads(line.decode('utf8')))
+            except ValueError: broken = True
+        return records, broken
+
+    # pick up lines appended by other processes sharing the same journal
+    def refresh(self):
+        with self.lock:
+            if not os.path.exists(self.cacheFile):
+                # journal was removed together with its folder
+                if self.fileId is not None: self.load()
+                return
+            st = os.stat(self.cacheFile)
+            if st.st_ino != self.fileId:
+                self.load()
+                return
+            if st.st_size <= self.offset: return
+            with open(self.cacheFile, 'rb') as f:
+                f.seek(self.offset)
+                content = f.read()
+            records, broken = self.parseRecords(content)
+            for record in records:
+                cacheLine = CacheLine.from_JSON(record, self.blobStore)
+                known = self.index.get((cacheLine.cmd, cacheLine.inHash))
+                if known is not None and known.outState == cacheLine.outState: continue
+                self.addToList(cacheLine)
+
+    def addToList(self, cacheLine):
+        self.cache.append(cacheLine)
+        if cacheLine.inHash is None: self.legacy.append(cacheLine)
         else:
-            self.cache = []
-            self.save()
-        
-    def save(self):
-        with open(self.workDir + '/.cache', 'w') as f: json.dump(self.to_JSON(), f)
-
-    def findSameState(self, cmd):
-        sameStateCacheLine = None # 
-        for cacheLine in self.cache:
-            if cacheLine.cmd == cmd:
-                output, code = runCommand('git diff --quiet --exit-code ' + str(cacheLine.inState), self.workDir, tryFast = False, returnCode=True)
-                if code == 0:
-                    sameStateCacheLine = cacheLine
-                    break
+            if (cacheLine.cmd, cacheLine.inHash) in self.index: self.superseded += 1
+            self.index[(cacheLine.cmd, cacheLine.inHash)] = cacheLine
+
+    def needCompaction(self):
+        return self.superseded > max(100, len(self.cache)//2)
+
+    def liveLines(self):
+        return [l for l in self.cache if l.inHash is None or self.index[(l.cmd, l.inHash)] is l]
+
+    def compact(self):
+        with self.fileLock():
+            # lines appended by other processes since the last read go into the new journal too
+            self.refresh()
+            self.cache = self.liveLines()
+            self.superseded = 0
+            tmp = self.cacheFile + '.tmp'
+            with open(tmp, 'w') as f:
+                for record in self.to_JSON(): f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.cacheFile)
+            self.openJournal()
+            self.offset = os.fstat(self.journal.fileno()).st_size
+
+    def findSameState(self, cmd, inHash=None):
+        if inHash is None: inHash = treeFingerprint(self.workDir)
+        sameStateCacheLine = self.index.get((cmd, inHash))
+        if sameStateCacheLine is None:
+            # lines saved before input hashes were recorded can only be checked with git
+            for cacheLine in self.legacy:
+                if cacheLine.cmd == cmd:
+                    output, code = runCommand('git diff --quiet --exit-code ' + str(cacheLine.inState), self.workDir, tryFast = False, returnCode=True)
+                    if code == 0:
+                        sameStateCacheLine = cacheLine
+                        break
         if sameStateCacheLine is not None:
             print('Command {0} was found in cache'.format(sameStateCacheLine.cmd))
         else: print('Command {0} was not found in cache'.format(cmd))
         return sameStateCacheLine
       
     def add(self, cacheLine):
-        self.cache.append(cacheLine)
-        self.save()
+        with self.fileLock():
+            cacheLine.storeOutput(self.blobStore)
+            # the journal is read up to its end, so the offset can be moved past the own line
+            self.refresh()
+            self.addToList(cacheLine)
+            with open(self.cacheFile, 'a') as f:
+                f.write(json.dumps(cacheLine.to_JSON()) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+                self.offset = f.tell()
+            if self.fileId is None: self.openJournal()
+            if self.compaction and self.needCompaction(): self.compact()
         
     def to_JSON(self):
-        json_pack = []
-        for cache_line in self.cache:
-            json_pack.append({'cmd' : cache_line.cmd,
-                              'inState' : cache_line.inState,
-                              'outState' : cache_line.outState,
-                              'output' : cache_line.output})
-        return json_pack
-    
-    def from_JSON(self):
-        with open(self.cacheFile, 'r') as f:
-                json_cache = json.load(f)
-        temp_cache = []
-        for cache_line in json_cache:
-            temp_cache.append(CacheLine(cache_line['cmd'], cache_line['inState'], cache_line['outState'], cache_line['output']))
-        return temp_cache
+        return [cache_line.to_JSON() for cache_line in self.cache]
+
+caches = {}
+cachesLock = threading.Lock()
+# Cache is loaded once per process and shared by all runCommand calls in the same workDir
+def getCache(workDir):
+    key = os.path.realpath(workDir)
+    with cachesLock:
+        if key not in caches: caches[key] = Cache(workDir)
+        else: caches[key].refresh()
+        return caches[key]
 
 class CacheLine:
-    def __init__(self, cmd, inState, outState, output):
+    def __init__(self, cmd, inState, outState, output, inHash=None, outputHash=None, blobStore=None, backend='git', sideEffects=None):
         self.cmd = cmd
         self.inState = inState
         self.outState = outState
-        self.output = output
+        self.inlineOutput = output
+        self.inHash = inHash
+        self.outputHash = outputHash
+        self.blobStore = blobStore
+        self.backend = backend
+        # [[absolute path, blob hash]] of files the command wrote outside of workDir
+        self.sideEffects = sideEffects
+
+    # output is stored out of line and is read only when it is needed (on cache hit)
+    @property
+    def output(self):
+        if self.inlineOutput is not None: return self.inlineOutput
+        return self.blobStore.get(self.outputHash).decode('utf8')
+
+    def storeOutput(self, blobStore):
+        if self.inlineOutput is None: return
+        self.outputHash = blobStore.put(self.inlineOutput.encode('utf8'))
+        self.blobStore = blobStore
+        self.inlineOutput = None
+
+    def to_JSON(self):
+        result = {'cmd' : self.cmd,
+                  'inState' : self.inState,
+                  'outState' : self.outState,
+                  'outputHash' : self.outputHash,
+                  'inHash' : self.inHash,
+                  'backend' : self.backend}
+        if self.sideEffects is not None: result['sideEffects'] = self.sideEffects
+        return result
+
+    @staticmethod
+    def from_JSON(cache_line, blobStore=None):
+        return CacheLine(cache_line['cmd'], cache_line['inState'], cache_line['outState'], cache_line.get('output'), cache_line.get('inHash'), cache_line.get('outputHash'), blobStore, cache_line.get('backend', 'git'), cache_line.get('sideEffects'))
+
+# Content addressed storage of zlib compressed blobs: <root>/<first 2 hex digits>/<sha256>
+class BlobStore:
+    def __init__(self, root, level=6):
+        self.root = root
+        self.level = level
+
+    def path(self, blobHash):
+        return join(self.root, blobHash[:2], blobHash)
+
+    def put(self, data):
+        blobHash = hashlib.sha256(data).hexdigest()
+        path = self.path(blobHash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmp, 'wb') as f: f.write(zlib.compress(data, self.level))
+            os.replace(tmp, path)
+        return blobHash
+
+    def get(self, blobHash):
+        with open(self.path(blobHash), 'rb') as f: return zlib.decompress(f.read())
+
+
+# Content defined chunking with a gear rolling hash over a 32 byte window.
+# A chunk ends where the top bits of the hash are zero, so an insertion shifts boundaries only locally
+# and near-identical files share most of their chunks.
+class ChunkStore:
+    window = 32
 
+    def __init__(self, root, minSize=1<<18, avgBits=20, maxSize=1<<22):
+        self.blobs = BlobStore(root, level=1)
+        self.minSize = minSize
+        self.avgBits = avgBits
+        self.maxSize = maxSize
+        self.gear = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)], dtype=np.uint32)
 
-def saveState(workDir, cmd, stage):
-    runCommand('git add -A .', workDir, tryFast = False)
-    runCommand('git commit --allow-empty-message --no-edit', workDir, tryFast = False, returnCode=True)
-    state = runCommand('git log --pretty=format:"%H"', workDir, tryFast = False).split("\n")[0]
+    def rollingHash(self, data):
+        # h[i] = sum_k gear[data[i-k]] << k, k < 32, computed by doubling the window 5 times
+        h = self.gear[np.frombuffer(data, dtype=np.uint8)]
+        step = 1
+        while step < self.window:
+            shifted = h[:-step] << np.uint32(step)
+            h[step:] += shifted
+            step *= 2
+        return h
+
+    def cutPoints(self, data):
+        candidates = np.nonzero((self.rollingHash(data) >> np.uint32(32-self.avgBits)) == 0)[0] + 1
+        cuts = []
+        last = 0
+        for c in candidates:
+            while c - last > self.maxSize:
+                last += self.maxSize
+                cuts.append(last)
+            if c - last >= self.minSize:
+                cuts.append(int(c))
+                last = int(c)
+        while len(data) - last > self.maxSize:
+            last += self.maxSize
+            cuts.append(last)
+        return cuts
+
+    def put(self, path):
+        recipe = []
+        pending = b''
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(1<<23)
+                data = pending + block
+                if block == b'':
+                    if data != b'': recipe.append(self.blobs.put(data))
+                    return recipe
+                last = 0
+                for cut in self.cutPoints(data):
+                    recipe.append(self.blobs.put(data[last:cut]))
+                    last = cut
+                pending = data[last:]
+
+    def get(self, recipe, dst):
+        with open(dst, 'wb') as f:
+            for chunkHash in recipe: f.write(self.blobs.get(chunkHash))
+
+chunksDirName = '.chunks'
+# Files not smaller than this are kept in the chunk store, shared by all workDirs under caseBaseDir (set by runWien2k)
+chunkThresholdGlobal = 1<<23
+chunkStoreRootGlobal = None
+chunkStores = {}
+chunkStoresLock = threading.Lock()
+def getChunkStore(workDir):
+    root = chunkStoreRootGlobal if chunkStoreRootGlobal is not None else join(workDir, snapshotsDirName, 'chunks')
+    with chunkStoresLock:
+        if root not in chunkStores: chunkStores[root] = ChunkStore(root)
+        return chunkStores[root]
+
+
+FICLONE = 0x40049409
+def reflinkFile(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return True
+        except OSError: return False
+
+# Copy-on-write copy (reflink) if the filesystem supports it, ordinary copy otherwise
+def cloneFile(src, dst):
+    cloned = reflinkFile(src, dst)
+    if not cloned: shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return cloned
+
+class GitSnapshots:
+    name = 'git'
+
+    def save(self, workDir, storeObjects=True):
+        runCommand('git add -A .', workDir, tryFast = False)
+        runCommand('git commit --allow-empty-message --no-edit', workDir, tryFast = False, returnCode=True)
+        return runCommand('git rev-parse HEAD', workDir, tryFast = False).strip()
+
+    def restore(self, workDir, state):
+        runCommand('git checkout ' + state + ' .', workDir, tryFast = False)
+
+# State is a manifest {file: [hash, executable]}, file contents are kept as reflinked/copied objects.
+# Hashes come from the stat cache, so unchanged files are neither re-read nor copied again.
+# Objects are never hardlinked to working files: WIEN2k programs rewrite their files in place.
+class SnapshotStore:
+    def __init__(self, root, chunkStore):
+        self.root = root
+        self.chunkStore = chunkStore
+        self.manifests = BlobStore(join(root, 'manifests'))
+
+    def objectPath(self, fileHash):
+        return join(self.root, 'objects', fileHash[:2], fileHash)
+
+    def storeObject(self, src, fileHash, size):
+        path = self.objectPath(fileHash)
+        if os.path.exists(path) or os.path.exists(path + '.chunks'): return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        if size >= chunkThresholdGlobal:
+            # large binaries (vector, clmsum, qtl ...) are split into chunks shared between states and workDirs
+            with open(tmp, 'w') as f: json.dump(self.chunkStore.put(src), f)
+            path += '.chunks'
+        else: cloneFile(src, tmp)
+        os.replace(tmp, path)
+
+    def restoreObject(self, fileHash, dst):
+        path = self.objectPath(fileHash)
+        if os.path.exists(path + '.chunks'):
+            with open(path + '.chunks', 'r') as f: self.chunkStore.get(json.load(f), dst)
+        else: cloneFile(path, dst)
+
+    def save(self, workDir, storeObjects=True):
+        hashes = treeFileHashes(workDir)
+        manifest = {}
+        for relPath, (fileHash, executable) in hashes.items():
+            src = join(workDir, relPath)
+            if storeObjects: self.storeObject(src, fileHash, os.path.getsize(src))
+            manifest[relPath] = [fileHash, executable]
+        return self.manifests.put(json.dumps(manifest, sort_keys=True).encode('utf8'))
+
+    def restore(self, workDir, state):
+        manifest = json.loads(self.manifests.get(state).decode('utf8'))
+        current = treeFileHashes(workDir)
+        for relPath, (fileHash, executable) in manifest.items():
+            if relPath in current and current[relPath][0] == fileHash: continue
+            dst = join(workDir, relPath)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.restore')
+            self.restoreObject(fileHash, tmp)
+            if executable: os.chmod(tmp, os.stat(tmp).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            os.replace(tmp, dst)
+        # the input fingerprint matched, so the files the manifest doesn't have were removed by the command
+        for relPath in current:
+            if relPath not in manifest: os.remove(join(workDir, relPath))
+
+class ManifestSnapshots:
+    name = 'manifest'
+
+    def store(self, workDir):
+        return SnapshotStore(join(workDir, snapshotsDirName), getChunkStore(workDir))
+
+    def save(self, workDir, storeObjects=True):
+        return self.store(workDir).save(workDir, storeObjects)
+
+    def restore(self, workDir, state):
+        self.store(workDir).restore(workDir, state)
+
+snapshotBackends = {'git': GitSnapshots(), 'manifest': ManifestSnapshots()}
+snapshotBackendGlobal = 'manifest'
+
+# Results shared between workDirs, stages, runs and users: keyed on command and input fingerprint only,
+# the output state is kept in the cache's own snapshot store and can be replayed into any matching workDir.
+class GlobalCache:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.snapshots = SnapshotStore(join(root, 'snapshots'), ChunkStore(join(root, 'chunks')))
+        # other processes append to the same journal, so it is never rewritten
+        self.cache = Cache(root, compaction=False)
+
+    def find(self, cmd, inHash):
+        cacheLine = self.cache.index.get((cmd, inHash))
+        if cacheLine is None:
+            self.cache.refresh()
+            cacheLine = self.cache.index.get((cmd, inHash))
+        if cacheLine is not None: print('Command {0} was found in global cache'.format(cmd))
+        return cacheLine
+
+    def replay(self, workDir, cacheLine):
+        self.snapshots.restore(workDir, cacheLine.outState)
+
+    def publish(self, workDir, cmd, inHash, output):
+        state = self.snapshots.save(workDir)
+        self.cache.add(CacheLine(cmd, None, state, output, inHash, backend='global'))
+
+# Root of the global cache (None - disabled), runWien2k takes it from params['common']['globalCacheDir']
+globalCacheDirGlobal = os.environ.get('W2AUTO_GLOBAL_CACHE')
+globalCaches = {}
+def getGlobalCache():
+    if globalCacheDirGlobal is None or globalCacheDirGlobal == '': return None
+    root = os.path.realpath(globalCacheDirGlobal)
+    with cachesLock:
+        if root not in globalCaches: globalCaches[root] = GlobalCache(root)
+        return globalCaches[root]
+
+def saveState(workDir, cmd, stage, backend=None):
+    if backend is None: backend = snapshotBackendGlobal
+    # input state is needed only to compare with, its file contents are not stored
+    with traceSpan('save ' + stage, 'snapshot'):
+        state = snapshotBackends[backend].save(workDir, storeObjects=(stage!='input'))
     print('save {0} state for command: {1}'.format(stage, cmd))
     return state
 
 
 def restoreState(workDir, state):
     print('restore state for command: {0}'.format(state.cmd))
-    runCommand('git checkout ' + state.outState + ' .', workDir, tryFast = False)
+    with traceSpan('restore', 'snapshot'):
+        snapshotBackends[state.backend].restore(workDir, state.outState)
+
+
+# ===================================================================================================================
+# Cluster jobs. Commands whose prefix contains 'run-cluster' go through jobManagerGlobal when a scheduler is
+# configured (params['common']['scheduler']): they are submitted, tracked by job id and their output is read from
+# the output file of that job. Options of run-cluster (-n, -m, -t, -p ...) are turned into sbatch options. All jobs are handled by one asyncio loop, so many of them may be in flight at once.
+
+slurmInfoSeparator = '================================= SLURM INFO'
+
+# options of run-cluster in the command prefix and their sbatch equivalents, long options (--mem=3000) are passed as is
+runClusterSlurmOptions = {'-n':'--ntasks', '-N':'--nodes', '-c':'--cpus-per-task', '-m':'--mem', '-t':'--time', '-p':'--partition', '-A':'--account', '-q':'--qos'}
+
+def runClusterOptions(prefix):
+    words = shlex.split(prefix)
+    programs = [i for i, w in enumerate(words) if 'run-cluster' in os.path.basename(w)]
+    words = words[programs[0]+1:] if len(programs) > 0 else []
+    options = []
+    i = 0
+    while i < len(words):
+        option = words[i]
+        value = words[i+1] if i+1 < len(words) and not words[i+1].startswith('-') else None
+        i += 1 if value is None else 2
+        if option.startswith('--'): options.append(option if value is None else option+'='+value)
+        elif option in runClusterSlurmOptions and value is not None: options.append(runClusterSlurmOptions[option]+'='+value)
+        else: print('Warning: option {0} of "{1}" has no sbatch equivalent and is ignored'.format(' '.join([option] + ([value] if value is not None else [])), prefix.strip()))
+    return options
+
+class ClusterJob:
+    def __init__(self, cmd, workDir, env=None, options=[]):
+        self.cmd = cmd
+        self.workDir = workDir
+        self.env = env
+        self.options = options
+        self.jobId = None
+        self.state = 'NEW'
+        self.returncode = None
+        self.outputFile = None
+        self.exitFile = None
+        self.unknownPolls = 0
+        self.done = None
+
+    def output(self):
+        if self.outputFile is None or not os.path.exists(self.outputFile): return ''
+        with open(self.outputFile, 'rb') as f: output = f.read().decode('utf8', 'ignore')
+        if slurmInfoSeparator in output: output = output[:output.find(slurmInfoSeparator)]
+        return output
+
+async def runProcess(args, input=None, env=None):
+    proc = await asyncio.create_subprocess_exec(*args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+    output, _ = await proc.communicate(input)
+    return output.decode('utf8', 'ignore'), proc.returncode
+
+# A finished job is recognized by the exit code file its script writes, then by sacct. When neither tells
+# anything (the job was killed before it could write the file and there is no accounting), the job is asked
+# about again and after unknownPolls polls it ends in state UNKNOWN, which is a failure.
+class SlurmScheduler:
+    finalStates = ['COMPLETED', 'FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'UNKNOWN']
+
+    def __init__(self, options=[], sbatch='sbatch', squeue='squeue', sacct='sacct', scancel='scancel', unknownPolls=6):
+        self.options = options
+        self.unknownPolls = unknownPolls
+        self.sbatch = sbatch
+        self.squeue = squeue
+        self.sacct = sacct
+        self.scancel = scancel
+
+    async def submit(self, job):
+        # the exit code file starts with '.', so it isn't a part of the state of workDir; the trap writes it
+        # also when the command itself calls exit or changes the directory
+        trap = 'echo $? > ' + shlex.quote(join(job.workDir, '.slurm-')) + '$SLURM_JOB_ID.exit'
+        script = '#!/bin/sh\ntrap ' + shlex.quote(trap) + ' EXIT\n' + job.cmd + '\n'
+        args = [self.sbatch, '--parsable', '--chdir='+job.workDir, '--output='+join(job.workDir, 'slurm-%j.out')] + self.options + job.options
+        output, code = await runProcess(args, script.encode('utf8'), job.env)
+        if code != 0: raise Exception('Error while submitting command "'+job.cmd+'":\n'+output)
+        job.jobId = output.strip().split('\n')[-1].split(';')[0]
+        job.outputFile = join(job.workDir, 'slurm-'+job.jobId+'.out')
+        job.exitFile = join(job.workDir, '.slurm-'+job.jobId+'.exit')
+        job.state = 'PENDING'
+
+    async def poll(self, jobs):
+        output, code = await runProcess([self.squeue, '-h', '-o', '%i %T', '--jobs='+','.join(j.jobId for j in jobs)])
+        queued = dict(line.split()[:2] for line in output.split('\n') if len(line.split()) >= 2) if code == 0 else {}
+        for job in jobs:
+            if job.jobId in queued:
+                job.state = queued[job.jobId]
+                continue
+            # left the queue (or squeue doesn't know it any more): the exit code of the script or the accounting
+            if self.readExitFile(job): continue
+            output, code = await runProcess([self.sacct, '-n', '-P', '-X', '-j', job.jobId, '-o', 'State,ExitCode'])
+            lines = [l for l in output.split('\n') if '|' in l]
+            if code == 0 and len(lines) > 0:
+                state, exitCode = lines[0].split('|')[:2]
+                job.state = state.split()[0]
+                job.returncode = int(exitCode.split(':')[0]) if job.state == 'COMPLETED' else (int(exitCode.split(':')[0]) or 1)
+            else:
+                # no accounting (yet): ask again on the next poll
+                job.unknownPolls += 1
+                if job.unknownPolls >= self.unknownPolls:
+                    job.state = 'UNKNOWN'
+                    print('Job {0} left the queue, but neither {1} nor sacct tell how it finished:\n{2}'.format(job.jobId, job.exitFile, output))
+
+    def readExitFile(self, job):
+        try:
+            with open(job.exitFile, 'r') as f: text = f.read().strip()
+        except OSError: return False
+        # written, but not yet flushed to this node
+        if text == '': return False
+        job.returncode = int(text)
+        job.state = 'COMPLETED' if job.returncode == 0 else 'FAILED'
+        os.remove(job.exitFile)
+        return True
+
+    async def cancel(self, job):
+        await runProcess([self.scancel, job.jobId])
+
+# Stand-in for a cluster: jobs are run on this machine, at most maxJobs at a time
+class LocalScheduler:
+    finalStates = ['COMPLETED', 'FAILED', 'CANCELLED']
+
+    def __init__(self, maxJobs=None):
+        self.maxJobs = maxJobs if maxJobs is not None else multiprocessing.cpu_count()
+        self.counter = 0
+        self.semaphore = None
+        self.semaphoreLoop = None
+        self.processes = {}
 
+    async def submit(self, job):
+        # a forked process has its own event loop
+        if self.semaphore is None or self.semaphoreLoop is not asyncio.get_running_loop():
+            self.semaphore = asyncio.Semaphore(self.maxJobs)
+            self.semaphoreLoop = asyncio.get_running_loop()
+        self.counter += 1
+        job.jobId = str(self.counter)
+        job.outputFile = join(job.workDir, 'local-'+str(os.getpid())+'-'+job.jobId+'.out')
+        job.state = 'PENDING'
+        asyncio.ensure_future(self.execute(job))
 
-def runCommand(cmd, workDir, prefix = '', canRedirectOutputToFile=True, env=None, tryFast=tryFastGlobal, returnCode=False, w2webTrueDir=None):
+    async def execute(self, job):
+        async with self.semaphore:
+            if job.state == 'CANCELLED': return
+            job.state = 'RUNNING'
+            with open(job.outputFile, 'wb') as out:
+                proc = await asyncio.create_subprocess_shell(job.cmd, cwd=job.workDir, env=job.env, stdout=out, stderr=subprocess.STDOUT)
+                self.processes[job.jobId] = proc
+                job.returncode = await proc.wait()
+            del self.processes[job.jobId]
+            if job.state != 'CANCELLED': job.state = 'COMPLETED' if job.returncode == 0 else 'FAILED'
+
+    async def poll(self, jobs):
+        pass
+
+    async def cancel(self, job):
+        job.state = 'CANCELLED'
+        if job.jobId in self.processes: self.processes[job.jobId].kill()
+
+class JobManager:
+    def __init__(self, scheduler, pollInterval=10):
+        self.scheduler = scheduler
+        self.pollInterval = pollInterval
+        self.jobs = {}
+        self.loop = None
+        self.poller = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    async def runAsync(self, cmd, workDir, env=None, options=[]):
+        job = ClusterJob(cmd, workDir, env, options)
+        job.done = asyncio.get_running_loop().create_future()
+        await self.scheduler.submit(job)
+        print('Job {0} submitted: {1}'.format(job.jobId, cmd))
+        self.jobs[job.jobId] = job
+        if self.poller is None or self.poller.done(): self.poller = asyncio.ensure_future(self.pollLoop())
+        try: await job.done
+        except asyncio.CancelledError:
+            await self.scheduler.cancel(job)
+            raise
+        return job
+
+    # one poll of the scheduler for all jobs in flight
+    async def pollLoop(self):
+        while len(self.jobs) > 0:
+            await asyncio.sleep(self.pollInterval)
+            try: await self.scheduler.poll(list(self.jobs.values()))
+            except Exception as e:
+                print('Error while polling jobs: ' + repr(e))
+                continue
+            for jobId, job in list(self.jobs.items()):
+                if job.state in self.scheduler.finalStates:
+                    del self.jobs[jobId]
+                    if not job.done.done(): job.done.set_result(job)
+
+    # blocking call for the worker threads
+    def run(self, cmd, workDir, env=None, options=[]):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.runAsync(cmd, workDir, env, options), self.loop).result()
+
+def makeJobManager(config):
+    if config is None or config == '': return None
+    if isinstance(config, str): config = {'type': config}
+    if config['type'] == 'slurm':
+        scheduler = SlurmScheduler(config['options'] if 'options' in config else [])
+        pollInterval = 10
+    elif config['type'] == 'local':
+        scheduler = LocalScheduler(config['maxJobs'] if 'maxJobs' in config else None)
+        pollInterval = 0.2
+    else: raise Exception('Error: unknown scheduler ' + str(config['type']))
+    return JobManager(scheduler, config['pollInterval'] if 'pollInterval' in config else pollInterval)
+
+jobManagerGlobal = None
+
+# Files outside of workDir which a command writes (w2web pictures, session files) are found by comparing
+# listings of sideEffectDirs before and after the command
+def listSideEffectFiles(dirs):
+    files = {}
+    for d in dirs:
+        for root, _, fileNames in os.walk(d):
+            for fileName in fileNames:
+                path = join(root, fileName)
+                try: st = os.stat(path)
+                except OSError: continue
+                files[path] = (st.st_mtime_ns, st.st_size)
+    return files
+
+def storeSideEffects(before, dirs, blobStore):
+    sideEffects = []
+    for path, info in sorted(listSideEffectFiles(dirs).items()):
+        if before.get(path) == info: continue
+        with open(path, 'rb') as f: sideEffects.append([path, blobStore.put(f.read())])
+    return sideEffects
+
+def replaySideEffects(cacheLine):
+    if cacheLine.sideEffects is None: return
+    for path, blobHash in cacheLine.sideEffects:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp, 'wb') as f: f.write(cacheLine.blobStore.get(blobHash))
+        os.replace(tmp, path)
+
+# ===================================================================================================================
+# Streaming capture of command output. Output is read from a pipe while the command runs, every line is given to
+# the matchers. A fatal matcher stops the command at once. Only the first outputHeadSizeGlobal and the last
+# outputTailSizeGlobal bytes are kept in memory (and in the cache); when there is more, the whole output also goes
+# to a spill file, which is kept if the command fails. Only the text of a kept spill file refers to it: outputs of
+# successful commands go to the cache and are replayed long after the spill file is removed.
+outputHeadSizeGlobal = 1<<20
+outputTailSizeGlobal = 4<<20
+
+class OutputMatcher:
+    def __init__(self, pattern, fatal=False, callback=None, flags=re.IGNORECASE):
+        self.regex = re.compile(pattern, flags)
+        self.fatal = fatal
+        self.callback = callback
+        self.matches = []
+
+    def match(self, line):
+        m = self.regex.search(line)
+        if m is None: return False
+        self.matches.append(line)
+        if self.callback is not None: self.callback(line)
+        return True
+
+class OutputCapture:
+    def __init__(self, headSize=None, tailSize=None):
+        self.headSize = headSize if headSize is not None else outputHeadSizeGlobal
+        self.tailSize = tailSize if tailSize is not None else outputTailSizeGlobal
+        self.head = bytearray()
+        self.tail = collections.deque()
+        self.tailBytes = 0
+        self.total = 0
+        self.spill = None
+        self.spillKept = False
+
+    def write(self, data):
+        self.total += len(data)
+        if self.spill is not None: self.spill.write(data)
+        if len(self.head) < self.headSize:
+            n = self.headSize - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        if len(data) == 0: return
+        self.tail.append(data)
+        self.tailBytes += len(data)
+        if self.tailBytes > self.tailSize:
+            if self.spill is None:
+                # nothing is dropped yet, so the spill file gets the whole output
+                self.spill = tempfile.NamedTemporaryFile(prefix='w2auto-', suffix='.log', delete=False)
+                self.spill.write(bytes(self.head))
+                for chunk in self.tail: self.spill.write(chunk)
+            while self.tailBytes - len(self.tail[0]) >= self.tailSize: self.tailBytes -= len(self.tail.popleft())
+
+    def text(self):
+        tail = b''.join(self.tail)
+        skipped = self.total - len(self.head) - len(tail)
+        if len(tail) > self.tailSize:
+            skipped += len(tail) - self.tailSize
+            tail = tail[-self.tailSize:]
+        middle = b''
+        if skipped > 0 and self.spillKept:
+            middle = '\n... {0} bytes skipped, the whole output is in {1} ...\n'.format(skipped, self.spill.name).encode('utf8')
+        elif skipped > 0:
+            middle = '\n... {0} bytes skipped ...\n'.format(skipped).encode('utf8')
+        return (bytes(self.head) + middle + tail).decode('utf8', 'ignore')
+
+    def close(self, keepSpill):
+        if self.spill is None: return
+        self.spill.close()
+        self.spillKept = keepSpill
+        if not keepSpill: os.remove(self.spill.name)
+
+# Peak memory of a command, KB: VmHWM of the processes of its tree, sampled in /proc while it runs (Linux only).
+# ru_maxrss of wait4 can't be used, the forked child counts the memory of w2auto until exec. Children that are still
+# such a copy (same cmdline as w2auto) are skipped; programs shorter than the poll interval may be missed.
+rssPollInterval = 0.2
+
+class TreeMemorySampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.peaks = {}
+        self.maxRss = 0
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if not os.path.exists('/proc/self/cmdline'): return self
+        with open('/proc/self/cmdline', 'rb') as f: self.ownCmdline = f.read()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    # None when nothing was measured
+    def stop(self):
+        if self.thread is None: return None
+        self.stopEvent.set()
+        self.thread.join()
+        return self.maxRss if len(self.peaks) > 0 else None
+
+    def run(self):
+        self.sample()
+        while not self.stopEvent.wait(rssPollInterval): self.sample()
+
+    def tree(self):
+        children = collections.defaultdict(list)
+        for name in os.listdir('/proc'):
+            if not name.isdigit(): continue
+            try:
+                with open('/proc/'+name+'/stat', 'rb') as f: data = f.read()
+            except OSError: continue
+            # the program name in parentheses may contain spaces
+            ppid = int(data[data.rfind(b')')+2:].split()[1])
+            children[ppid].append(int(name))
+        pids = [self.pid]
+        for pid in pids: pids += children[pid]
+        return pids
+
+    # peaks of the processes alive at the same time are summed up
+    def sample(self):
+        total = 0
+        for pid in self.tree():
+            try:
+                with open('/proc/{0}/cmdline'.format(pid), 'rb') as f: cmdline = f.read()
+                with open('/proc/{0}/status'.format(pid), 'rb') as f: status = f.read()
+            except OSError: continue
+            m = re.search(rb'VmHWM:\s+(\d+)', status)
+            if cmdline == self.ownCmdline or m is None: continue
+            self.peaks[pid] = max(self.peaks.get(pid, 0), int(m.group(1)))
+            total += self.peaks[pid]
+        self.maxRss = max(self.maxRss, total)
+
+# Returns returncode, the line of the first fatal match (None if there was no one), rusage and peak memory
+def streamCommand(fullCommand, cwd, env, capture, matchers=[]):
+    canStop = any(m.fatal for m in matchers)
+    # own process group, so that all programs started by a script can be stopped
+    proc = subprocess.Popen(fullCommand, cwd=cwd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=canStop)
+    sampler = TreeMemorySampler(proc.pid).start()
+    fatalLine = None
+    partial = b''
+    try:
+        while True:
+            data = proc.stdout.read1(1<<16)
+            if len(data) == 0: break
+            capture.write(data)
+            if len(matchers) == 0: continue
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()[-(1<<16):]
+            for line in lines:
+                line = line.decode('utf8', 'ignore')
+                for m in matchers:
+                    if m.match(line) and m.fatal and fatalLine is None: fatalLine = line
+            if fatalLine is not None: break
+        if fatalLine is None and len(partial) > 0:
+            line = partial.decode('utf8', 'ignore')
+            for m in matchers:
+                if m.match(line) and m.fatal and fatalLine is None: fatalLine = line
+    except BaseException:
+        if canStop: stopProcessGroup(proc)
+        sampler.stop()
+        raise
+    if fatalLine is not None: stopProcessGroup(proc)
+    proc.stdout.close()
+    if proc.returncode is not None: return proc.returncode, fatalLine, None, sampler.stop()
+    # wait4 gives the resources of this command (with its children) only, not of commands of other threads
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, fatalLine, rusage, sampler.stop()
+
+def stopProcessGroup(proc):
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try: os.killpg(proc.pid, sig)
+        except ProcessLookupError: return
+        try:
+            proc.wait(timeout=10)
+            return
+        except subprocess.TimeoutExpired: pass
+
+# cacheKey replaces cmd in the cache, when cmd itself contains volatile parts
+def runCommand(cmd, workDir, prefix = '', canRedirectOutputToFile=True, env=None, tryFast=tryFastGlobal, returnCode=False, w2webTrueDir=None, cacheKey=None, sideEffectDirs=[], matchers=[], monitor=None):
+    with traceSpan(commandName(cmd), 'command', cmd=cmd[:200], workDir=w2webTrueDir or workDir, cache='miss' if tryFast else 'off'):
+        result = executeCommand(cmd, workDir, prefix, canRedirectOutputToFile, env, tryFast, returnCode, w2webTrueDir, cacheKey, sideEffectDirs, matchers, monitor)
+        traceSet('outputBytes', len(result[0] if returnCode else result))
+        return result
+
+# monitor (start/stop) runs only while the command really runs, it is stopped before the output state is saved
+def executeCommand(cmd, workDir, prefix, canRedirectOutputToFile, env, tryFast, returnCode, w2webTrueDir, cacheKey, sideEffectDirs, matchers, monitor):
     
     cmdWorkDir = workDir
+    if cacheKey is None: cacheKey = cmd
     if w2webTrueDir is not None:  workDir = w2webTrueDir
     
     if 'run-cluster' in prefix:
         canRedirectOutputToFile = False
       
-    if canRedirectOutputToFile:
-        f = tempfile.NamedTemporaryFile(delete=False)
-        f.close()
-        postfix = ' > '+f.name+' 2>&1'
-    else: postfix = ''
     
+    cacheHit = False
     if tryFast:
-        cache = Cache(workDir)
-        sameStateCacheLine = cache.findSameState(cmd)
+        cache = getCache(workDir)
+        # side effects are absolute paths, they can't be shared with other working folders
+        globalCache = getGlobalCache() if len(sideEffectDirs) == 0 else None
+        inHash = treeFingerprint(workDir)
+        sameStateCacheLine = cache.findSameState(cacheKey, inHash)
+        globalCacheLine = None
+        if sameStateCacheLine is None and globalCache is not None:
+            globalCacheLine = globalCache.find(cacheKey, inHash)
         if sameStateCacheLine is not None:
             restoreState(workDir, sameStateCacheLine)
+            replaySideEffects(sameStateCacheLine)
             output = sameStateCacheLine.output
+            cacheHit = True
+            traceSet('cache', 'local')
+        elif globalCacheLine is not None:
+            with traceSpan('global replay', 'snapshot'): globalCache.replay(workDir, globalCacheLine)
+            output = globalCacheLine.output
+            cacheHit = True
+            traceSet('cache', 'global')
         else:
-            prevState = saveState(workDir, cmd, 'input')
+            backend = snapshotBackendGlobal
+            prevState = saveState(workDir, cmd, 'input', backend)
+            sideEffectsBefore = listSideEffectFiles(sideEffectDirs)
     
-    if (not tryFast) or (tryFast and (sameStateCacheLine is None)):
+    if not cacheHit:
         prefix = prefix.strip()
         if prefix=='':
-            fullCommand = cmd+' '+postfix
+            fullCommand = cmd
+        else:
+            fullCommand = prefix+' "'+cmd+'"'
+        fatalLine = None
+        if monitor is not None: monitor.start()
+        if 'run-cluster' in prefix and jobManagerGlobal is not None:
+            # options of run-cluster (cores, memory, time, partition ...) go to the scheduler
+            job = jobManagerGlobal.run(cmd, cmdWorkDir, env, runClusterOptions(prefix))
+            output = job.output()
+            returncode = job.returncode
+            if returncode is None:
+                raise Exception('Error: job {0} of command "{1}" finished in state {2}, its exit code is unknown:\n{3}'.format(job.jobId, cmd, job.state, output))
         else:
-            fullCommand = prefix+' "'+cmd+'" '+postfix
-        procInfo = subprocess.run(fullCommand, cwd=cmdWorkDir, shell=True, env=env)
-        
-        if postfix != '':
-            with open(f.name, 'rb') as myfile:
-                output = myfile.read()
-                output = output.decode('utf8', 'ignore')
-            os.remove(f.name)
-        else: 
-            output = ''
             if 'run-cluster' in prefix:
-                files = glob.glob(workDir+'/slurm*.out'); files.sort()
-                if len(files) == 0: raise Exception('Error: can\'t find slurm*.out file in folder '+workDir)
-                with open(files[-1], 'r') as myfile: output = myfile.read()
-                output = output[:output.find('================================= SLURM INFO')]
+                # other jobs may write their slurm*.out here too, only files of this one are looked at
+                oldFiles = set(glob.glob(workDir+'/slurm*.out'))
+                submitTime = time.time()
+            if canRedirectOutputToFile:
+                capture = OutputCapture()
+                returncode, fatalLine, rusage, maxRss = streamCommand(fullCommand, cmdWorkDir, env, capture, matchers)
+                if rusage is not None: traceSet('childCpu', rusage.ru_utime + rusage.ru_stime)
+                if maxRss is not None: traceSet('maxRss', maxRss)
+                capture.close(keepSpill=(returncode != 0 or fatalLine is not None))
+                output = capture.text()
+            else: 
+                returncode = subprocess.run(fullCommand, cwd=cmdWorkDir, shell=True, env=env).returncode
+                output = ''
+                if 'run-cluster' in prefix:
+                    files = [fn for fn in glob.glob(workDir+'/slurm*.out') if fn not in oldFiles or os.path.getmtime(fn) >= submitTime]
+                    if len(files) == 0: raise Exception('Error: can\'t find slurm*.out file of command "'+cmd+'" in folder '+workDir)
+                    files.sort(key=os.path.getmtime)
+                    with open(files[-1], 'r') as myfile: output = myfile.read()
+                    if slurmInfoSeparator in output: output = output[:output.find(slurmInfoSeparator)]
+        if monitor is not None: monitor.stop()
                 
         if debugMode:
             debugLog.write(comandLogSeparator + cmd + '\n')            
             if 'git diff' in cmd: debugLog.write('output size = '+str(len(output))+'\n')
             else: debugLog.write(output+'\n')
-        if returnCode: return output, procInfo.returncode
-        if procInfo.returncode !=0:
+        if fatalLine is not None and not returnCode:
+            raise Exception('Command ' + prefix + ' "'+cmd+'" was stopped on line "'+fatalLine.strip()+'":\n'+output)
+        if returnCode: return output, returncode
+        if returncode !=0:
             raise Exception('Error while executing command ' + prefix + ' "'+cmd+'":\n'+output)
       
-    if tryFast and (sameStateCacheLine is None):
-        nextState = saveState(workDir, cmd, 'output')
-        cache.add(CacheLine(cmd, prevState, nextState, output))
+    if tryFast and not cacheHit:
+        nextState = saveState(workDir, cmd, 'output', backend)
+        sideEffects = storeSideEffects(sideEffectsBefore, sideEffectDirs, cache.blobStore) if len(sideEffectDirs) > 0 else None
+        cache.add(CacheLine(cacheKey, prevState, nextState, output, inHash, backend=backend, sideEffects=sideEffects))
+        if globalCache is not None:
+            with traceSpan('global publish', 'snapshot'): globalCache.publish(workDir, cacheKey, inHash, output)
 
     return output
 
@@ -205,7 +1206,26 @@ debug=0
     w2webContext = {'HOME':d, 'w2webInstallFolder':w2webInstallFolder, 'caseBaseDir':caseBaseDir, 'env':env}    
     return w2webContext
 
+# params which differ from run to run but don't change what a w2web script does
+w2webVolatileParams = ['TIME', 'SID', 'NAME', 'HOSTNODE']
+
+# All scripts of one w2web folder share its tmp and sessions: calls (and session creation) are serialized per
+# folder, so that side effects recorded for a call are its own and not files of a call of another stage
+w2webLocks = {}
+w2webLocksLock = threading.Lock()
+def w2webLock(w2webContext):
+    key = os.path.realpath(w2webContext['w2webInstallFolder'])
+    with w2webLocksLock:
+        if key not in w2webLocks: w2webLocks[key] = threading.RLock()
+        return w2webLocks[key]
+
+# w2web calls are cached like other commands: key is the script with its normalized params, state is workDir.
+# Pictures in w2web tmp and session files are recorded as side effects and written back on a cache hit.
 def runW2webCommand(htdocsFileName0, params, w2webContext, workDir, method='GET', tryFast = True):
+    with traceSpan(htdocsFileName0, 'w2web', workDir=workDir, method=method), w2webLock(w2webContext):
+        return executeW2webCommand(htdocsFileName0, params, w2webContext, workDir, method, tryFast)
+
+def executeW2webCommand(htdocsFileName0, params, w2webContext, workDir, method, tryFast):
     wienroot = os.environ['WIENROOT']
     htdocs = join(wienroot, 'SRC_w2web/htdocs')
     if htdocsFileName0[0]=='/': htdocsFileName = htdocsFileName0[1:]
@@ -219,11 +1239,14 @@ def runW2webCommand(htdocsFileName0, params, w2webContext, workDir, method='GET'
         webParams = urllib.parse.urlencode(sorted_params)
     env['SCRIPT_NAME'] = htdocsFileName0
     env['HTTP_REFERER'] = ''
+    keyParams = sorted((k, v) for k, v in urllib.parse.parse_qsl(webParams, keep_blank_values=True) if k not in w2webVolatileParams)
+    cacheKey = 'w2web ' + method + ' ' + htdocsFileName0 + '?' + urllib.parse.urlencode(keyParams)
+    sideEffectDirs = [join(w2webContext['w2webInstallFolder'], 'tmp'), join(w2webContext['w2webInstallFolder'], 'sessions')]
     if method=='GET':
         env['QUERY_STRING'] = webParams
         env['REQUEST_METHOD'] = 'GET'
         cmd = 'QUERY_STRING="'+ webParams + '" '+cmd0
-        output = runCommand(cmd0, os.path.dirname(cmd0), '', True, env, tryFast=False, w2webTrueDir=workDir)
+        output = runCommand(cmd0, os.path.dirname(cmd0), '', True, env, tryFast=tryFast, w2webTrueDir=workDir, cacheKey=cacheKey, sideEffectDirs=sideEffectDirs)
     else:
         env['REQUEST_METHOD'] = 'POST'
         env['CONTENT_LENGTH'] = str(len(webParams))
@@ -232,78 +1255,142 @@ def runW2webCommand(htdocsFileName0, params, w2webContext, workDir, method='GET'
         f.close()
         cmd = 'echo -n "'+webParams+'" | '+cmd0
         #cmd = 'cat ' + f.name + ' | '+cmd0
-        output = runCommand(cmd, os.path.dirname(cmd0), '', True, env, tryFast=False, w2webTrueDir=workDir)
+        output = runCommand(cmd, os.path.dirname(cmd0), '', True, env, tryFast=tryFast, w2webTrueDir=workDir, cacheKey=cacheKey, sideEffectDirs=sideEffectDirs)
         os.remove(f.name)
     if debugMode:
         debugLog.write(comandLogSeparator + htdocsFileName0+'\nparams = ' + str(params) + '\nMETHOD = '+method+'\n')
         debugLog.write(output+'\n')
     return output
 
+# new.cgi and save.cgi of one session are not interleaved with calls of other threads (DOS atoms, stages)
 def newSession(workDir, w2webContext):
     sessionName = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(10))
-    output = runW2webCommand('/session/new.cgi', {'NEWNAME':sessionName}, w2webContext, workDir, tryFast = False)
-    foundRes = re.search('dir.pl\?.*SID=(\d+)\&', output)
-    if foundRes is None:
-        raise Exception('Error while executing command "/session/new.cgi":\n'+output)
-    else: SID = foundRes.group(1)
-    output = runW2webCommand('/session/save.cgi', {'SID':SID, 'dir':workDir}, w2webContext, workDir, tryFast = False)
+    with w2webLock(w2webContext):
+        output = runW2webCommand('/session/new.cgi', {'NEWNAME':sessionName}, w2webContext, workDir, tryFast = False)
+        foundRes = re.search('dir.pl\?.*SID=(\d+)\&', output)
+        if foundRes is None:
+            raise Exception('Error while executing command "/session/new.cgi":\n'+output)
+        else: SID = foundRes.group(1)
+        output = runW2webCommand('/session/save.cgi', {'SID':SID, 'dir':workDir}, w2webContext, workDir, tryFast = False)
     return SID, sessionName
 
+# ===================================================================================================================
+# Model of a WIEN2k struct file. Atom blocks are read line by line: the first position line, MULT, the other
+# positions, the line with name/NPT/R0/RMT/Z and the local rotation matrix.
+structPositionRe = re.compile(r'^\s*(?:ATOM)?\s*(-?\d+)\s*:\s*X=\s*([-+\d.]+)\s*Y=\s*([-+\d.]+)\s*Z=\s*([-+\d.]+)', re.IGNORECASE)
+structMultRe = re.compile(r'MULT=\s*(\d+)', re.IGNORECASE)
+structNameRe = re.compile(r'^(.*?)\s*NPT=\s*(\d+)\s+R0=\s*([-+\d.eEdD]+)\s+RMT=\s*([\d.]+)\s+Z:\s*([\d.]+)', re.IGNORECASE)
+structAtomsRe = re.compile(r'NONEQUIV\.ATOMS\s*:\s*(\d+)\s*(\S*)', re.IGNORECASE)
+# unit is missing in struct files which w2web hasn't saved yet
+structModeRe = re.compile(r'MODE OF CALC=(\S+)(?:\s+unit=(\S+))?', re.IGNORECASE)
+
+class StructAtom:
+    def __init__(self, index, name, positions, npt, r0, rmt, Z):
+        self.index = index
+        self.name = name
+        # fractional coordinates of all equivalent positions
+        self.positions = positions
+        self.npt = npt
+        self.r0 = r0
+        self.rmt = rmt
+        self.Z = Z
+
+    @property
+    def mult(self):
+        return len(self.positions)
+
+class Structure:
+    def __init__(self, title, lattice, spaceGroup, mode, unit, cell, atoms):
+        self.title = title
+        self.lattice = lattice
+        self.spaceGroup = spaceGroup
+        self.mode = mode
+        self.unit = unit
+        # a, b, c, alpha, beta, gamma
+        self.cell = cell
+        self.atoms = atoms
+
+    @staticmethod
+    def parse(content):
+        lines = content.split('\n')
+        if len(lines) < 4: raise Exception('Error: struct file is too short')
+        foundRes = structAtomsRe.search(lines[1])
+        if foundRes is None: raise Exception('Error: can\'t find number of atoms in struct file line "'+lines[1]+'"')
+        atomCount = int(foundRes.group(1))
+        spaceGroup = foundRes.group(2)
+        foundRes = structModeRe.search(lines[2])
+        if foundRes is None: raise Exception('Error: can\'t find mode of calculation in struct file line "'+lines[2]+'"')
+        mode, unit = foundRes.group(1), foundRes.group(2) or ''
+        # 6F10.6, fields may run together
+        cell = tuple(float(lines[3][10*i:10*i+10]) for i in range(6))
+        atoms = []
+        i = 4
+        for atomIndex in range(atomCount):
+            foundRes = structPositionRe.match(lines[i]) if i < len(lines) else None
+            if foundRes is None: raise Exception('Error: atom {0} is expected in line {1} of struct file'.format(atomIndex+1, i+1))
+            positions = [tuple(float(foundRes.group(k)) for k in range(2,5))]
+            foundRes = structMultRe.search(lines[i+1])
+            if foundRes is None: raise Exception('Error: MULT is expected in line {0} of struct file'.format(i+2))
+            mult = int(foundRes.group(1))
+            for k in range(1, mult):
+                foundRes = structPositionRe.match(lines[i+1+k])
+                if foundRes is None: raise Exception('Error: position {0} of atom {1} is expected in line {2} of struct file'.format(k+1, atomIndex+1, i+2+k))
+                positions.append(tuple(float(foundRes.group(j)) for j in range(2,5)))
+            i += 1 + mult
+            foundRes = structNameRe.match(lines[i])
+            if foundRes is None: raise Exception('Error: name, NPT, R0, RMT and Z of atom {0} are expected in line {1} of struct file'.format(atomIndex+1, i+1))
+            atoms.append(StructAtom(atomIndex+1, foundRes.group(1).strip(), positions, int(foundRes.group(2)), float(foundRes.group(3).replace('D','E').replace('d','e')), float(foundRes.group(4)), float(foundRes.group(5))))
+            # LOCAL ROT MATRIX: 3 lines
+            i += 4
+        return Structure(lines[0].strip(), lines[1][:4].strip(), spaceGroup, mode, unit, cell, atoms)
+
+    # names of non-equivalent atoms, the same name of different atoms gets _ATOM_<index>
+    def atomNames(self):
+        counts = collections.Counter(a.name for a in self.atoms)
+        return [a.name + ('_ATOM_'+str(a.index) if counts[a.name] > 1 else '') for a in self.atoms]
+
+    def atomCounts(self):
+        return {name: a.mult for name, a in zip(self.atomNames(), self.atoms)}
+
+    def defaultKpoints(self):
+        divider = 1
+        bohrToAngstrom = 1.88973
+        for size in self.cell[:3]: divider *= size/bohrToAngstrom/5
+        return int((2000//divider)+1)
+
+    # the dict used by the stages (XTLSparams['structInfo'] has the same form), every call gives a new one
+    def info(self):
+        return {'atomNamesList':self.atomNames(), 'kpoints':self.defaultKpoints(), 'atomCounts':self.atomCounts()}
+
+# parsed structures by content hash: runs and stages read the same struct files again and again
+structures = {}
+structuresLock = threading.Lock()
+def readStructure(structFile):
+    with open(structFile, 'r') as f: content = f.read()
+    key = hashlib.sha1(content.encode('utf8')).hexdigest()
+    with structuresLock:
+        if key not in structures: structures[key] = Structure.parse(content)
+        return structures[key]
+
 def parseStructFile(structFile):
-    #Serch names of atoms in struct file
-    with open(structFile, 'r') as myfile: structFileContent = myfile.read()
-    atomNamesList = re.findall(r'[\n\s]+(\D\s?\S*)\s+NPT', structFileContent, flags = re.IGNORECASE)
-    atomNamesList = list(map(lambda a: a.strip(), atomNamesList))
-    
-    atomNumbers = re.findall(r'ATOM\s+\-?(\d+)\:', structFileContent, flags = re.IGNORECASE)
-    assert len(atomNumbers) == len(atomNamesList)
-    
-    atomNamesList1 = []
-    for i in range(len(atomNamesList)):
-        if atomNamesList.count(atomNamesList[i]) > 1:
-            atomNamesList1.append(atomNamesList[i]+'_ATOM_'+atomNumbers[i])
-        else:
-            atomNamesList1.append(atomNamesList[i])
-    atomNamesList = atomNamesList1
-    
-    #count the number of each atom
-    counts = re.findall(r'[.*\s][-\s]+(\d+)[:+]', structFileContent, flags = re.IGNORECASE)
-    
-    #make elements in counts list integers, not string for correct sort in np.unique
-    for i in range(len(counts)):
-        counts[i] = int(counts[i])
-        
-    unique, unique_counts = np.unique(counts, return_counts=True)
-    assert len(unique_counts) == len(atomNamesList)
-    atomCounts={}
-    for i in range(len(atomNamesList)):
-        if atomNamesList[i] in atomCounts:
-            atomCounts[atomNamesList[i]]+=unique_counts[i]
-        else:
-            atomCounts[atomNamesList[i]]=unique_counts[i]
-    atomNamesListUnique = []
-    for a in atomNamesList:
-        if a not in atomNamesListUnique: atomNamesListUnique.append(a)
-    atomNamesList = atomNamesListUnique
-    #Count number of kpoints
-    foundRes = re.search(r'MODE OF CALC=RELA unit=bohr', structFileContent, flags = re.IGNORECASE)
-    if foundRes is None:
+    structure = readStructure(structFile)
+    if structure.mode.upper() != 'RELA' or structure.unit.lower() != 'bohr':
         raise Exception('String "MODE OF CALC=RELA unit=bohr" is absent in struct file. May be you are using another units?":\n')
-    cellSize=re.search(r'unit=.*[\s\n]*(\d+.\d+)\s+(\d+.\d+)\s+(\d+.\d+)', structFileContent, flags = re.IGNORECASE)
-    
-    divider=1
-    bohrToAngstrom=1.88973
-    for i in range(1,4):
-        divider*=float(cellSize.group(i))/bohrToAngstrom/5
-    kpoints=int((2000//divider)+1)
-    result = {'atomNamesList':atomNamesList, 'kpoints':kpoints, 'atomCounts':atomCounts}
-	
-    parse_file_log = open('parse_log.txt', 'w')
-    for information in result.keys():
-        parse_file_log.write(information + '\n')
-        parse_file_log.write(str(result[information]) +'\n')
-	
-    return result
+    return structure.info()
+
+orbitalSizes = {'s':1, 'p':3, 'd':5, 'f':7}
+
+# Order of Wannier projections and of rows of the hopping matrix in XTLS: atoms in order of atomNamesList, every
+# orbital of atomOrbitals for all equivalent positions. Returns [(atom name, orbital, [1-based positions])]
+def orbitalLayout(structInfo, atomOrbitals):
+    layout = []
+    first = 1
+    for a in structInfo['atomNamesList']:
+        positions = list(range(first, first + structInfo['atomCounts'][a]))
+        first += structInfo['atomCounts'][a]
+        if a not in atomOrbitals: continue
+        for orb in atomOrbitals[a]: layout.append((a, orb, positions))
+    return layout
 
 def getSID(workDir, w2webContext):
     if os.path.exists(workDir + '/.session'):
@@ -315,7 +1402,7 @@ def getSID(workDir, w2webContext):
         with open(workDir+'/.session', 'w') as SIDfile: SIDfile.write(SID + '\n' + sessionName)
     return SID, sessionName
 
-ignoreFiles = ['.git', '.gitignore', '.cache', '.session']
+ignoreFiles = ['.git', '.gitignore', '.cache', '.cache.lock', '.session', hashCacheFileName, outputsDirName, snapshotsDirName]
 def prepareDirectory(workDir):
     rmAllExceptIgnore(workDir)
     os.makedirs(workDir, exist_ok=True)
@@ -328,25 +1415,423 @@ def prepareDirectory(workDir):
         runCommand('git commit -m "initial commit"', workDir, tryFast = False)
         #=====================================================
 
-def mycopy(src, dst):
-    if os.path.isdir(src): shutil.copytree(src, dst)
-    else: shutil.copy(src, dst)
+# 'auto' - reflink every file if the filesystem supports it, otherwise hardlink the files
+# the stage only reads and copy the rest; 'copy' - always make full copies
+cloneModeGlobal = 'auto'
+# files of the converged SCF which DOS and Bandstructure read but never write
+scfReadOnlyPatterns = ['*.clmsum', '*.clmup', '*.clmdn', '*.vsp', '*.vspup', '*.vspdn', '*.vns', '*.vnsup', '*.vnsdn', '*.vtotal', '*.vcoul', '*.r2v']
+# files which the first program of DOS and Bandstructure (x lapw1) writes from scratch, there is no need to copy them
+scfRegeneratedPatterns = ['*.vector*', '*.energy*']
 
-def copyAllFiles(srcDir, dstDir):
-    for f in os.listdir(srcDir):
-        if (f not in ignoreFiles) and (f[0] not in ['.',':']):
-            mycopy(srcDir+'/'+f, dstDir)
+def matchesAny(fileName, patterns):
+    return any(fnmatch.fnmatch(fileName, p) for p in patterns)
 
+def mycopy(src, dst, readOnlyPatterns=[]):
+    if os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        for f in os.listdir(src): mycopy(join(src, f), join(dst, f), readOnlyPatterns)
+    elif cloneModeGlobal == 'copy': shutil.copy(src, dst)
+    elif matchesAny(os.path.basename(src), readOnlyPatterns):
+        if reflinkFile(src, dst): shutil.copymode(src, dst)
+        else:
+            # no reflinks here: share the inode, the stage doesn't write this file
+            os.unlink(dst)
+            try: os.link(src, dst)
+            # another filesystem or no hard links on it (EXDEV, EPERM)
+            except OSError: shutil.copy2(src, dst)
+    else: cloneFile(src, dst)
+
+def copyAllFiles(srcDir, dstDir, readOnlyPatterns=[], skipPatterns=[]):
+    with traceSpan('copyAllFiles', 'copy', src=srcDir, dst=dstDir):
+        for f in os.listdir(srcDir):
+            if (f not in ignoreFiles) and (f[0] not in ['.',':']) and not matchesAny(f, skipPatterns):
+                mycopy(srcDir+'/'+f, join(dstDir, f), readOnlyPatterns)
+
+# Subdirectories are cleaned the same way: nested stage folders (Wannier in Bandstructure, XTLS in Wannier)
+# keep their caches and snapshots, only directories left empty are removed
 def rmAllExceptIgnore(workDir):
     if os.path.exists(workDir):
         for f in os.listdir(workDir):      
             if f not in ignoreFiles:
+                path = workDir+'/'+f
                 #remove file
-                if os.path.isfile(workDir+'/'+f): os.unlink(workDir+'/'+f )
-                #remove directory
-                if os.path.isdir(workDir+'/'+f): shutil.rmtree(workDir+'/'+f)
+                if os.path.islink(path) or not os.path.isdir(path): os.unlink(path)
+                #clean directory
+                else:
+                    rmAllExceptIgnore(path)
+                    if len(os.listdir(path)) == 0: os.rmdir(path)
+
+# ===================================================================================================================
+# Parallel layout: how the k-points of a stage are spread over the cores. k-parallel jobs are the cheapest,
+# MPI is used only when there are fewer k-points than cores and the matrix is big enough, OpenMP threads
+# for big matrices and for idle cores. runWien2k takes the hosts from params['common']['machines']:
+# {'hosts': ['node1', 'node2'], 'coresPerHost': 32} ('auto' - the nodes of the slurm allocation or this host).
+machinesConfigGlobal = None
+mpiMinMatrixSize = 5000
+ompMinMatrixSize = 2000
+
+def countKpoints(klistFile):
+    if not os.path.exists(klistFile): return 0
+    count = 0
+    with open(klistFile, 'r') as f:
+        for line in f:
+            if line.startswith('END'): break
+            if line.strip() != '': count += 1
+    return count
+
+# Matrix size from the last lapw1 run, otherwise an estimate: number of plane waves V*Kmax^3/(6*pi^2)
+def matrixSize(workDir, caseName):
+    for ext in ['output1', 'output1up']:
+        fileName = join(workDir, caseName+'.'+ext)
+        if os.path.exists(fileName):
+            with open(fileName, 'r', errors='ignore') as f: sizes = re.findall(r'MATRIX SIZE\s*(\d+)', f.read())
+            if len(sizes) > 0: return int(sizes[-1])
+    structFile = join(workDir, caseName+'.struct')
+    in1Files = [join(workDir, caseName+ext) for ext in ['.in1c', '.in1', '.in1_st'] if os.path.exists(join(workDir, caseName+ext))]
+    if not os.path.exists(structFile) or len(in1Files) == 0: return 0
+    with open(in1Files[0], 'r') as f: rkmax = re.search(r'\(WFFIL, WFPRI, ENFIL, SUPWF\)\s+(\d+[.\d]*)', f.read())
+    try: structure = readStructure(structFile)
+    except Exception: return 0
+    rmts = [atom.rmt for atom in structure.atoms]
+    if rkmax is None or len(rmts) == 0: return 0
+    a, b, c = structure.cell[:3]
+    ca, cb, cc = [np.cos(np.radians(x)) for x in structure.cell[3:6]]
+    volume = a*b*c*np.sqrt(max(0, 1 - ca**2 - cb**2 - cc**2 + 2*ca*cb*cc))
+    # centered lattices: the primitive cell is smaller
+    volume /= {'F':4, 'B':2, 'C':2}.get(structure.lattice[:1], 1)
+    kmax = float(rkmax.group(1))/min(rmts)
+    return int(volume*kmax**3/(6*np.pi**2))
+
+def machinesHosts(config):
+    hosts = config['hosts'] if 'hosts' in config else 'auto'
+    if hosts == 'auto':
+        nodeList = os.environ.get('SLURM_JOB_NODELIST', '')
+        hosts = []
+        if nodeList != '' and shutil.which('scontrol') is not None:
+            hosts = subprocess.run(['scontrol', 'show', 'hostnames', nodeList], stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+        if len(hosts) == 0: hosts = [socket.gethostname()]
+    if 'coresPerHost' in config: coresPerHost = config['coresPerHost']
+    else: coresPerHost = int(os.environ.get('SLURM_CPUS_ON_NODE', os.cpu_count()))
+    return hosts, coresPerHost
+
+def planLayout(kpoints, size, hosts, coresPerHost, stage='SCF'):
+    kpoints = max(1, kpoints)
+    omp = 2 if size >= ompMinMatrixSize and coresPerHost >= 2 else 1
+    slots = len(hosts)*(coresPerHost//omp)
+    mpi = 1
+    if size >= mpiMinMatrixSize and kpoints < slots:
+        # idle cores go to MPI inside each k-point
+        mpi = max(1, min(coresPerHost//omp, slots//kpoints))
+    jobsPerHost = max(1, (coresPerHost//omp)//mpi)
+    kJobs = min(kpoints, jobsPerHost*len(hosts))
+    usedPerHost = -(-kJobs//len(hosts))*mpi*omp
+    if mpi == 1 and usedPerHost < coresPerHost:
+        # few k-points and a small matrix: OpenMP threads for the rest of the cores
+        omp = max(omp, min(coresPerHost//max(1, -(-kJobs//len(hosts))), 4))
+    jobs = [(hosts[i % len(hosts)], mpi) for i in range(kJobs)]
+    # w2w is k-parallel with OpenMP inside, it gets all cores of a host divided between its jobs
+    w2wThreads = max(1, coresPerHost//max(1, -(-kJobs//len(hosts))))
+    layout = {'stage':stage, 'kpoints':kpoints, 'matrixSize':size, 'jobs':jobs, 'mpi':mpi, 'omp':omp, 'w2wThreads':w2wThreads}
+    if stage == 'SCF' and size >= mpiMinMatrixSize: layout['lapw0'] = [(h, coresPerHost) for h in hosts]
+    return layout
+
+def writeMachines(workDir, layout):
+    lines = ['# ' + layout['stage'] + ': ' + str(layout['kpoints']) + ' k-points, matrix size ' + str(layout['matrixSize'])]
+    lines.append('granularity:1')
+    for host, mpi in layout['jobs']:
+        lines.append('1:' + host + (':'+str(mpi) if mpi > 1 else ''))
+    if 'lapw0' in layout: lines.append('lapw0:' + ' '.join(h+':'+str(n) for h, n in layout['lapw0']))
+    lines.append('omp_global:' + str(layout['omp']))
+    lines.append('extrafine:1')
+    with open(join(workDir, '.machines'), 'w') as f: f.write('\n'.join(lines) + '\n')
+
+# Plans the layout of a stage and writes .machines if hosts are configured
+def prepareMachines(workDir, caseName, stage, klistFile=None, runParallel=True):
+    if klistFile is None: klistFile = join(workDir, caseName+'.klist')
+    config = machinesConfigGlobal
+    if config is None: hosts, coresPerHost = [socket.gethostname()], os.cpu_count()
+    else: hosts, coresPerHost = machinesHosts(config if isinstance(config, dict) else {})
+    layout = planLayout(countKpoints(klistFile), matrixSize(workDir, caseName), hosts, coresPerHost, stage)
+    if config is None and os.path.exists(join(workDir, '.machines')):
+        # .machines made by somebody else (e.g. the run-cluster wrapper): w2w threads follow its k-parallel jobs
+        with open(join(workDir, '.machines'), 'r') as f: kJobs = len(re.findall(r'^\d+:\S+', f.read(), flags=re.MULTILINE))
+        layout['w2wThreads'] = max(1, coresPerHost//max(1, kJobs))
+    if config is not None and runParallel:
+        writeMachines(workDir, layout)
+        print('{0}: {1} k-parallel jobs x {2} MPI x {3} OpenMP'.format(stage, len(layout['jobs']), layout['mpi'], layout['omp']))
+    return layout
+
+# Watches case.scf while run_lapw is running: every iteration adds :ENE, :DIS and :FER lines.
+# The density of the iteration with the smallest charge distance is saved as case.clmsum_best (it is a part of the
+# state, so a cached run_lapw restores it too). When the charge distance diverges
+# or oscillates without progress, .stop is created and run_lapw stops after the current iteration.
+# The mixer writes case.clmsum before the :DIS line of its iteration gets to case.scf, so the density is copied only while
+# case.clmsum is older than case.scf and no later iteration has finished, and it is kept only if it didn't change during the copy.
+# The monitor runs only while run_lapw really runs and saves its state in case.scfmonitor before the output state is saved:
+# a run_lapw restored from the cache brings the state back (loadRecord) instead of judging the restored case.scf at once.
+class SCFMonitor:
+    checkpointFiles = ['clmsum', 'clmup', 'clmdn']
+    checkpointSuffix = '_best'
+
+    def __init__(self, workDir, caseName, pollInterval=5, minIterations=5, divergeIterations=3, divergeFactor=10, oscillationWindow=8, oscillationChanges=6):
+        self.workDir = workDir
+        self.caseName = caseName
+        self.scfFile = join(workDir, caseName+'.scf')
+        self.stopFile = join(workDir, '.stop')
+        self.recordFile = join(workDir, caseName+'.scfmonitor')
+        self.pollInterval = pollInterval
+        self.minIterations = minIterations
+        self.divergeIterations = divergeIterations
+        self.divergeFactor = divergeFactor
+        self.oscillationWindow = oscillationWindow
+        self.oscillationChanges = oscillationChanges
+        # run_lapw appends to case.scf, only the new part is read
+        self.offset = os.path.getsize(self.scfFile) if os.path.exists(self.scfFile) else 0
+        self.partial = ''
+        self.iterations = []
+        self.current = None
+        self.best = None
+        # best iteration whose density is not saved yet, and the saved one
+        self.pending = None
+        self.checkpoint = None
+        self.problem = None
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if os.path.exists(self.stopFile): os.remove(self.stopFile)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None: return
+        self.stopEvent.set()
+        self.thread.join()
+        self.thread = None
+        if os.path.exists(self.stopFile): os.remove(self.stopFile)
+        self.saveRecord()
+
+    def saveRecord(self):
+        record = {'iterations': self.iterations, 'best': self.best, 'checkpoint': self.checkpoint, 'problem': self.problem}
+        with open(self.recordFile, 'w') as f: json.dump(record, f)
+
+    def loadRecord(self):
+        if not os.path.exists(self.recordFile): return
+        with open(self.recordFile, 'r') as f: record = json.load(f)
+        self.iterations = record['iterations']
+        self.best = record['best']
+        self.checkpoint = record['checkpoint']
+        self.problem = record['problem']
+
+    def run(self):
+        while not self.stopEvent.wait(self.pollInterval): self.poll()
+        self.poll()
+
+    def poll(self):
+        if not os.path.exists(self.scfFile): return
+        with open(self.scfFile, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+        lines = (self.partial + data.decode('utf8', 'ignore')).split('\n')
+        self.partial = lines.pop()
+        for line in lines: self.parseLine(line)
+        if self.pending is not None: self.saveCheckpoint()
+
+    def checkpointStats(self):
+        stats = {}
+        for ext in self.checkpointFiles:
+            src = join(self.workDir, self.caseName+'.'+ext)
+            if os.path.exists(src):
+                st = os.stat(src)
+                stats[ext] = (st.st_size, st.st_mtime_ns)
+        return stats
+
+    # between iterations only: case.scf is read to the end and the mixer of the next iteration hasn't written case.clmsum yet
+    def betweenIterations(self, stats):
+        scf = os.stat(self.scfFile)
+        if scf.st_size != self.offset or 'clmsum' not in stats: return False
+        return all(mtime <= scf.st_mtime_ns for size, mtime in stats.values())
+
+    def saveCheckpoint(self):
+        iteration = self.pending
+        stats = self.checkpointStats()
+        if not self.betweenIterations(stats): return
+        files = {}
+        for ext in stats:
+            src = join(self.workDir, self.caseName+'.'+ext)
+            with open(src, 'rb') as f: data = f.read()
+            with open(src + self.checkpointSuffix + '.tmp', 'wb') as f: f.write(data)
+            files[ext] = [len(data), hashlib.sha1(data).hexdigest()]
+        # torn or newer copy: tried again on the next poll, until the next iteration finishes
+        if self.checkpointStats() != stats or not self.betweenIterations(stats) or any(files[ext][0] != stats[ext][0] for ext in stats):
+            for ext in stats: os.remove(join(self.workDir, self.caseName+'.'+ext + self.checkpointSuffix + '.tmp'))
+            return
+        for ext in self.checkpointFiles:
+            dst = join(self.workDir, self.caseName+'.'+ext + self.checkpointSuffix)
+            if ext in files: os.replace(dst + '.tmp', dst)
+            elif os.path.exists(dst): os.remove(dst)
+        self.checkpoint = {'iteration': iteration, 'files': files}
+        self.pending = None
+
+    def validCheckpoint(self):
+        if self.checkpoint is None: return False
+        for ext, (size, sha1) in self.checkpoint['files'].items():
+            fileName = join(self.workDir, self.caseName+'.'+ext + self.checkpointSuffix)
+            if not os.path.exists(fileName) or os.path.getsize(fileName) != size: return False
+            with open(fileName, 'rb') as f:
+                if hashlib.sha1(f.read()).hexdigest() != sha1: return False
+        return True
+
+    def parseLine(self, line):
+        m = re.match(r':ITE(\d+):', line)
+        if m is not None:
+            self.current = {'iteration': int(m.group(1))}
+            return
+        if self.current is None: return
+        numbers = re.findall(r'[-+]?\d+\.\d+(?:[eE][-+]?\d+)?', line)
+        if len(numbers) == 0: return
+        for label, key in [(':ENE', 'ene'), (':DIS', 'dis'), (':FER', 'fer')]:
+            if line.startswith(label): self.current[key] = float(numbers[-1])
+        if 'ene' in self.current and 'dis' in self.current:
+            self.iterationDone(self.current)
+            self.current = None
+
+    def iterationDone(self, iteration):
+        self.iterations.append(iteration)
+        print('{0}: iteration {1}  ENE = {2}  DIS = {3}  FER = {4}'.format(self.caseName, iteration['iteration'], iteration['ene'], iteration['dis'], iteration.get('fer', '')))
+        if self.best is None or iteration['dis'] < self.best['dis']: self.best = iteration
+        # case.clmsum is the density of the last iteration only, earlier ones can't be saved any more
+        self.pending = iteration if self.best is iteration else None
+        problem = self.check()
+        if problem is not None and self.problem is None:
+            self.problem = problem
+            print('{0}: charge distance is {1}, stopping SCF after the current iteration'.format(self.caseName, problem))
+            with open(self.stopFile, 'w') as f: pass
 
-def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams, kpoints, rkmax = 0, lstart_energy = 0, efmod='TETRA', ef_eval=None, iqtlsave=False):
+    def check(self):
+        dis = [it['dis'] for it in self.iterations]
+        if len(dis) < self.minIterations: return None
+        last = dis[-(self.divergeIterations+1):]
+        if all(b > a for a, b in zip(last, last[1:])) and dis[-1] > self.divergeFactor*min(dis): return 'diverging'
+        if len(dis) > self.oscillationWindow:
+            window = np.array(dis[-self.oscillationWindow:])
+            signs = np.sign(np.diff(window))
+            changes = np.sum(signs[1:] != signs[:-1])
+            if changes >= self.oscillationChanges and window.min() >= min(dis[:-self.oscillationWindow]): return 'oscillating'
+        return None
+
+    # back to the saved density with half the mixing factor and without Broyden history
+    def restartFromBest(self):
+        if not self.validCheckpoint(): raise Exception('Error: no valid checkpoint of the SCF density in '+self.workDir)
+        for ext in self.checkpointFiles:
+            dst = join(self.workDir, self.caseName+'.'+ext)
+            if ext in self.checkpoint['files']: shutil.copyfile(dst + self.checkpointSuffix, dst)
+            elif os.path.exists(dst): os.remove(dst)
+        inmFile = join(self.workDir, self.caseName+'.inm')
+        with open(inmFile, 'r') as f: lines = f.read().split('\n')
+        # second line of case.inm: mixing factor for BROYD/PRATT scheme
+        factor = float(lines[1].split()[0])
+        lines[1] = re.sub(r'^(\s*)\S+', '\g<1>{0:.3f}'.format(factor/2), lines[1])
+        with open(inmFile, 'w') as f: f.write('\n'.join(lines))
+        for fileName in glob.glob(join(self.workDir, self.caseName+'.broyd*')): os.remove(fileName)
+        iteration = self.checkpoint['iteration']
+        print('{0}: restart from iteration {1} (DIS = {2}) with mixing factor {3:.3f}'.format(self.caseName, iteration['iteration'], iteration['dis'], factor/2))
+
+# In-process versions of the w2web structure and init steps of SCF (SCFparams['init'] = 'native', w2web stays as the fallback).
+# For an existing .struct file StructGen only shows it in a form and saves it back, the only change comes from
+# structrmt.pl: RMTs of setrmt_lapw with reduction 0, case.struct_setrmt becomes case.struct (structend.pl removes it).
+def nativeStructure(workDir, fileName):
+    structFile = workDir+'/'+fileName+'.struct'
+    # errors of the struct file: the form of structgen.pl would be broken
+    readStructure(structFile)
+    output = runCommand('setrmt_lapw '+fileName+' -r 0', workDir)
+    if not notEmpty(workDir+'/'+fileName+'.struct_setrmt'):
+        raise Exception('Error while executing command "setrmt_lapw '+fileName+' -r 0":\n'+output)
+    shutil.copyfile(workDir+'/'+fileName+'.struct_setrmt', structFile)
+    os.remove(workDir+'/'+fileName+'.struct_setrmt')
+    readStructure(structFile)
+
+# inputs written by x lstart and the files initlapw phase 15 makes of them (sessions of w2auto are always complex)
+initInputs = {'in0_st':'in0', 'in1_st':'in1c', 'in2_st':'in2c', 'inc_st':'inc', 'inm_st':'inm'}
+
+# phase 10 - after x lstart, 15 - after x kgen: the _st inputs become the inputs of the SCF cycle, 20 - after x dstart.
+# Phases 10 and 20 only move the w2web session on, here the files of their steps are checked.
+def nativeInitPhase(workDir, fileName, phase):
+    if phase == '10': required = list(initInputs.keys())
+    elif phase == '15': required = list(initInputs.keys()) + ['klist']
+    elif phase == '20': required = list(initInputs.values()) + ['klist', 'clmsum']
+    else: raise Exception('Error: unknown init phase ' + str(phase))
+    missing = [fileName+'.'+ext for ext in required if not notEmpty(workDir+'/'+fileName+'.'+ext)]
+    if len(missing) > 0:
+        raise Exception('Error in init phase '+phase+', files are missing or empty: '+', '.join(missing))
+    if phase == '15':
+        for st, dst in initInputs.items():
+            shutil.copyfile(workDir+'/'+fileName+'.'+st, workDir+'/'+fileName+'.'+dst)
+
+# field index (whitespace separated) of the line set to value, right-aligned in the width of the old field
+def setInputField(line, index, value):
+    fields = list(re.finditer(r'\s*\S+', line))
+    if index >= len(fields): raise Exception('Error: field {0} is expected in line "{1}"'.format(index+1, line))
+    start, end = fields[index].span()
+    text = str(value)
+    text = text.rjust(end-start) if len(text) < end-start else ' '+text
+    return line[:start] + text + line[end:]
+
+# settings of phase 15 in the inputs of the SCF cycle (0 or None - as lstart wrote them):
+# case.in1(c) line 2 - RKmax and lmax, K-VECTORS line - de of emax=Ef+de (Ry), case.inm line 2 - mixing factor
+def editInitInputs(workDir, fileName, rkmax=0, lmax=None, emax=None, mix=None):
+    in1Files = [workDir+'/'+fileName+ext for ext in ['.in1c', '.in1'] if os.path.exists(workDir+'/'+fileName+ext)]
+    if (rkmax != 0 or lmax is not None or emax is not None) and len(in1Files) == 0:
+        raise Exception('Error: there is no '+fileName+'.in1c or '+fileName+'.in1 in '+workDir)
+    for in1File in in1Files:
+        with open(in1File, 'r') as f: lines = f.read().split('\n')
+        if rkmax != 0:
+            print('correcting:', in1File)
+            lines[1] = setInputField(lines[1], 0, rkmax)
+        if lmax is not None: lines[1] = setInputField(lines[1], 1, lmax)
+        if emax is not None:
+            kLines = [i for i, line in enumerate(lines) if line.startswith('K-VECTORS')]
+            if len(kLines) == 0: raise Exception('Error: there is no K-VECTORS line in '+in1File)
+            # K-VECTORS FROM UNIT:4   emin   de   nband
+            lines[kLines[0]] = setInputField(lines[kLines[0]], 4, emax)
+        with open(in1File, 'w') as f: f.write('\n'.join(lines))
+    if mix is not None:
+        inmFile = workDir+'/'+fileName+'.inm'
+        with open(inmFile, 'r') as f: lines = f.read().split('\n')
+        lines[1] = setInputField(lines[1], 0, mix)
+        with open(inmFile, 'w') as f: f.write('\n'.join(lines))
+
+# run_lapw watched by SCFMonitor, restarted from the best density when the charge distance diverges or oscillates
+def runLapwCycles(workDir, fileName, lapwParams, parallel, runCommandPrefix):
+    # lapwParams['monitor']: False or parameters of SCFMonitor
+    monitorParams = lapwParams['monitor'] if 'monitor' in lapwParams else {}
+    maxRestarts = lapwParams['maxRestarts'] if 'maxRestarts' in lapwParams else 2
+    iterNum = lapwParams['iterNum']
+    restarts = 0
+    while True:
+        cmd = 'run_lapw -i '+str(iterNum)+' -ec '+str(lapwParams['ec']) + parallel
+        # show the progress of the cycles and don't wait for the other iterations after a program of the cycle has failed
+        matchers = [OutputMatcher(r'^\s*cycle\s+\d+', callback=lambda line: print(fileName+': '+line.strip())),
+                    OutputMatcher(r'stop error', fatal=True)]
+        monitor = SCFMonitor(workDir, fileName, **monitorParams) if monitorParams is not False else None
+        # the record of the previous run_lapw is not a part of the input state
+        if monitor is not None and os.path.exists(monitor.recordFile): os.remove(monitor.recordFile)
+        try: output = runCommand(cmd, workDir=workDir, prefix=runCommandPrefix, matchers=matchers, monitor=monitor)
+        finally:
+            if monitor is not None: monitor.stop()
+        if monitor is None: break
+        # saved by the monitor itself or restored from the cache together with the output state
+        monitor.loadRecord()
+        if monitor.problem is None: break
+        iterNum -= len(monitor.iterations)
+        if restarts >= maxRestarts or iterNum <= 0 or not monitor.validCheckpoint():
+            raise Exception('Energy in SCF NOT CONVERGED: charge distance is '+monitor.problem+' after '+str(restarts)+' restarts')
+        restarts += 1
+        monitor.restartFromBest()
+    return output, cmd
+
+def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams, kpoints, rkmax = 0, lstart_energy = 0, efmod='TETRA', ef_eval=None, iqtlsave=False, init='native', lmax=None, emax=None, mix=None):
     print('SCF running...')
     parentDir = w2webContext['caseBaseDir']
     fileName, fileExtension = os.path.splitext(structureFile0)
@@ -354,12 +1839,18 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
     structureFile = fileName+fileExtension
     workDir = parentDir + '/' + fileName
     
+    if init not in ['native', 'w2web']: raise Exception('Error: unknown init ' + str(init))
     prepareDirectory(workDir)
-    SID, sessionName = getSID(workDir, w2webContext)
-
     assert os.path.exists(structureFile0), 'File '+structureFile0+' doesn\'t exist'
+    # cif files are converted by structask.pl only, their structure steps go through w2web
+    nativeStruct = init == 'native' and fileExtension == '.struct'
+    if not nativeStruct or init == 'w2web': SID, sessionName = getSID(workDir, w2webContext)
+
     shutil.copyfile(structureFile0, workDir+'/'+structureFile)
    
+    def initlapw(params):
+        if init == 'native': nativeInitPhase(workDir, fileName, params['phase'])
+        else: runW2webCommand('/exec/initlapw.pl', dict({'SID':SID}, **params), w2webContext, workDir, method='GET')
 
     def saveStructure(output):
         foundRes = re.findall(r'INPUT.*?NAME=\"(.*?)\".*?VALUE=\"(.*?)\"', output, flags = re.IGNORECASE)
@@ -385,7 +1876,8 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
     
     
     #======================== struct ======================================
-    if fileExtension=='.cif':
+    if nativeStruct: nativeStructure(workDir, fileName)
+    elif fileExtension=='.cif':
         output = runW2webCommand('/util/structask.pl', {'SID':SID}, w2webContext, workDir, method='GET')
         output = runW2webCommand('/util/structask.pl', {'SID':SID, 'DIR':workDir, 'doit':'1', 'NAME':fileName, 'complex':'CHECKED', 'numatoms':'2', 'ciffil':structureFile, 'TIME':'Wed Oct  3 16:14:37 2018', 'ALERT':'', 'spinpol':'', 'afm':'', 'p':'', 'COMMENT':'', 'SESSION_EXPERT_RED':'', 'SESSION_EXPERT_VXC':'', 'SESSION_EXPERT_ECUT':'', 'SESSION_EXPERT_RKMAX':'', 'SESSION_EXPERT_FERMIT':'', 'SESSION_EXPERT_MIX':'', 'SESSION_EXPERT_NUMK':''}, w2webContext, workDir, method='POST')
         shutil.copyfile(structureFile0, workDir+'/'+structureFile)
@@ -393,18 +1885,19 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
         assert fileExtension=='.struct', 'Use only .cif or .struct files'
         output = runW2webCommand('/util/structstart.pl', {'SID':SID}, w2webContext, workDir, method='GET')
 
-    output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
-    
-    output = saveStructure(output)
-    
-    output = runW2webCommand('/util/structrmt.pl', 'doit=1&SID='+SID+'&reduc=0&orig=', w2webContext, workDir, method='POST')
-    output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
-    
-    #  Save structure
-    output = saveStructure(output)
-    # save file and clean up (when you are done)
-    output = runW2webCommand('/util/structend.pl', {'SID':SID}, w2webContext, workDir, method='GET')
-    output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
+    if not nativeStruct:
+        output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
+        
+        output = saveStructure(output)
+        
+        output = runW2webCommand('/util/structrmt.pl', 'doit=1&SID='+SID+'&reduc=0&orig=', w2webContext, workDir, method='POST')
+        output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
+        
+        #  Save structure
+        output = saveStructure(output)
+        # save file and clean up (when you are done)
+        output = runW2webCommand('/util/structend.pl', {'SID':SID}, w2webContext, workDir, method='GET')
+        output = runW2webCommand('/util/structgen.pl', {'SID':SID}, w2webContext, workDir, method='GET')
             
     #x nn
     enters = "\n"*22
@@ -447,21 +1940,7 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
         print('ERROR in command "x lstart".\nPlease, correct energy level for "x lstart" command!\nCurrent energy level is ', energy)
         exit(0)
     
-    output = runW2webCommand('/exec/initlapw.pl', {'SID':SID,'phase':'10'}, w2webContext, workDir, method='GET')
-    
-    #Set RKMAX parameter
-    if rkmax!=0:
-        current_file = fileName + '.in1_st'
-        if os.path.exists(workDir + '/' + current_file):
-            print('correcting:',workDir + '/' + current_file)
-            with open(workDir + '/' + current_file, 'r') as file_in:
-                fileContent = file_in.read()
-            result = re.sub(pattern = r'(.*\(WFFIL, WFPRI, ENFIL, SUPWF\)\s+)(\d+[.\d]*)', repl = '\g<1>' + str(rkmax), string = fileContent)
-            with open(workDir + '/' + current_file, 'w') as file_out:
-                file_out.write(result)
-        else:
-            print('ERROR: file ' + fileName + '.in1_st does not exist!')
-            exit(0)
+    initlapw({'phase':'10'})
     
     #Change EF-method
     if efmod != 'TETRA':
@@ -495,7 +1974,9 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
     # x kgen
     output = runCommand("echo ' \n"+str(structInfo['kpoints'])+"\n\n\n\n\n1"+enters+"' | x kgen", workDir)
             
-    output = runW2webCommand('/exec/initlapw.pl', {'SID':SID,'phase':'15', 'doit':'1'}, w2webContext, workDir, method='GET')
+    initlapw({'phase':'15', 'doit':'1'})
+    #Set RKMAX, LMAX, EMAX and mixing factor
+    editInitInputs(workDir, fileName, rkmax, lmax, emax, mix)
 
     #x dstart
     output = runCommand("x dstart", workDir)
@@ -520,32 +2001,33 @@ def SCF(structureFile0, w2webContext, runParallel, runCommandPrefix, lapwParams,
         raise Exception('File ' + current_file + ' was not found!')
     
     
-    output = runW2webCommand('/exec/initlapw.pl', {'SID':SID,'phase':'20'}, w2webContext, workDir, method='GET')
+    initlapw({'phase':'20'})
             
     #For BaCoP2O7 change *.in1 file to correct
     if fileName=='BaCoP2O7':
         shutil.copyfile('BaCoP2O7.in1', workDir+'/BaCoP2O7.in1')
     parallel = ' -p' if runParallel else ''
-    cmd = 'run_lapw -i '+str(lapwParams['iterNum'])+' -ec '+str(lapwParams['ec']) + parallel
-    output = runCommand(cmd, workDir=workDir, prefix=runCommandPrefix)
+    prepareMachines(workDir, fileName, 'SCF', runParallel=runParallel)
+    output, cmd = runLapwCycles(workDir, fileName, lapwParams, parallel, runCommandPrefix)
     if output.find('energy in SCF NOT CONVERGED')>=0:
         raise Exception('Energy in SCF NOT CONVERGED')
     if output.lower().find('error')>=0:
         raise Exception('Error while executing command '+cmd+':\n'+output)
     return workDir
 
-def DOS(workDirSCF, w2webContext, runParallel, runCommandPrefix, xmin=None):
+def DOS(workDirSCF, w2webContext, runParallel, runCommandPrefix, xmin=None, mode='batch', workers=4, plot=True):
     print('DOS running...')
     parentFolder = os.path.dirname(workDirSCF)
     taskName = os.path.basename(workDirSCF)
     workDir = parentFolder + '/' + taskName + '_DOS'
     workDir += '/' + taskName
     prepareDirectory(workDir)
-    copyAllFiles(workDirSCF, workDir)
+    copyAllFiles(workDirSCF, workDir, scfReadOnlyPatterns, scfRegeneratedPatterns)
     SID, sessionName = getSID(workDir, w2webContext)
     
     #x lapw1
     parallel = ' -p' if runParallel else ''
+    prepareMachines(workDir, taskName, 'DOS', runParallel=runParallel)
     output = runCommand("echo ''|x lapw1"+parallel, workDir=workDir, prefix=runCommandPrefix)
     if (output.lower().find('error')>=0) or notEmpty(workDir+'/lapw1.error'):
         with open(workDir+'/lapw1.error', 'r') as myfile: error = myfile.read()
@@ -562,68 +2044,141 @@ def DOS(workDirSCF, w2webContext, runParallel, runCommandPrefix, xmin=None):
     # Configure input-file, command: "configure taskName.inp"
     structInfo = w2webContext['structInfo']
     atomNumb=len(structInfo['atomNamesList'])
-    enters = "\n"*22
+    atomConfigs = [str(atomIndex+1) + " tot,s,p,d" for atomIndex in range(atomNumb)]
+    picNames = [structInfo['atomNamesList'][atomIndex]+'_'+str(atomIndex) for atomIndex in range(atomNumb)]
 
     picDir = workDir+'/pics'
     if os.path.exists(picDir): shutil.rmtree(picDir)
     os.makedirs(picDir, exist_ok=True)
-            
-    #Draw DOS plot
-    def drawDOSPlot(atomIndex):
-        config = str(atomIndex+1) + " tot,s,p,d"
-        output = runCommand("echo '"+enters+"'|configure_int_lapw -b total "+config+" end", workDir)
-        
-        #Extend boundary of DOS plots
-        current_file = taskName + '.int'
-        if os.path.exists(workDir + '/' + current_file):
-            with open(workDir + '/' + current_file, 'r') as file_in:
-                fileContent = file_in.read()
-            result = re.sub(pattern = r'^\W+(-[.\d]+)(\W+[\d.]+\W+[\d.]+.*#Emin)', repl = ' -1.50\g<2>', string = fileContent, flags=re.MULTILINE)
-            result = re.sub(pattern = r'(^\W+-[.\d]+\W+[\d.]+\W+)([\d.]+)(.*#Emin)', repl = '\g<1>1.500\g<3>', string = result, flags=re.MULTILINE)
-            with open(workDir + '/' + current_file, 'w') as file_out:
-                file_out.write(result)
-            
-        # x tetra
+
+    if not plot:
+        # figures are drawn later from the .dos* files of all atoms (plotBackend 'native')
+        configureDOS(workDir, taskName, " ".join(atomConfigs))
         output = runCommand("echo ''|x tetra", workDir)
+    elif mode == 'perAtom':
+        for atomIndex in range(atomNumb):
+            configureDOS(workDir, taskName, atomConfigs[atomIndex])
+            output = runCommand("echo ''|x tetra", workDir)
+            drawDOSPlot(workDir, SID, sessionName, w2webContext, xmin, picDir, picNames[atomIndex])
+    elif mode == 'parallel':
+        # every atom in its own scratch copy of workDir, so configure/tetra/dos.pl of different atoms don't interfere
+        def atomDOS(atomIndex):
+            scratchDir = workDir + '/atoms/' + str(atomIndex+1)
+            prepareDirectory(scratchDir)
+            copyAllFiles(workDir, scratchDir, skipPatterns=['atoms', 'pics', '*.vector*'])
+            scratchSID, scratchSessionName = getSID(scratchDir, w2webContext)
+            configureDOS(scratchDir, taskName, atomConfigs[atomIndex])
+            output = runCommand("echo ''|x tetra", scratchDir)
+            drawDOSPlot(scratchDir, scratchSID, scratchSessionName, w2webContext, xmin, picDir, picNames[atomIndex])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for future in [executor.submit(atomDOS, atomIndex) for atomIndex in range(atomNumb)]: future.result()
+    else:
+        # one case.int with all atoms and one x tetra, then every atom is plotted from the same .dos* files
+        configureDOS(workDir, taskName, " ".join(atomConfigs))
+        output = runCommand("echo ''|x tetra", workDir)
+        dosFiles = readDOSFiles(workDir, taskName)
+        try:
+            for atomIndex in range(atomNumb):
+                # total + tot,s,p,d of the atom: the same columns x tetra gives for a single atom
+                writeDOSView(workDir, taskName, dosFiles, [0] + [1+4*atomIndex+i for i in range(4)])
+                drawDOSPlot(workDir, SID, sessionName, w2webContext, xmin, picDir, picNames[atomIndex])
+        finally:
+            restoreDOSFiles(workDir, dosFiles)
+    return workDir
+
+def configureDOS(workDir, taskName, config):
+    enters = "\n"*22
+    output = runCommand("echo '"+enters+"'|configure_int_lapw -b total "+config+" end", workDir)
+    
+    #Extend boundary of DOS plots
+    current_file = taskName + '.int'
+    if os.path.exists(workDir + '/' + current_file):
+        with open(workDir + '/' + current_file, 'r') as file_in:
+            fileContent = file_in.read()
+        result = re.sub(pattern = r'^\W+(-[.\d]+)(\W+[\d.]+\W+[\d.]+.*#Emin)', repl = ' -1.50\g<2>', string = fileContent, flags=re.MULTILINE)
+        result = re.sub(pattern = r'(^\W+-[.\d]+\W+[\d.]+\W+)([\d.]+)(.*#Emin)', repl = '\g<1>1.500\g<3>', string = result, flags=re.MULTILINE)
+        with open(workDir + '/' + current_file, 'w') as file_out:
+            file_out.write(result)
+
+#Draw DOS plot
+def drawDOSPlot(workDir, SID, sessionName, w2webContext, xmin, picDir, fileName):
+    xmin_str = str(xmin) if xmin is not None else '-10'
+    params={'xmin':xmin_str, 'xmax':'10', 'ymin':'', 'ymax':'', 'doit':'1', 'plot':'1', 'dos_col1':'1', 'NAME':sessionName, 'SID':SID,'HOSTNODE':'', 'DIR':workDir, 'ALERT':'', 'TIME':'Wed Oct  3 16:14:37 2018', 'spinpol':'', 'afm':'', 'complex':'', 'p':'', 'COMMENT':'', 'SESSION_EXPERT_RED':'', 'SESSION_EXPERT_VXC':'', 'SESSION_EXPERT_ECUT':'', 'SESSION_EXPERT_RKMAX':'', 'SESSION_EXPERT_FERMIT':'', 'SESSION_EXPERT_MIX':'', 'SESSION_EXPERT_NUMK':'', 'units':'1', 'color':'1', 'dos_lsize':'24'}
+    for i in range(4):
+        params['dos_col'+str(i+1)] = str(2+i)
         
-        xmin_str = str(xmin) if xmin is not None else '-10'
-        params={'xmin':xmin_str, 'xmax':'10', 'ymin':'', 'ymax':'', 'doit':'1', 'plot':'1', 'dos_col1':'1', 'NAME':sessionName, 'SID':SID,'HOSTNODE':'', 'DIR':workDir, 'ALERT':'', 'TIME':'Wed Oct  3 16:14:37 2018', 'spinpol':'', 'afm':'', 'complex':'', 'p':'', 'COMMENT':'', 'SESSION_EXPERT_RED':'', 'SESSION_EXPERT_VXC':'', 'SESSION_EXPERT_ECUT':'', 'SESSION_EXPERT_RKMAX':'', 'SESSION_EXPERT_FERMIT':'', 'SESSION_EXPERT_MIX':'', 'SESSION_EXPERT_NUMK':'', 'units':'1', 'color':'1', 'dos_lsize':'24'}
-        for i in range(4):
-            params['dos_col'+str(i+1)] = str(2+i)
-            
-        params['dos_label1']=''
-        params['dos_linetyp1']='1'
-        params['dos_linewidth1']='1'
-        
-        output = runW2webCommand('/exec/dos.pl', params, w2webContext, workDir, method='POST')
-        
-        foundRes=re.search(r'\<IMG\s+SRC=(/tmp/.*?.png)', output, flags = re.IGNORECASE)
-        img = foundRes.group(1)
-        img = w2webContext['w2webInstallFolder']+img
-        ps = os.path.splitext(img)[0]+'.ps'
-        #fileName = 'total' if atomIndex<0 else atoms[atomIndex]
-        fileName = 'total' if atomIndex<0 else structInfo['atomNamesList'][atomIndex]+'_'+str(atomIndex)
-        if os.path.exists(img): shutil.copy(img, picDir+'/'+fileName+'.png')
-        else: print('Warning: file '+img+' doesn\'t exist')
-        if os.path.exists(ps): shutil.copy(ps, picDir+'/'+fileName+'.ps')
-        else: print('Warning: file '+ps+' doesn\'t exist')
-        
-    for atomIndex in range(0,atomNumb): drawDOSPlot(atomIndex)
+    params['dos_label1']=''
+    params['dos_linetyp1']='1'
+    params['dos_linewidth1']='1'
+    
+    output = runW2webCommand('/exec/dos.pl', params, w2webContext, workDir, method='POST')
+    
+    foundRes=re.search(r'\<IMG\s+SRC=(/tmp/.*?.png)', output, flags = re.IGNORECASE)
+    img = foundRes.group(1)
+    img = w2webContext['w2webInstallFolder']+img
+    ps = os.path.splitext(img)[0]+'.ps'
+    if os.path.exists(img): shutil.copy(img, picDir+'/'+fileName+'.png')
+    else: print('Warning: file '+img+' doesn\'t exist')
+    if os.path.exists(ps): shutil.copy(ps, picDir+'/'+fileName+'.ps')
+    else: print('Warning: file '+ps+' doesn\'t exist')
+
+# x tetra splits its columns into case.dos1, case.dos2, ... (and the same *ev files).
+# Returns {suffix: (header lines, column labels, data with energy in the first column)} and the original file contents.
+def readDOSFiles(workDir, taskName):
+    dosFiles = {'taskName':taskName, 'original':{}, 'data':{}}
+    for suffix in ['', 'ev']:
+        k = 1
+        header = None
+        labels = []
+        columns = []
+        while os.path.exists(join(workDir, taskName+'.dos'+str(k)+suffix)):
+            fileName = join(workDir, taskName+'.dos'+str(k)+suffix)
+            with open(fileName, 'r') as f: content = f.read()
+            dosFiles['original'][fileName] = content
+            headerLines = [l for l in content.split('\n') if l.startswith('#')]
+            data = np.loadtxt(StringIO(content), comments='#', ndmin=2)
+            if header is None:
+                header = headerLines
+                columns.append(data[:,:1])
+            if len(headerLines) > 0: labels += headerLines[-1].lstrip('#').split()[1:]
+            columns.append(data[:,1:])
+            k += 1
+        if header is not None:
+            dosFiles['data'][suffix] = (header, labels, np.hstack(columns))
+    return dosFiles
 
-def Bandstructure(workDirSCF, klist_band_file, w2webContext, runParallel, runCommandPrefix, efmod='TETRA'):
+def writeDOSView(workDir, taskName, dosFiles, columnIndices):
+    for fileName in dosFiles['original']:
+        if os.path.exists(fileName): os.remove(fileName)
+    for suffix, (header, labels, data) in dosFiles['data'].items():
+        header = list(header)
+        if len(header) > 0:
+            header = [re.sub(r'NDOS=\s*\d+', 'NDOS= '+str(len(columnIndices)), l) for l in header]
+            if len(labels) == data.shape[1]-1:
+                header[-1] = '#' + ' '.join([header[-1].lstrip('#').split()[0]] + [labels[i] for i in columnIndices])
+        with open(join(workDir, taskName+'.dos1'+suffix), 'w') as f:
+            for l in header: f.write(l+'\n')
+            np.savetxt(f, data[:, [0]+[1+i for i in columnIndices]], fmt='%12.6f')
+
+def restoreDOSFiles(workDir, dosFiles):
+    for fileName, content in dosFiles['original'].items():
+        with open(fileName, 'w') as f: f.write(content)
+
+def Bandstructure(workDirSCF, klist_band_file, w2webContext, runParallel, runCommandPrefix, efmod='TETRA', plot=True):
     print('Bandstructure running...')
     parentFolder = os.path.dirname(workDirSCF)
     taskName = os.path.basename(workDirSCF)
     workDir = parentFolder + '/' + taskName + '_Bandstructure'
     workDir += '/' + taskName
     prepareDirectory(workDir)
-    copyAllFiles(workDirSCF, workDir)
+    copyAllFiles(workDirSCF, workDir, scfReadOnlyPatterns, scfRegeneratedPatterns)
     SID, sessionName = getSID(workDir, w2webContext)
 
     shutil.copy(klist_band_file, workDir+'/'+taskName+'.klist_band')
     
     # x lapw1 -band
     parallel = ' -p' if runParallel else ''
+    prepareMachines(workDir, taskName, 'BAND', workDir+'/'+taskName+'.klist_band', runParallel)
     output = runCommand("echo ''|x lapw1 -band"+parallel, workDir=workDir, prefix=runCommandPrefix)
         
     if (output.lower().find('error')>=0) or notEmpty(workDir+'/lapw1.error'):
@@ -664,6 +2219,7 @@ def Bandstructure(workDirSCF, klist_band_file, w2webContext, runParallel, runCom
     
     # x spaghetti
     output = runCommand("echo ''|x spaghetti"+parallel, workDir)
+    if not plot: return workDir
         
     output = runW2webCommand('/exec/band.pl', {'doit':'1', 'plot':'1', 'NAME':sessionName, 'SID':SID,'HOSTNODE':'', 'DIR':workDir, 'ALERT':'', 'TIME':'Wed Oct  3 16:14:37 2018', 'spinpol':'', 'afm':'', 'complex':'', 'p':'', 'COMMENT':'', 'SESSION_EXPERT_RED':'', 'SESSION_EXPERT_VXC':'', 'SESSION_EXPERT_ECUT':'', 'SESSION_EXPERT_RKMAX':'', 'SESSION_EXPERT_FERMIT':'', 'SESSION_EXPERT_MIX':'', 'SESSION_EXPERT_NUMK':''}, w2webContext, workDir, method='POST')
         
@@ -681,7 +2237,60 @@ def analyseDOS(workDirDOS):
     dosInfo = {'energyInterval':[-11,2], 'atomOrbitals':{'FeT':['d'], 'FeM':['d'], 'O':['p']}}
     return dosInfo
 
-def Wannier(taskName, workDirBandstructure, energyInterval, atomOrbitals, w2webContext, runParallel, runCommandPrefix, wannierRunCommandPrefix):
+rydbergToEv = 13.605693
+
+# Band energies of lapw1 (case.energy or case.energy_1, _2, ... of a k-parallel run) as an array [k-point, band] in Ry,
+# k-points with fewer bands are padded with NaN. Every run of "band energy" lines starting with band 1 is a k-point,
+# k-point headers and linearization energies at the top of the file don't match.
+bandEnergyRe = re.compile(r'^\s*(\d+)\s*([-+]?\d*\.\d+(?:[EeDd][-+]?\d+)?)\s*$', re.MULTILINE)
+def readBandEnergies(workDir, caseName):
+    fileNames = [join(workDir, caseName+'.energy')]
+    if not notEmpty(fileNames[0]):
+        fileNames = glob.glob(join(workDir, caseName+'.energy_*'))
+        fileNames = sorted([f for f in fileNames if f.rsplit('_', 1)[1].isdigit()], key=lambda f: int(f.rsplit('_', 1)[1]))
+    content = ''
+    for fileName in fileNames:
+        with open(fileName, 'r') as f: content += f.read() + '\n'
+    found = np.array(bandEnergyRe.findall(content))
+    if len(found) == 0: raise Exception('Error: no band energies in '+', '.join(fileNames))
+    bands = found[:,0].astype(int)
+    energies = np.char.replace(np.char.replace(found[:,1], 'D', 'E'), 'd', 'e').astype(float)
+    k = np.cumsum(bands == 1) - 1
+    bands, energies, k = bands[k >= 0], energies[k >= 0], k[k >= 0]
+    result = np.full((k[-1]+1, bands.max()), np.nan)
+    result[k, bands-1] = energies
+    return result
+
+def fermiEnergy(scfFile):
+    with open(scfFile, 'r') as myfile: scfFileContent = myfile.read()
+    foundRes = re.findall(r'F E R M I - ENERGY\(.+\)=\s*([\d\.\+\-]*)', scfFileContent, flags = re.IGNORECASE)
+    if len(foundRes) == 0: raise Exception('Error: can\'t find Fermi energy in file '+scfFile)
+    return float(foundRes[-1])
+
+# Energy windows with exactly bandCount bands at every k-point: bands first..first+bandCount-1 must lie above all
+# energies of the band below and under all energies of the band above. Edges of a window are in the middle of the gaps.
+# Returns [(first band (from 1), e1, e2, smallest of the two gaps)] in the units of energies.
+def bandWindows(energies, bandCount):
+    n = energies.shape[1]
+    if bandCount > n or bandCount <= 0: return []
+    missing = np.isnan(energies)
+    lo = np.min(np.where(missing, np.inf, energies), axis=0)
+    hi = np.max(np.where(missing, -np.inf, energies), axis=0)
+    # bands inside the window must exist at all k-points
+    complete = np.concatenate([[0], np.cumsum(np.any(missing, axis=0))])
+    first = np.arange(n - bandCount + 1)
+    below = np.concatenate([[-np.inf], hi])[first]
+    bottom = lo[first]
+    top = hi[first + bandCount - 1]
+    above = np.concatenate([lo, [np.inf]])[first + bandCount]
+    ok = (below < bottom) & (top < above) & (complete[first + bandCount] == complete[first])
+    # no band below or above: 1 unit of margin
+    e1 = np.where(np.isfinite(below), (below + bottom)/2, bottom - 1)
+    e2 = np.where(np.isfinite(above), (top + above)/2, top + 1)
+    gap = np.minimum(bottom - below, above - top)
+    return [(int(f)+1, float(a), float(b), float(g)) for f, a, b, g in zip(first[ok], e1[ok], e2[ok], gap[ok])]
+
+def Wannier(taskName, workDirBandstructure, energyInterval, atomOrbitals, w2webContext, runParallel, runCommandPrefix, wannierRunCommandPrefix, plot=True, strictWindow=False):
     print('Wannier running...')
     workDir = workDirBandstructure+'/'+taskName
     enters = "\n"*22
@@ -692,33 +2301,38 @@ def Wannier(taskName, workDirBandstructure, energyInterval, atomOrbitals, w2webC
     output = runCommand("echo '"+str(structInfo['kpoints']*2)+"\n0\n"+enters+"' | x kgen -fbz", workDir)
     
     
-    correctBandCount = 0
-    counts = {'s':1, 'p':3, 'd':5}
-    proj = ''
-    atomList = [] 
-    for an in structInfo['atomNamesList']: atomList += [an]*structInfo['atomCounts'][an]
-    # order of atoms and orbitals must be the same as in function XTLS !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-    for a in structInfo['atomNamesList']:
-        if a not in atomOrbitals: continue
-        for orb in atomOrbitals[a]:
-            correctBandCount += counts[orb]*structInfo['atomCounts'][a]
-            ind = np.where(np.array(atomList) == a)[0]
-            for i in ind: proj += str(i+1) + ':' + orb + "\n"
+    # the same order as rows of the hopping matrix in XTLS
+    layout = orbitalLayout(structInfo, atomOrbitals)
+    correctBandCount = sum(orbitalSizes[orb]*len(positions) for a, orb, positions in layout)
+    proj = ''.join(str(i) + ':' + orb + "\n" for a, orb, positions in layout for i in positions)
     
+    def findbands(e1, e2):
+        output = runCommand("x findbands -all "+e1+" "+e2, workDir)
+        findbandsFile = workDir + '/' + taskName+'.outputfind'
+        with open(findbandsFile, 'r') as myfile: findbandsFileContent = myfile.read()
+        i = findbandsFileContent.find("\n \n")
+        return pd.read_csv(StringIO(findbandsFileContent[:i]), sep='\s+', names=['k-point', 'first', 'last', 'bands'], skiprows=2, header=None)
+
     e1 = str(energyInterval[0]); e2 = str(energyInterval[1])
-    output = runCommand("x findbands -all "+e1+" "+e2, workDir)
-        
-    findbandsFile = workDir + '/' + taskName+'.outputfind'
-    with open(findbandsFile, 'r') as myfile: findbandsFileContent = myfile.read()
-    i = findbandsFileContent.find("\n \n")
-    bands = pd.read_csv(StringIO(findbandsFileContent[:i]), sep='\s+', names=['k-point', 'first', 'last', 'bands'], skiprows=2, header=None)
+    bands = findbands(e1, e2)
     ind = bands['bands'].values == correctBandCount
+    # energyInterval is kept if it gives the right band count at some k-point, with strictWindow only if it gives it at all of them
+    if True not in ind or (strictWindow and not np.all(ind)):
+        # the window is searched over band energies of all k-points at once instead of guessing a new interval
+        scfFiles = [join(workDir, taskName+'.scf'), join(workDirBandstructure, os.path.basename(workDirBandstructure)+'.scf')]
+        energies = (readBandEnergies(workDir, taskName) - fermiEnergy([f for f in scfFiles if os.path.exists(f)][0]))*rydbergToEv
+        windows = bandWindows(energies, correctBandCount)
+        if len(windows) > 0:
+            bandFirst, w1, w2, gap = min(windows, key=lambda w: abs(w[1]-energyInterval[0]) + abs(w[2]-energyInterval[1]))
+            print('Energy interval [{0};{1}] gives {2} bands instead of {3}, bands {4}-{5} are separated from the others in [{6:.3f};{7:.3f}]'.format(e1, e2, np.unique(bands['bands'].values), correctBandCount, bandFirst, bandFirst+correctBandCount-1, w1, w2))
+            e1 = '{0:.3f}'.format(w1); e2 = '{0:.3f}'.format(w2)
+            energyInterval = [w1, w2]
+            bands = findbands(e1, e2)
+            ind = bands['bands'].values == correctBandCount
+        elif True in ind:
+            print('Warning: {0} bands are found only at {1} of {2} k-points in [{3};{4}] and no other window separates {0} bands at all k-points'.format(correctBandCount, np.sum(ind), len(ind), e1, e2))
     if True not in ind:
-        print('Wrong count of K-points\' bands!\n')
-        print('Expected band: '+str(correctBandCount))
-        print('Actual bands: {0}'.format(np.unique(bands['bands'].values)))
-        print('You should {0} energy interval.'.format('extend' if correctBandCount>max(bands['bands'].values) else 'narrow')+ 'Current energy interval is ['+e1+';'+e2+']')
-        exit(0)      
+        raise Exception('Error: no energy window gives {0} bands at all k-points, interval [{1};{2}] gives {3} bands. Check atomOrbitals'.format(correctBandCount, e1, e2, np.unique(bands['bands'].values)))
     first = bands['first'].values[ind]
     last = bands['last'].values[ind]
     bandCounts = bands['bands'].values[ind]
@@ -753,12 +2367,12 @@ def Wannier(taskName, workDirBandstructure, energyInterval, atomOrbitals, w2webC
         
     #x lapw1
     parallel = ' -p' if runParallel else ''
+    layout = prepareMachines(workDir, taskName, 'Wannier', runParallel=runParallel)
     output = runCommand("x lapw1" + parallel, workDir=workDir, prefix=runCommandPrefix)
 
-    threads = os.cpu_count()
     #x w2w
     if runParallel:
-        w2w_threads = min([threads, 12])
+        w2w_threads = layout['w2wThreads']
         output = runCommand("OMP_NUM_THREADS="+str(w2w_threads)+" x w2w -p", workDir=workDir, prefix='')
     else:
         output = runCommand("x w2w ", workDir=workDir, prefix='')
@@ -769,58 +2383,257 @@ def Wannier(taskName, workDirBandstructure, energyInterval, atomOrbitals, w2webC
     else:
         output = runCommand("OMP_NUM_THREADS=1 x wannier90", workDir=workDir, prefix='')
         
+    if not plot: return workDir
     output = runCommand("echo \"set term png\nset output '1.png'\nset yrange ["+str(energyInterval[0]-2)+":"+str(energyInterval[1]+2)+"]\nplot '"+taskName+r".spaghetti_ene' using (\$4/0.529189):5, '"+taskName+"_band.dat' with lines\nexit\n\" | gnuplot", workDir)
     
     return workDir
 
+# ===================================================================================================================
+# Plots without w2web and gnuplot (common_params['plotBackend'] = 'native'): DOS, Bandstructure and Wannier only
+# leave their data files, then all the figures are drawn in one batch from .dos*ev, .spaghetti_ene and _band.dat.
+# A figure is a dict: output, title, xlabel, ylabel, xlim, ylim, hlines, vlines and curves [(x, y, kwargs of plot)].
+# matplotlib is needed only for this backend, figures are drawn without pyplot, so the backend of the caller is not changed.
+
+def importFigure():
+    try: from matplotlib.figure import Figure
+    except ImportError: raise Exception('Error: plotBackend \'native\' needs matplotlib')
+    return Figure
+
+# bands in one curve, separated by NaN
+def bandsCurve(bands):
+    x = np.concatenate([np.append(k, np.nan) for k, e in bands]) if len(bands) > 0 else np.array([])
+    y = np.concatenate([np.append(e, np.nan) for k, e in bands]) if len(bands) > 0 else np.array([])
+    return x, y
+
+# rows of (distance, energy), a new band starts where the distance goes back
+def splitBands(data):
+    starts = np.concatenate([[0], np.where(np.diff(data[:,0]) < 0)[0]+1, [len(data)]])
+    return [(data[a:b,0], data[a:b,1]) for a, b in zip(starts[:-1], starts[1:]) if b > a]
+
+# case.spaghetti_ene: k_x k_y k_z distance energy(eV), band after band with "bandindex:" lines between them
+def readSpaghetti(fileName):
+    with open(fileName, 'r') as f: lines = [l for l in f if l.strip() != '' and 'bandindex' not in l]
+    return splitBands(np.loadtxt(lines, usecols=(3, 4), ndmin=2))
+
+# <wannierName>_band.dat of wannier90: distance energy, bands separated by empty lines
+def readWannierBands(fileName):
+    return splitBands(np.loadtxt(fileName, usecols=(0, 1), ndmin=2))
+
+# energy range of the spaghetti plot from case.insp: "-14.0 3.0  2   # energy range, energy switch (1:Ry, 2:eV)"
+def inspEnergyRange(inspFile):
+    if not os.path.exists(inspFile): return None
+    with open(inspFile, 'r') as f: found = re.search(r'^\s*([-+\d.]+)\s+([-+\d.]+)\s+(\d)\s*#\s*energy range', f.read(), flags=re.MULTILINE)
+    if found is None: return None
+    scale = rydbergToEv if found.group(3) == '1' else 1.0
+    return [float(found.group(1))*scale, float(found.group(2))*scale]
+
+# the same pictures as dos.pl: total DOS and tot,s,p,d of every atom, files pics/<atom>_<index>.png
+def dosFigures(workDirDOS, xmin=None):
+    taskName = os.path.basename(workDirDOS)
+    names = readStructure(join(workDirDOS, taskName+'.struct')).atomNames()
+    dosFiles = readDOSFiles(workDirDOS, taskName)
+    if 'ev' not in dosFiles['data']: raise Exception('Error: there is no '+taskName+'.dos1ev in '+workDirDOS)
+    header, labels, data = dosFiles['data']['ev']
+    picDir = join(workDirDOS, 'pics')
+    os.makedirs(picDir, exist_ok=True)
+    figures = []
+    for atomIndex, name in enumerate(names):
+        columns = [0] + [1+4*atomIndex+i for i in range(4)]
+        if columns[-1] >= data.shape[1]-1: raise Exception('Error: {0}.dos*ev have no columns of atom {1} ({2})'.format(taskName, atomIndex+1, name))
+        curves = [(data[:,0], data[:,1+c], {'label':labels[c] if len(labels) == data.shape[1]-1 else None, 'linewidth':1}) for c in columns]
+        figures.append({'output':join(picDir, name+'_'+str(atomIndex)+'.png'), 'title':taskName+': '+name, 'xlabel':'Energy, eV', 'ylabel':'DOS, states/eV',
+                        'xlim':[xmin if xmin is not None else -10, 10], 'vlines':[0], 'curves':curves})
+    return figures
+
+def bandFigure(workDirBandstructure):
+    taskName = os.path.basename(workDirBandstructure)
+    x, y = bandsCurve(readSpaghetti(join(workDirBandstructure, taskName+'.spaghetti_ene')))
+    return {'output':join(workDirBandstructure, taskName+'_bands.png'), 'title':taskName, 'ylabel':'Energy, eV', 'xlim':[np.nanmin(x), np.nanmax(x)],
+            'ylim':inspEnergyRange(join(workDirBandstructure, taskName+'.insp')), 'hlines':[0], 'curves':[(x, y, {'color':'k', 'linewidth':0.8})]}
+
+# WIEN2k bands (points) and Wannier bands (lines) as in 1.png of gnuplot: distances of spaghetti are in 1/bohr.
+# The spaghetti is taken from the Wannier folder or else from the Bandstructure folder around it.
+def wannierFigure(workDirWannier):
+    taskName = os.path.basename(workDirWannier)
+    workDirBandstructure = os.path.dirname(workDirWannier)
+    kw, ew = bandsCurve(readWannierBands(join(workDirWannier, taskName+'_band.dat')))
+    curves = [(kw, ew, {'linewidth':1, 'label':'Wannier'})]
+    spaghettiFiles = [join(workDirWannier, taskName+'.spaghetti_ene'), join(workDirBandstructure, os.path.basename(workDirBandstructure)+'.spaghetti_ene')]
+    spaghettiFiles = [f for f in spaghettiFiles if os.path.exists(f)]
+    if len(spaghettiFiles) > 0:
+        k, e = bandsCurve(readSpaghetti(spaghettiFiles[0]))
+        curves.insert(0, (k/0.529189, e, {'linestyle':'none', 'marker':'.', 'markersize':2, 'label':'WIEN2k'}))
+    return {'output':join(workDirWannier, '1.png'), 'title':taskName, 'ylabel':'Energy, eV', 'ylim':[np.nanmin(ew)-2, np.nanmax(ew)+2], 'curves':curves}
+
+# figures of a finished stage (workDir is its result)
+def stageFigures(stage, params, workDir):
+    if not params[stage]['run']: return []
+    if stage == 'DOS': return dosFigures(workDir, params['DOS']['xmin'])
+    if stage == 'BAND': return [bandFigure(workDir)]
+    if stage == 'Wannier': return [wannierFigure(workDir)]
+    return []
+
+def renderFigure(figure):
+    Figure = importFigure()
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    for x, y, kwargs in figure['curves']: ax.plot(x, y, **kwargs)
+    for y in figure.get('hlines', []): ax.axhline(y, color='gray', linestyle=':', linewidth=0.8)
+    for x in figure.get('vlines', []): ax.axvline(x, color='gray', linestyle=':', linewidth=0.8)
+    if figure.get('xlim') is not None: ax.set_xlim(*figure['xlim'])
+    if figure.get('ylim') is not None: ax.set_ylim(*figure['ylim'])
+    ax.set_title(figure.get('title', ''))
+    ax.set_xlabel(figure.get('xlabel', ''))
+    ax.set_ylabel(figure.get('ylabel', ''))
+    if any('label' in kwargs and kwargs['label'] is not None for x, y, kwargs in figure['curves']): ax.legend()
+    fig.savefig(figure['output'], dpi=100)
+    return figure['output']
+
+# all figures at once, with workers > 1 in a pool of processes
+def renderFigures(figures, workers=1):
+    importFigure()
+    start = time.time()
+    if workers > 1 and len(figures) > 1:
+        if debugMode: debugLog.flush()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=initWorkerProcess) as executor:
+            outputs = list(executor.map(renderFigure, figures))
+    else:
+        outputs = [renderFigure(figure) for figure in figures]
+    print('{0} figures are drawn in {1:.1f} s'.format(len(outputs), time.time()-start))
+    return outputs
+
 # =====================================================================================================================================
-def TriDiag(folder):
-    def constructV(x,n):
-        V = np.eye(n)
-        c = np.cos(x)
-        s = np.sin(x)
-        inds = [[0,1], [0,2], [0,3], [0,4], [1,2], [1,3], [1,4], [2,3], [2,4], [3,4]]
-        K = len(inds)
-        for k in range(K):
-            Q = np.eye(n)
-            i = inds[k][0]+5
-            j = inds[k][1]+5
-            Q[i][i]=c[k]
-            Q[i][j]=-s[k]
-            Q[j][i]=s[k]
-            Q[j][j]=c[k]
-            V = np.dot(V,Q)
-        k = K
-        for i in range(5,10):
-            for j in range(10,n):
-                Q = np.eye(n)
-                Q[i][i]=c[k]
-                Q[i][j]=-s[k]
-                Q[j][i]=s[k]
-                Q[j][j]=c[k]
-                V = np.dot(V,Q)
-                k = k+1
-        return V
-
-    def targetF(x,A):
-        n,m = A.shape
-        inds = [[0,1], [0,2], [0,3], [0,4], [1,2], [1,3], [1,4], [2,3], [2,4], [3,4]]
-        K = len(inds)
-        V = constructV(x,n)
-        Vt = np.transpose(V)
-        D = np.dot(Vt,A)
-        D = np.dot(D,V)
-        y = np.zeros(2*K+5)
-        for k in range(K):
-            i = inds[k][0]
-            j = inds[k][1]
-            y[k] = D[i][j+5] - D[j][i+5]
-            y[k+K] = D[i][j+5]
-        dd = [3, 3, 3, 3, 3]
-        for i in range(5):
-            y[2*K+i] = D[i][i+5]-dd[i]
-        return np.linalg.norm(y)**2
+# Rotation planes of TriDiag: all pairs inside the ligand block 5..9, then every (5..9, 10..n-1) pair
+def givensPlanes(n):
+    inds = [[0,1], [0,2], [0,3], [0,4], [1,2], [1,3], [1,4], [2,3], [2,4], [3,4]]
+    planes = [(i+5, j+5) for i, j in inds]
+    for i in range(5,10):
+        for j in range(10,n): planes.append((i, j))
+    return planes
+
+# D <- Q^T D Q for the rotation Q in plane (i,j): Q[i][i]=c, Q[i][j]=-s, Q[j][i]=s, Q[j][j]=c.
+# Only rows and columns i,j change, so it costs O(n) instead of a dense O(n^3) product.
+def givensRotate(D, i, j, c, s):
+    Di = D[i].copy()
+    D[i] = c*Di + s*D[j]
+    D[j] = c*D[j] - s*Di
+    Di = D[:,i].copy()
+    D[:,i] = c*Di + s*D[:,j]
+    D[:,j] = c*D[:,j] - s*Di
+
+# V = Q_1 Q_2 ... Q_K
+def constructV(x, n):
+    V = np.eye(n)
+    for (i, j), c, s in zip(givensPlanes(n), np.cos(x), np.sin(x)):
+        Vi = V[:,i].copy()
+        V[:,i] = c*Vi + s*V[:,j]
+        V[:,j] = c*V[:,j] - s*Vi
+    return V
+
+# Target of TriDiag and its analytic gradient.
+# D = V^T A V, f = |y(D)|^2 depends only on the block D[:5,5:10]; G = df/dD.
+# df/dx_k = Y_k[i,j] - Y_k[j,i] with Y_K = G^T D + G D^T and Y_{k-1} = Q_k Y_k Q_k^T (backward sweep).
+def targetF(x, A):
+    n,m = A.shape
+    planes = givensPlanes(n)
+    c = np.cos(x)
+    s = np.sin(x)
+    D = np.array(A, dtype=float)
+    for k, (i, j) in enumerate(planes): givensRotate(D, i, j, c[k], s[k])
+    inds = [[0,1], [0,2], [0,3], [0,4], [1,2], [1,3], [1,4], [2,3], [2,4], [3,4]]
+    K = len(inds)
+    y = np.zeros(2*K+5)
+    G = np.zeros((n,n))
+    for k in range(K):
+        i = inds[k][0]
+        j = inds[k][1]
+        y[k] = D[i][j+5] - D[j][i+5]
+        y[k+K] = D[i][j+5]
+        G[i][j+5] += 2*y[k] + 2*y[k+K]
+        G[j][i+5] -= 2*y[k]
+    dd = [3, 3, 3, 3, 3]
+    for i in range(5):
+        y[2*K+i] = D[i][i+5]-dd[i]
+        G[i][i+5] += 2*y[2*K+i]
+    Y = np.dot(G.T, D) + np.dot(G, D.T)
+    grad = np.zeros(len(planes))
+    for k in range(len(planes)-1, -1, -1):
+        i, j = planes[k]
+        grad[k] = Y[i][j] - Y[j][i]
+        givensRotate(Y, i, j, c[k], -s[k])
+    return np.dot(y, y), grad
+
+def minimizeTriDiag(A, x0):
+    sol = scipy.optimize.minimize(targetF, x0, args=(A,), jac=True, method='BFGS', tol=1e-04, options={'maxiter':100000})
+    return sol.fun, sol.x
+
+# Solutions of TriDiag memoized by HopMat content (in memory and as <hash>.npz in cacheDir).
+# A new problem is minimized once from the solution of the closest solved one of the same size (from zero angles as before if there is none);
+# with starts > 1 from zero angles, that solution and random angles (in a pool of workers processes). The best minimum is kept.
+class TriDiagSolver:
+    def __init__(self, cacheDir=None, starts=1, workers=1):
+        self.cacheDir = cacheDir
+        self.starts = starts
+        self.workers = workers
+        self.solutions = {}
+        self.lock = threading.Lock()
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            for fileName in os.listdir(cacheDir):
+                if fileName.endswith('.npz') and '.tmp' not in fileName: self.loadSolution(fileName[:-4])
+
+    # solver is sent to the XTLS worker processes, the lock can't be pickled
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def loadSolution(self, key):
+        if self.cacheDir is None or not os.path.exists(join(self.cacheDir, key+'.npz')): return None
+        with np.load(join(self.cacheDir, key+'.npz')) as f: self.solutions[key] = (f['A'], f['x'], float(f['fun']))
+        return self.solutions[key]
+
+    def saveSolution(self, key, A, x, fun):
+        self.solutions[key] = (A, x, fun)
+        if self.cacheDir is None: return
+        tmp = join(self.cacheDir, key + '.' + str(os.getpid()) + '.tmp.npz')
+        np.savez(tmp, A=A, x=x, fun=fun)
+        os.replace(tmp, join(self.cacheDir, key+'.npz'))
 
+    def startPoints(self, key, A):
+        n = A.shape[0]
+        K = len(givensPlanes(n))
+        same = [(np.linalg.norm(A-As), xs) for As, xs, fs in self.solutions.values() if As.shape == A.shape]
+        warm = [min(same, key=lambda p: p[0])[1]] if len(same) > 0 else []
+        if self.starts <= 1: return warm or [np.zeros(K)]
+        points = [np.zeros(K)] + warm
+        rng = np.random.RandomState(int(key[:8], 16))
+        while len(points) < self.starts: points.append(rng.uniform(-np.pi, np.pi, K))
+        return points
+
+    def solve(self, A0, A):
+        key = hashlib.sha256(str(A0.shape).encode('utf8') + np.ascontiguousarray(A0, dtype=float).tobytes()).hexdigest()
+        with self.lock: solution = self.solutions.get(key) or self.loadSolution(key)
+        if solution is not None:
+            print('TriDiag solution was found in cache')
+            return solution[1]
+        with self.lock: points = self.startPoints(key, A)
+        if self.workers > 1 and len(points) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork')) as executor:
+                results = list(executor.map(minimizeTriDiag, [A]*len(points), points))
+        else: results = [minimizeTriDiag(A, x0) for x0 in points]
+        fun, x = min(results, key=lambda r: r[0])
+        with self.lock: self.saveSolution(key, A, x, fun)
+        return x
+
+triDiagSolverGlobal = TriDiagSolver()
+
+def TriDiag(folder, solver=None):
+    if solver is None: solver = triDiagSolverGlobal
     A0 = np.loadtxt(folder+'/HopMat.dat')
     n,sz = A0.shape
     if n<10:
@@ -836,9 +2649,7 @@ def TriDiag(folder):
     V0t = np.transpose(V0)
     A = np.dot(V0t,A0)
     A = np.dot(A,V0)
-    sol = scipy.optimize.minimize(targetF, np.zeros((10+(n-10)*5,1)), args=(A), method='BFGS', tol=1e-04, options={'maxiter':100000})
-    #print(sol)
-    x = sol.x
+    x = solver.solve(A0, A)
     V = constructV(x,n)
     Vt = np.transpose(V)
     D = np.dot(Vt,A)
@@ -872,49 +2683,243 @@ def TriDiag(folder):
     np.savetxt(folder+"/HsphereLL.dat", D1spher[5:10,5:10], delimiter=" ", fmt='%6.3f')
     return 0
 
-def XTLS(workDirWannier, XTLSFolder, atomOrbitals, hopMatBorder, XTLSinput, w2webContext):
+def replaceToAbsolutePath(XTLSinputFolder, Hsphere, XTLSinput):
+    with open(XTLSinputFolder + '/' + XTLSinput, 'r') as file_in:
+        text = file_in.read()
+    
+    abs_path = os.path.abspath(XTLSinputFolder) + '/Hsphere'
+    '''replace_string is a string which will replace the first open(11,..) command
+    in Xtls script. This string will contain declairings of all needed variables
+    for describing absolute path.
+    total_parts is a counter of parts of absolute path with length 'limit'
+    '''
+    replace_string=''
+    total_parts = 1
+    limit = 50
+    #declaring variables of parts
+    for part in range(limit, len(abs_path), limit):
+        replace_string +='char @ path' + str(total_parts) + '=\"' + abs_path[part-limit:part] + '\";\n    '
+        total_parts+=1
+        
+    replace_string += 'char @ path' + str(total_parts) + '=\"' + abs_path[part:len(abs_path)] + '\";\n    '
+    #declaring path string as sum of path variables
+    input_file_path = ''
+    for i in range(1, total_parts+1):
+        input_file_path +='path' + str(i) + '+'
+    #declaring InputFileName variables for all types of Hsphere        
+    for sphere in Hsphere:
+        if sphere!='LD':
+            replace_string +='char @ InputFileName{0}={1}\"{0}.dat\";\n    '.format(sphere, input_file_path)
+
+    replace_string += '\n    open(11,InputFileNameDD);'
+    #replacing relative paths to absolute in Xtls script
+    for sphere in Hsphere:
+        if sphere == 'DD':
+            text = re.sub(r'open.*DD.*', replace_string, text)
+        else:
+            text = re.sub(r'\s*".*Hsphere' + sphere + '.dat"', 'InputFileName' + sphere, text)
+    
+    with open(XTLSinputFolder + '/' + XTLSinput, 'w') as file_out:
+            file_out.write(text)
+
+def XTLSComputation(folder, XTLSFolder, XTLSinput, solver=None):
+    output = TriDiag(folder, solver)
+    if output==1: 
+        return False
+    os.makedirs(folder+'/xcards', exist_ok=True)
+    os.makedirs(folder+'/xcodes', exist_ok=True)
+    os.makedirs(folder+'/xobjs', exist_ok=True)
+    os.makedirs(folder+'/xwrk', exist_ok=True)
+    Hsphere=['DD', 'DL', 'LD', 'LL']
+    for sphere in Hsphere:
+        shutil.copy(folder+'/Hsphere'+sphere+'.dat', folder+'/xcards/')
+    shutil.copy(XTLSinput, folder+'/xcards/')
+            
+    #change paths to Hsphere files to absolute in XTLSinput file
+    #replaceToAbsolutePath(folder+'/xcards', Hsphere, XTLSinput)
+            
+    XTLSinputBaseName = os.path.split(XTLSinput)[1]
+    output = runCommand("HOST=localhost "+XTLSFolder+"/bin/x925 --wait "+XTLSinputBaseName, folder+'/xcards')
+    os.rename(folder+'/xobjs/'+XTLSinputBaseName+'.obj', folder+'/xobjs/result.obj')
+    output = runCommand(XTLSFolder+"/bin/xc < "+XTLSFolder+"/xc/spc/spcana.x > spectrum.txt", folder+'/xcodes')
+    #Copy spectrum picture to main folder
+    shutil.copy(folder+'/xcodes/spectrum.ps', 'spectrum_'+folder.split('/')[-1] + '.ps')
+    return True
+
+# Hopping integrals of wannier90 (<case>_hr.dat): H[r, m, n] = <m,0|H|n,R[r]> divided by the degeneracy of R[r],
+# so blocks of orbitals can be cut from it directly. Orbitals are in the order of the projections of Wannier.
+class WannierHamiltonian:
+    def __init__(self, R, degeneracy, H):
+        self.R = R
+        self.degeneracy = degeneracy
+        self.H = H
+        self.index = {tuple(r):i for i, r in enumerate(R.tolist())}
+
+    @staticmethod
+    def parse(fileName):
+        with open(fileName, 'r') as f:
+            f.readline()
+            size = int(f.readline())
+            count = int(f.readline())
+            degeneracy = []
+            while len(degeneracy) < count: degeneracy += [int(x) for x in f.readline().split()]
+            data = pd.read_csv(f, sep=r'\s+', header=None, names=['R1', 'R2', 'R3', 'm', 'n', 're', 'im'],
+                               dtype={'R1':np.int64, 'R2':np.int64, 'R3':np.int64, 'm':np.int64, 'n':np.int64, 're':np.float64, 'im':np.float64})
+        if len(data) != count*size*size:
+            raise Exception('Error: {0} has {1} hopping lines instead of {2}'.format(fileName, len(data), count*size*size))
+        degeneracy = np.array(degeneracy, dtype=np.int64)
+        # wannier90 writes all size*size elements of each R one after another
+        r = np.arange(len(data)) // (size*size)
+        H = np.zeros((count, size, size), dtype=np.complex128)
+        H[r, data['m'].values-1, data['n'].values-1] = (data['re'].values + 1j*data['im'].values) / degeneracy[r]
+        R = data[['R1', 'R2', 'R3']].values[::size*size]
+        return WannierHamiltonian(R, degeneracy, H)
+
+    def save(self, prefix):
+        np.save(prefix + '_R.npy', np.column_stack([self.R, self.degeneracy]))
+        np.save(prefix + '_H.npy', self.H)
+
+    # H is memory-mapped: only blocks which are used are read
+    @staticmethod
+    def load(prefix):
+        R = np.load(prefix + '_R.npy')
+        return WannierHamiltonian(R[:, :3], R[:, 3], np.load(prefix + '_H.npy', mmap_mode='r'))
+
+    # Frobenius norms of blocks of orbitals (blockSizes in the order of orbitals) for every R:
+    # max and 2nd max over R and the index of R with the max
+    def blockNorms(self, blockSizes, chunk=64):
+        if sum(blockSizes) != self.H.shape[1]:
+            raise Exception('Error: {0} orbitals in blocks, but {1} Wannier functions'.format(sum(blockSizes), self.H.shape[1]))
+        starts = np.concatenate([[0], np.cumsum(blockSizes)[:-1]]).astype(int)
+        norms = np.empty((len(self.R), len(blockSizes), len(blockSizes)))
+        for i in range(0, len(self.R), chunk):
+            squares = np.abs(self.H[i:i+chunk])**2
+            norms[i:i+chunk] = np.sqrt(np.add.reduceat(np.add.reduceat(squares, starts, axis=1), starts, axis=2))
+        second = np.partition(norms, -2, axis=0)[-2] if len(self.R) > 1 else np.zeros(norms.shape[1:])
+        return norms.max(axis=0), second, norms.argmax(axis=0)
+
+    # Hamiltonian of the cluster of blocks: blocks[0] in the home cell, every other block in the cell
+    # where its hopping from blocks[0] is the largest (cells from blockNorms)
+    def localHamiltonian(self, blockSizes, blocks, cells):
+        starts = np.concatenate([[0], np.cumsum(blockSizes)[:-1]]).astype(int)
+        positions = [np.zeros(3, dtype=np.int64)] + [self.R[cells[blocks[0], b]] for b in blocks[1:]]
+        offsets = np.concatenate([[0], np.cumsum([blockSizes[b] for b in blocks])])
+        matrix = np.zeros((offsets[-1], offsets[-1]))
+        for i, bi in enumerate(blocks):
+            for j, bj in enumerate(blocks):
+                r = self.index.get(tuple((positions[j] - positions[i]).tolist()))
+                if r is None: continue
+                matrix[offsets[i]:offsets[i+1], offsets[j]:offsets[j+1]] = self.H[r, starts[bi]:starts[bi]+blockSizes[bi], starts[bj]:starts[bj]+blockSizes[bj]].real
+        return (matrix + matrix.T) / 2
+
+# parsed _hr.dat by content hash: in memory for the run and as .npy in cacheDir for the next runs
+hamiltonians = {}
+hamiltoniansLock = threading.Lock()
+def readWannierHamiltonian(fileName, cacheDir=None):
+    sha = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''): sha.update(block)
+    key = sha.hexdigest()
+    with hamiltoniansLock:
+        if key in hamiltonians: return hamiltonians[key]
+        prefix = join(cacheDir, key) if cacheDir is not None else None
+        if prefix is not None and os.path.exists(prefix + '_H.npy'):
+            hamiltonian = WannierHamiltonian.load(prefix)
+        else:
+            hamiltonian = WannierHamiltonian.parse(fileName)
+            if prefix is not None:
+                os.makedirs(cacheDir, exist_ok=True)
+                # written under temporary names: concurrent runs may read the cache
+                tmp = prefix + '.' + str(os.getpid()) + '.tmp'
+                hamiltonian.save(tmp)
+                os.replace(tmp + '_R.npy', prefix + '_R.npy')
+                os.replace(tmp + '_H.npy', prefix + '_H.npy')
+                hamiltonian = WannierHamiltonian.load(prefix)
+        hamiltonians[key] = hamiltonian
+        return hamiltonian
+
+def formatBlockNorms(norms, second):
+    text = ''
+    for title, matrix in (('Block Norms Max', norms), ('Block Norms 2nd max', second)):
+        text += ' ' + title + ' \n' + ''.join(' ' + ' '.join('{0:.3f}'.format(x) for x in row) + '\n' for row in matrix)
+    return text
+
+# One row of the hopping matrix: local Hamiltonian, tridiagonalization and XTLS spectrum.
+# Errors are reported in the result instead of being raised, so one bad row doesn't stop the others.
+# cmd is None when HopMat.dat is already written (nativeHamiltonian)
+def XTLSRow(row, orbital, folder, cmd, XTLSFolder, XTLSinput, solver=None):
+    start = time.time()
+    try:
+        if cmd is not None: runCommand(cmd, folder)
+        status = 'ok' if XTLSComputation(folder, XTLSFolder, XTLSinput, solver) else 'skipped'
+        error = ''
+    except Exception as e:
+        status = 'failed'
+        error = str(e)
+        print('XTLS row {0} ({1}) failed:\n{2}'.format(row, orbital, error))
+    return {'row':row, 'orbital':orbital, 'status':status, 'time':time.time()-start, 'error':error}
+
+# Runs in each forked worker: locks may have been held by other threads at the moment of fork
+def initWorkerProcess():
+    global cachesLock, hashCachesLock, chunkStoresLock, structuresLock, hamiltoniansLock, w2webLocksLock, debugLog, jobManagerGlobal, tracerGlobal
+    cachesLock = threading.Lock()
+    hashCachesLock = threading.Lock()
+    chunkStoresLock = threading.Lock()
+    structuresLock = threading.Lock()
+    hamiltoniansLock = threading.Lock()
+    w2webLocksLock = threading.Lock()
+    w2webLocks.clear()
+    caches.clear()
+    hashCaches.clear()
+    chunkStores.clear()
+    globalCaches.clear()
+    if debugMode: debugLog = open(debugLog.name, 'a', buffering=1)
+    # the thread with the event loop is not forked
+    if jobManagerGlobal is not None: jobManagerGlobal = JobManager(jobManagerGlobal.scheduler, jobManagerGlobal.pollInterval)
+    if tracerGlobal is not None: tracerGlobal.lock = threading.Lock()
+
+def XTLS(workDirWannier, XTLSFolder, atomOrbitals, hopMatBorder, XTLSinput, w2webContext, workers=1, triDiagStarts=1, folderName='XTLS1', nativeHamiltonian=False):
     print('XTLS running...')
+    # solutions are kept in caseBaseDir, which is never cleaned, and reused by the next runs.
+    # The solver is passed explicitly: several XTLS stages of a campaign may run at the same time
+    solver = TriDiagSolver(join(w2webContext['caseBaseDir'], '.tridiag'), triDiagStarts, 1 if workers > 1 else triDiagStarts)
     parentDir = w2webContext['caseBaseDir']
-    workDir = workDirWannier + '/XTLS1'
+    workDir = workDirWannier + '/' + folderName
     prepareDirectory(workDir)
     wannierName = os.path.basename(workDirWannier)
     shutil.copyfile(workDirWannier + '/' + wannierName + '_hr.dat', workDir + '/' + wannierName + '_hr.dat')
         
-    # order of atoms and orbitals must be the same as in function Wannier !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-    structInfo = w2webContext['structInfo']
-
-    counts = {'s':1, 'p':3, 'd':5}
-    params = str(len(atomOrbitals))
-    atomList = []
-    hopMatAtomOrbitals = []
-    for an in structInfo['atomNamesList']: atomList += [an]*structInfo['atomCounts'][an]
-    for a in structInfo['atomNamesList']:
-        if a not in atomOrbitals: continue
-        for orb in atomOrbitals[a]:
-            params += ' ' + str(structInfo['atomCounts'][a]) + ' ' + str(counts[orb])
-            ind = np.where(np.array(atomList) == a)[0]
-            for i in ind: hopMatAtomOrbitals.append(a + ':' + orb)
-    hopMatAtomOrbitals = np.array(hopMatAtomOrbitals)
+    # the same order as projections of Wannier
+    layout = orbitalLayout(w2webContext['structInfo'], atomOrbitals)
+    params = str(len(atomOrbitals)) + ''.join(' ' + str(len(positions)) + ' ' + str(orbitalSizes[orb]) for a, orb, positions in layout)
+    hopMatAtomOrbitals = np.array([a + ':' + orb for a, orb, positions in layout for i in positions])
 
-    cmd = "local_Hamilton "+wannierName+"_hr.dat  "+params+" 1 1"    
-    output = runCommand(cmd, workDir)
+    blockSizes = [orbitalSizes[orb] for a, orb, positions in layout for i in positions]
+    if nativeHamiltonian:
+        hamiltonian = readWannierHamiltonian(workDir + '/' + wannierName + '_hr.dat', join(parentDir, '.hamiltonians'))
+        norms, second, cells = hamiltonian.blockNorms(blockSizes)
+        output = formatBlockNorms(norms, second)
+        hopMatr = norms
+        minElemOfMatrix = norms.min()
+    else:
+        cmd = "local_Hamilton "+wannierName+"_hr.dat  "+params+" 1 1"    
+        output = runCommand(cmd, workDir)
+        foundRes=re.search(r'Block Norms Max \n([\s\S]+)[\s\n]+Block Norms 2nd max', output, flags = re.IGNORECASE)
+        matrix=foundRes.group(1)
+        matrix=matrix.split('\n') #split matrix in rows
+        hopMatr=[]
+        minElemOfMatrix=sys.float_info.max
+        for line in matrix:
+            if line!='':
+                listOfNumbers=line.split(' ')  #split each row in list of elements
+                listOfNumbers.remove('')
+                matrixRow=[float(item) for item in listOfNumbers]
+                minInRow=min(matrixRow)
+                minElemOfMatrix=minInRow if minInRow<minElemOfMatrix else minElemOfMatrix
+                hopMatr.append(matrixRow)
     with open(workDir+'/output.txt', 'w') as file_out:
         file_out.write(output)
     
-    foundRes=re.search(r'Block Norms Max \n([\s\S]+)[\s\n]+Block Norms 2nd max', output, flags = re.IGNORECASE)
-    matrix=foundRes.group(1)
-    matrix=matrix.split('\n') #split matrix in rows
-    hopMatr=[]
-    minElemOfMatrix=sys.float_info.max
-    for line in matrix:
-        if line!='':
-            listOfNumbers=line.split(' ')  #split each row in list of elements
-            listOfNumbers.remove('')
-            matrixRow=[float(item) for item in listOfNumbers]
-            minInRow=min(matrixRow)
-            minElemOfMatrix=minInRow if minInRow<minElemOfMatrix else minElemOfMatrix
-            hopMatr.append(matrixRow)
-    
     matr = np.copy(hopMatr)
     matrSize=len(hopMatAtomOrbitals)
     for i in range(matrSize):
@@ -928,69 +2933,7 @@ def XTLS(workDirWannier, XTLSFolder, atomOrbitals, hopMatBorder, XTLSinput, w2we
     s = elCounts[uniqElements>hopMatBorder].sum()
     print('Take', s, 'elements greater than', hopMatBorder)
     
-    def XTLSComputation(folder):
-        
-        def replaceToAbsolutePath(XTLSinputFolder, Hsphere):
-            with open(XTLSinputFolder + '/' + XTLSinput, 'r') as file_in:
-                text = file_in.read()
-            
-            abs_path = os.path.abspath(XTLSinputFolder) + '/Hsphere'
-            '''replace_string is a string which will replace the first open(11,..) command
-            in Xtls script. This string will contain declairings of all needed variables
-            for describing absolute path.
-            total_parts is a counter of parts of absolute path with length 'limit'
-            '''
-            replace_string=''
-            total_parts = 1
-            limit = 50
-            #declaring variables of parts
-            for part in range(limit, len(abs_path), limit):
-                replace_string +='char @ path' + str(total_parts) + '=\"' + abs_path[part-limit:part] + '\";\n    '
-                total_parts+=1
-                
-            replace_string += 'char @ path' + str(total_parts) + '=\"' + abs_path[part:len(abs_path)] + '\";\n    '
-            #declaring path string as sum of path variables
-            input_file_path = ''
-            for i in range(1, total_parts+1):
-                input_file_path +='path' + str(i) + '+'
-            #declaring InputFileName variables for all types of Hsphere        
-            for sphere in Hsphere:
-                if sphere!='LD':
-                    replace_string +='char @ InputFileName{0}={1}\"{0}.dat\";\n    '.format(sphere, input_file_path)
-
-            replace_string += '\n    open(11,InputFileNameDD);'
-            #replacing relative paths to absolute in Xtls script
-            for sphere in Hsphere:
-                if sphere == 'DD':
-                    text = re.sub(r'open.*DD.*', replace_string, text)
-                else:
-                    text = re.sub(r'\s*".*Hsphere' + sphere + '.dat"', 'InputFileName' + sphere, text)
-            
-            with open(XTLSinputFolder + '/' + XTLSinput, 'w') as file_out:
-                    file_out.write(text)
-                    
-        output = TriDiag(folder)
-        if output==1: 
-            return
-        os.makedirs(folder+'/xcards', exist_ok=True)
-        os.makedirs(folder+'/xcodes', exist_ok=True)
-        os.makedirs(folder+'/xobjs', exist_ok=True)
-        os.makedirs(folder+'/xwrk', exist_ok=True)
-        Hsphere=['DD', 'DL', 'LD', 'LL']
-        for sphere in Hsphere:
-            shutil.copy(folder+'/Hsphere'+sphere+'.dat', folder+'/xcards/')
-        shutil.copy(XTLSinput, folder+'/xcards/')
-                
-        #change paths to Hsphere files to absolute in XTLSinput file
-        #replaceToAbsolutePath(folder+'/xcards', Hsphere)
-                
-        XTLSinputBaseName = os.path.split(XTLSinput)[1]
-        output = runCommand("HOST=localhost "+XTLSFolder+"/bin/x925 --wait "+XTLSinputBaseName, folder+'/xcards')
-        os.rename(folder+'/xobjs/'+XTLSinputBaseName+'.obj', folder+'/xobjs/result.obj')
-        output = runCommand(XTLSFolder+"/bin/xc < "+XTLSFolder+"/xc/spc/spcana.x > spectrum.txt", folder+'/xcodes')
-        #Copy spectrum picture to main folder
-        shutil.copy(folder+'/xcodes/spectrum.ps', 'spectrum_'+folder.split('/')[-1] + '.ps')
-        
+    tasks = []
     for j in range(matrSize):
         
         #indBool = hopMatr[j+1:, j] > hopMatBorder
@@ -1005,21 +2948,84 @@ def XTLS(workDirWannier, XTLSFolder, atomOrbitals, hopMatBorder, XTLSinput, w2we
             f.write(str(hopMatAtomOrbitals[j]) + ' is overlapped with: '+ " ".join(hopMatAtomOrbitals[ind-1]) + '\n') 
             f.write("local_Hamilton ../"+wannierName+"_hr.dat  "+params+" "+str(len(ind)+1)+" "+str(j+1)+" "+" ".join(str(x) for x in ind) + '\n')
         
-        output = runCommand("local_Hamilton ../"+wannierName+"_hr.dat  "+params+" "+str(len(ind)+1)+" "+str(j+1)+" "+" ".join(str(x) for x in ind), folder)
-            
-        XTLSComputation(folder)
+        cmd = "local_Hamilton ../"+wannierName+"_hr.dat  "+params+" "+str(len(ind)+1)+" "+str(j+1)+" "+" ".join(str(x) for x in ind)
+        if nativeHamiltonian:
+            np.savetxt(folder + '/HopMat.dat', hamiltonian.localHamiltonian(blockSizes, [j] + list(ind-1), cells), fmt='%12.6f')
+            cmd = None
+        tasks.append((j+1, str(hopMatAtomOrbitals[j]), folder, cmd, XTLSFolder, XTLSinput, solver))
+
+    # rows are independent (each works in its own folder), run them in a pool of processes
+    rowResults = []
+    if workers > 1 and len(tasks) > 1:
+        if debugMode: debugLog.flush()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=initWorkerProcess) as executor:
+            futures = [executor.submit(XTLSRow, *task) for task in tasks]
+            for task, future in zip(tasks, futures):
+                try: rowResults.append(future.result())
+                except Exception as e:
+                    rowResults.append({'row':task[0], 'orbital':task[1], 'status':'failed', 'time':0.0, 'error':repr(e)})
+    else:
+        for task in tasks: rowResults.append(XTLSRow(*task))
+
+    summary = '{0:>5} {1:<20} {2:<8} {3:>9}  {4}\n'.format('row', 'orbital', 'status', 'time, s', 'error')
+    for r in rowResults:
+        summary += '{0:>5} {1:<20} {2:<8} {3:>9.1f}  {4}\n'.format(r['row'], r['orbital'], r['status'], r['time'], r['error'].split('\n')[0])
+    print('XTLS summary:\n' + summary)
+    with open(workDir + '/summary.txt', 'w') as f: f.write(summary)
+    return rowResults
 # ===================================================================================================================
 
-def runWien2k(params):
-    global debugMode, debugLog
+def runTracedStage(name, function, results):
+    with traceSpan(name, 'stage'): return function(results)
+
+# Runs stages {name: (dependencies, function)}, each one as soon as all its dependencies are finished,
+# at most maxWorkers at a time. function gets a dict with results of the finished stages.
+# After the first error no new stages are started, running ones are waited for and the error is re-raised.
+# With stopOnError=False independent stages go on, errors (and stages skipped because of them) are put into errors.
+def runStageGraph(stages, maxWorkers=2, stopOnError=True, errors=None):
+    results = {}
+    pending = dict(stages)
+    running = {}
+    error = None
+    failed = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+        while True:
+            if error is None:
+                for name, (dependencies, function) in list(pending.items()):
+                    if any(d in failed for d in dependencies):
+                        failed.add(name)
+                        if errors is not None: errors[name] = 'skipped: dependency failed'
+                        del pending[name]
+                    elif all(d in results for d in dependencies):
+                        running[executor.submit(runTracedStage, name, function, dict(results))] = name
+                        del pending[name]
+            if len(running) == 0:
+                # skipping a stage may make its dependents skippable too
+                if error is None and any(any(d in failed for d in dependencies) for dependencies, _ in pending.values()): continue
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try: results[name] = future.result()
+                except BaseException as e:
+                    print('Stage {0} failed'.format(name))
+                    failed.add(name)
+                    if errors is not None: errors[name] = repr(e)
+                    if stopOnError and error is None: error = e
+    if error is not None: raise error
+    if len(pending) > 0:
+        raise Exception('Error: unresolved dependencies of stages: ' + ', '.join(pending.keys()))
+    return results
+
+# Process-wide settings of a run: debug log, global cache, WIENROOT
+def setupRun(params):
+    global debugMode, debugLog, globalCacheDirGlobal, jobManagerGlobal, machinesConfigGlobal, tracerGlobal
     common_params = params['common']
-    SCFparams = params['SCF']
-    DOSparams = params['DOS']
-    BANDparams = params['BAND']
-    Wannierparams = params['Wannier']
-    XTLSparams = params['XTLS']
-    
     debugMode = common_params['debugMode']
+    if 'trace' in common_params and common_params['trace']: tracerGlobal = Tracer(common_params['trace'])
+    if 'globalCacheDir' in common_params: globalCacheDirGlobal = common_params['globalCacheDir']
+    if 'scheduler' in common_params: jobManagerGlobal = makeJobManager(common_params['scheduler'])
+    if 'machines' in common_params: machinesConfigGlobal = common_params['machines']
     if debugMode:
         debugLog=open('log.txt','w')
         
@@ -1030,6 +3036,15 @@ def runWien2k(params):
         os.environ['WIENROOT'] = params['WIENROOT']
         os.environ['PATH'] = os.environ['WIENROOT']+':'+os.environ['PATH']
 
+# Stages {name: (dependencies, function)} of one structure with one set of params, for runStageGraph
+def wien2kStages(params, w2webContext, workingFolder):
+    common_params = params['common']
+    SCFparams = params['SCF']
+    DOSparams = params['DOS']
+    BANDparams = params['BAND']
+    Wannierparams = params['Wannier']
+    XTLSparams = params['XTLS']
+
     wannierName = Wannierparams['wannierName']
     structureFile = SCFparams['struct_file']
     
@@ -1044,39 +3059,304 @@ def runWien2k(params):
     efmod = SCFparams['efmod']
     ef_eval = SCFparams['ef_eval']
     iqtlsave = SCFparams['iqtlsave'] if 'iqtlsave' in SCFparams else False
+    init = SCFparams['init'] if 'init' in SCFparams else 'native'
+    lmax = SCFparams['lmax'] if 'lmax' in SCFparams else None
+    emax = SCFparams['emax'] if 'emax' in SCFparams else None
+    mix = SCFparams['mix'] if 'mix' in SCFparams else None
+    plotBackend = common_params['plotBackend'] if 'plotBackend' in common_params else 'w2web'
+    if plotBackend not in ['w2web', 'native']: raise Exception('Error: unknown plotBackend ' + str(plotBackend))
+    # fail now, not after SCF
+    if plotBackend == 'native': importFigure()
+    plot = plotBackend == 'w2web'
+    plotWorkers = common_params['plotWorkers'] if 'plotWorkers' in common_params else 1
     hopMatBorder = XTLSparams['hopMatBorder']
     XTLSinput = XTLSparams['XTLSinput']
-    
-    workingFolder = '.' if 'workingFolder' not in params['common'] else params['common']['workingFolder']
-    w2webContext = prepareW2WebEmulation(workingFolder)
 
-    if SCFparams['run']:
-        workDirSCF = SCF(structureFile, w2webContext, SCFparams['runParallel'], SCFparams['runCommandPrefix'], lapwParams, kpoints, rkmax, lstart_energy, efmod, ef_eval, iqtlsave)
-    else:
-        workDirSCF = workingFolder + '/w2webEmulator/caseBaseDir/'+name
-        workDirSCF = os.path.abspath(workDirSCF)
-        w2webContext['structInfo'] = parseStructFile(workDirSCF+'/'+name+'.struct')
-        if kpoints>0 : 
-             w2webContext['structInfo']['kpoints'] = kpoints
+    def runSCF(results):
+        if SCFparams['run']:
+            workDirSCF = SCF(structureFile, w2webContext, SCFparams['runParallel'], SCFparams['runCommandPrefix'], lapwParams, kpoints, rkmax, lstart_energy, efmod, ef_eval, iqtlsave, init, lmax, emax, mix)
+        else:
+            workDirSCF = workingFolder + '/w2webEmulator/caseBaseDir/'+name
+            workDirSCF = os.path.abspath(workDirSCF)
+            w2webContext['structInfo'] = parseStructFile(workDirSCF+'/'+name+'.struct')
+            if kpoints>0 : 
+                 w2webContext['structInfo']['kpoints'] = kpoints
+        return workDirSCF
         
-    if DOSparams['run']:
-        workDirDOS = DOS(workDirSCF, w2webContext, DOSparams['runParallel'], DOSparams['runCommandPrefix'], DOSparams['xmin'])
-    else:
-        workDirDOS = workingFolder + '/w2webEmulator/caseBaseDir/'+name+'_DOS/'+name
-        workDirDOS = os.path.abspath(workDirDOS)
+    def runDOS(results):
+        if DOSparams['run']:
+            DOSmode = DOSparams['mode'] if 'mode' in DOSparams else 'batch'
+            DOSworkers = DOSparams['workers'] if 'workers' in DOSparams else 4
+            workDirDOS = DOS(results['SCF'], w2webContext, DOSparams['runParallel'], DOSparams['runCommandPrefix'], DOSparams['xmin'], DOSmode, DOSworkers, plot)
+        else:
+            workDirDOS = workingFolder + '/w2webEmulator/caseBaseDir/'+name+'_DOS/'+name
+            workDirDOS = os.path.abspath(workDirDOS)
+        return workDirDOS
 
-    if BANDparams['run']:
-        workDirBandstructure = Bandstructure(workDirSCF, klist_band_file, w2webContext, BANDparams['runParallel'], BANDparams['runCommandPrefix'], efmod)
-    else:
-        workDirBandstructure = workingFolder + '/w2webEmulator/caseBaseDir/'+name+'_Bandstructure/'+name
-        workDirBandstructure = os.path.abspath(workDirBandstructure)
+    def runBAND(results):
+        if BANDparams['run']:
+            workDirBandstructure = Bandstructure(results['SCF'], klist_band_file, w2webContext, BANDparams['runParallel'], BANDparams['runCommandPrefix'], efmod, plot)
+        else:
+            workDirBandstructure = workingFolder + '/w2webEmulator/caseBaseDir/'+name+'_Bandstructure/'+name
+            workDirBandstructure = os.path.abspath(workDirBandstructure)
+        return workDirBandstructure
 
-    if Wannierparams['run']:
-        workDirWannier = Wannier(wannierName, workDirBandstructure, dosInfo['energyInterval'], dosInfo['atomOrbitals'], w2webContext, Wannierparams['runParallel'], Wannierparams['runCommandPrefix'], Wannierparams['wannierRunCommandPrefix'])
-    else:
-        workDirWannier=workingFolder+'/w2webEmulator/caseBaseDir/'+name+'_Bandstructure/'+name+'/'+wannierName;   
+    def runWannier(results):
+        if Wannierparams['run']:
+            strictWindow = Wannierparams['strictWindow'] if 'strictWindow' in Wannierparams else False
+            workDirWannier = Wannier(wannierName, results['BAND'], dosInfo['energyInterval'], dosInfo['atomOrbitals'], w2webContext, Wannierparams['runParallel'], Wannierparams['runCommandPrefix'], Wannierparams['wannierRunCommandPrefix'], plot, strictWindow)
+        else:
+            workDirWannier=workingFolder+'/w2webEmulator/caseBaseDir/'+name+'_Bandstructure/'+name+'/'+wannierName;   
+        return workDirWannier
     
-    if XTLSparams['run']:
-        if 'structInfo' in XTLSparams:
-            w2webContext['structInfo'] = XTLSparams['structInfo']
-        XTLS(workDirWannier, XTLSparams['Xtls_path'], dosInfo['atomOrbitals'], hopMatBorder, XTLSinput, w2webContext=w2webContext)
+    def runXTLS(results):
+        if XTLSparams['run']:
+            # DOS may still be running with the same context, don't replace structInfo under its feet
+            XTLSContext = dict(w2webContext)
+            if 'structInfo' in XTLSparams:
+                XTLSContext['structInfo'] = XTLSparams['structInfo']
+            XTLSworkers = XTLSparams['workers'] if 'workers' in XTLSparams else 1
+            triDiagStarts = XTLSparams['triDiagStarts'] if 'triDiagStarts' in XTLSparams else 1
+            XTLSfolderName = XTLSparams['folderName'] if 'folderName' in XTLSparams else 'XTLS1'
+            nativeHamiltonian = XTLSparams['nativeHamiltonian'] if 'nativeHamiltonian' in XTLSparams else False
+            return XTLS(results['Wannier'], XTLSparams['Xtls_path'], dosInfo['atomOrbitals'], hopMatBorder, XTLSinput, w2webContext=XTLSContext, workers=XTLSworkers, triDiagStarts=triDiagStarts, folderName=XTLSfolderName, nativeHamiltonian=nativeHamiltonian)
+
+    def runPlots(results):
+        figures = [f for stage in ['DOS', 'BAND', 'Wannier'] for f in stageFigures(stage, params, results[stage])]
+        return renderFigures(figures, plotWorkers)
+
+    # DOS and Bandstructure both depend only on SCF and work in different folders
+    stages = {'SCF': ([], runSCF),
+              'DOS': (['SCF'], runDOS),
+              'BAND': (['SCF'], runBAND),
+              'Wannier': (['BAND'], runWannier),
+              'XTLS': (['Wannier'], runXTLS)}
+    if plotBackend == 'native': stages['PLOTS'] = (['DOS', 'BAND', 'Wannier'], runPlots)
+    return stages
+
+def runWien2k(params):
+    global chunkStoreRootGlobal
+    setupRun(params)
+    common_params = params['common']
+    workingFolder = '.' if 'workingFolder' not in common_params else common_params['workingFolder']
+    w2webContext = prepareW2WebEmulation(workingFolder)
+    chunkStoreRootGlobal = join(w2webContext['caseBaseDir'], chunksDirName)
+    stages = wien2kStages(params, w2webContext, workingFolder)
+    maxParallelStages = common_params['maxParallelStages'] if 'maxParallelStages' in common_params else 2
+    try: return runStageGraph(stages, maxParallelStages)
+    finally:
+        if tracerGlobal is not None: tracerGlobal.close()
+
+# ===================================================================================================================
+# Campaigns: many structures x many parameter sets in one run.
+#
+# campaign = {'params': <params of runWien2k, used as the base>,
+#             'structures': ['Fe3O4.struct', {'struct_file':'FeSiO4.struct', 'BAND.klist_band':'FeSiO4.klist_band'}, ...],
+#             'variants': {'SCF.RKmax': [6.5, 7], 'common.dosInfo.energyInterval': [[-8,2], [-7,3]]},
+#             'campaignFolder': 'campaign', 'maxJobs': 4, 'maxCores': 16, 'cores': {'SCF': 4, 'XTLS': 2}}
+#
+# Every structure is run with every combination of variants. Overrides are dotted paths into params.
+# Each stage gets a key: hash of the params it depends on and of the key of its parent stage.
+# Jobs with the same key share the stage, so e.g. variants of XTLS params run SCF, DOS, Bandstructure
+# and Wannier only once. Different SCFs work in their own working folders, DOS/Bandstructure variants
+# of one SCF get a clone of the SCF folder, Wannier and XTLS variants get their own subfolders.
+# The stages of a job are those of wien2kStages, with plotBackend 'native' PLOTS too.
+
+# params that change only the way a stage is run, not its results
+executionOnlyParams = ['run', 'runParallel', 'runCommandPrefix', 'wannierRunCommandPrefix', 'workers', 'folderName']
+
+def setParam(params, path, value):
+    keys = path.split('.')
+    for k in keys[:-1]: params = params.setdefault(k, {})
+    params[keys[-1]] = copy.deepcopy(value)
+
+def fileContentHash(fileName):
+    if not os.path.isfile(fileName): return fileName
+    with open(fileName, 'rb') as f: return hashlib.sha1(f.read()).hexdigest()
+
+def stageKey(params, stage, parentKey):
+    parts = {'parent': parentKey, 'stage': stage}
+    parts['params'] = {k:v for k,v in params[stage].items() if k not in executionOnlyParams} if stage in params else {}
+    # w2web plots are made by the stages themselves, native ones by PLOTS
+    if stage in ['DOS', 'BAND', 'Wannier', 'PLOTS']:
+        parts['plotBackend'] = params['common']['plotBackend'] if 'plotBackend' in params['common'] else 'w2web'
+    if stage == 'SCF':
+        parts['struct'] = fileContentHash(params['SCF']['struct_file'])
+        parts['kpoints'] = params['common']['kpoints']
+        parts['WIENROOT'] = params['WIENROOT'] if 'WIENROOT' in params else ''
+    elif stage == 'BAND':
+        parts['klist_band'] = fileContentHash(params['BAND']['klist_band'])
+        parts['efmod'] = params['SCF']['efmod']
+    elif stage in ['DOS', 'Wannier']:
+        parts['dosInfo'] = params['common']['dosInfo']
+    elif stage == 'XTLS':
+        parts['atomOrbitals'] = params['common']['dosInfo']['atomOrbitals']
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+def campaignJobs(campaign):
+    base = campaign['params']
+    structures = campaign['structures'] if 'structures' in campaign else [base['SCF']['struct_file']]
+    variants = campaign['variants'] if 'variants' in campaign else {}
+    paths = sorted(variants.keys())
+    combinations = [{}]
+    for path in paths:
+        combinations = [dict(c, **{path: v}) for c in combinations for v in variants[path]]
+    jobs = []
+    for structure in structures:
+        if not isinstance(structure, dict): structure = {'struct_file': structure}
+        for combination in combinations:
+            params = copy.deepcopy(base)
+            setParam(params, 'SCF.struct_file', os.path.abspath(structure['struct_file']))
+            for path, value in structure.items():
+                if path != 'struct_file': setParam(params, path, value)
+            for path, value in combination.items(): setParam(params, path, value)
+            jobs.append({'structure': structure['struct_file'], 'variant': combination, 'params': params})
+    return jobs
+
+# Counts cores of the running stages, a stage waits until there are enough free cores
+class CoreLimiter:
+    def __init__(self, maxCores):
+        self.maxCores = maxCores
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.maxCores)
+        with self.condition:
+            while self.used + n > self.maxCores: self.condition.wait()
+            self.used += n
+        return n
+
+    def release(self, n):
+        with self.condition:
+            self.used -= n
+            self.condition.notify_all()
+
+def runCampaign(campaign):
+    global chunkStoreRootGlobal
+    base = campaign['params']
+    setupRun(base)
+    campaignFolder = os.path.abspath(campaign['campaignFolder'] if 'campaignFolder' in campaign else 'campaign')
+    os.makedirs(campaignFolder, exist_ok=True)
+    # one chunk store for all the working folders of the campaign
+    chunkStoreRootGlobal = join(campaignFolder, chunksDirName)
+    maxJobs = campaign['maxJobs'] if 'maxJobs' in campaign else 2
+    maxCores = campaign['maxCores'] if 'maxCores' in campaign else multiprocessing.cpu_count()
+    stageCores = campaign['cores'] if 'cores' in campaign else {}
+    jobs = campaignJobs(campaign)
+
+    # nodes of the graph: name -> stage, params, working folder, node names of the parent stages
+    nodes = {}
+    children = {}
+    stageCount = 0
+    for job in jobs:
+        params = job['params']
+        # only the names of the stages, w2webContext is not used before they run
+        jobStages = wien2kStages(params, None, campaignFolder)
+        stageCount += len(jobStages)
+        name = os.path.splitext(os.path.basename(params['SCF']['struct_file']))[0]
+        scfKey = stageKey(params, 'SCF', '')
+        scfNode = 'SCF:' + scfKey[:12]
+        if scfNode not in nodes:
+            nodes[scfNode] = {'stage':'SCF', 'params':params, 'folder':join(campaignFolder, name+'-'+scfKey[:8]), 'parents':{}}
+        job['nodes'] = {'SCF': scfNode}
+        keys = {'SCF': scfKey}
+        for stage in ['DOS', 'BAND']:
+            key = keys[stage] = stageKey(params, stage, scfKey)
+            node = stage + ':' + key[:12]
+            if node not in nodes:
+                siblings = children.setdefault((scfNode, stage), [])
+                # the first variant works next to its SCF, the others in a clone of it
+                folder = nodes[scfNode]['folder'] if len(siblings) == 0 else join(campaignFolder, name+'-'+key[:8])
+                nodes[node] = {'stage':stage, 'params':params, 'folder':folder, 'parents':{'SCF':scfNode}}
+                siblings.append(node)
+            job['nodes'][stage] = node
+        bandNode = job['nodes']['BAND']
+        wannierKey = keys['Wannier'] = stageKey(params, 'Wannier', keys['BAND'])
+        wannierNode = 'Wannier:' + wannierKey[:12]
+        if wannierNode not in nodes:
+            siblings = children.setdefault((bandNode, 'Wannier'), [])
+            if len(siblings) > 0:
+                params = copy.deepcopy(params)
+                params['Wannier']['wannierName'] += '_' + wannierKey[:8]
+            nodes[wannierNode] = {'stage':'Wannier', 'params':params, 'folder':nodes[bandNode]['folder'], 'parents':{'BAND':bandNode}}
+            siblings.append(wannierNode)
+        job['nodes']['Wannier'] = wannierNode
+        xtlsKey = stageKey(job['params'], 'XTLS', wannierKey)
+        xtlsNode = 'XTLS:' + xtlsKey[:12]
+        if xtlsNode not in nodes:
+            siblings = children.setdefault((wannierNode, 'XTLS'), [])
+            params = copy.deepcopy(job['params'])
+            params['Wannier']['wannierName'] = nodes[wannierNode]['params']['Wannier']['wannierName']
+            if len(siblings) > 0: params['XTLS']['folderName'] = 'XTLS_' + xtlsKey[:8]
+            nodes[xtlsNode] = {'stage':'XTLS', 'params':params, 'folder':nodes[wannierNode]['folder'], 'parents':{'Wannier':wannierNode}}
+            siblings.append(xtlsNode)
+        job['nodes']['XTLS'] = xtlsNode
+        if 'PLOTS' in jobStages:
+            plotsKey = stageKey(params, 'PLOTS', '+'.join(keys[stage] for stage in jobStages['PLOTS'][0]))
+            plotsNode = 'PLOTS:' + plotsKey[:12]
+            if plotsNode not in nodes:
+                parents = {stage: job['nodes'][stage] for stage in jobStages['PLOTS'][0]}
+                params = copy.deepcopy(params)
+                params['Wannier']['wannierName'] = nodes[wannierNode]['params']['Wannier']['wannierName']
+                nodes[plotsNode] = {'stage':'PLOTS', 'params':params, 'folder':nodes[bandNode]['folder'], 'parents':parents}
+            job['nodes']['PLOTS'] = plotsNode
+        if sorted(job['nodes'].keys()) != sorted(jobStages.keys()):
+            raise Exception('Error: campaign doesn\'t know how to share stages ' + ', '.join(sorted(set(jobStages.keys()) - set(job['nodes'].keys()))))
+
+    contexts = {}
+    for node in nodes.values():
+        if node['folder'] not in contexts: contexts[node['folder']] = prepareW2WebEmulation(node['folder'])
+    limiter = CoreLimiter(maxCores)
+
+    def makeFunction(nodeName):
+        node = nodes[nodeName]
+        w2webContext = contexts[node['folder']]
+        stageFunction = wien2kStages(node['params'], w2webContext, node['folder'])[node['stage']][1]
+        def function(results):
+            stageResults = {stage: results[parent] for stage, parent in node['parents'].items()}
+            scfNode = node['parents']['SCF'] if 'SCF' in node['parents'] else None
+            if scfNode is not None and nodes[scfNode]['folder'] != node['folder']:
+                # variant of DOS/Bandstructure: work in a clone of the shared SCF
+                workDirSCF = join(w2webContext['caseBaseDir'], os.path.basename(results[scfNode]))
+                prepareDirectory(workDirSCF)
+                copyAllFiles(results[scfNode], workDirSCF, scfReadOnlyPatterns, scfRegeneratedPatterns)
+                w2webContext['structInfo'] = copy.deepcopy(contexts[nodes[scfNode]['folder']]['structInfo'])
+                stageResults['SCF'] = workDirSCF
+            cores = stageCores[node['stage']] if node['stage'] in stageCores else 1
+            cores = limiter.acquire(cores)
+            try: return stageFunction(stageResults)
+            finally: limiter.release(cores)
+        return function
+
+    stages = {n: (list(node['parents'].values()), makeFunction(n)) for n, node in nodes.items()}
+    print('Campaign: {0} jobs, {1} stages instead of {2}'.format(len(jobs), len(stages), stageCount))
+    errors = {}
+    try: results = runStageGraph(stages, maxJobs, stopOnError=False, errors=errors)
+    finally:
+        if tracerGlobal is not None: tracerGlobal.close()
+
+    summary = []
+    for job in jobs:
+        entry = {'structure': job['structure'], 'variant': job['variant'], 'stages': {}}
+        for stage, node in job['nodes'].items():
+            if node in results: entry['stages'][stage] = {'node': node, 'status': 'ok', 'result': results[node]}
+            else: entry['stages'][stage] = {'node': node, 'status': 'failed', 'error': errors[node] if node in errors else ''}
+        summary.append(entry)
+    with open(join(campaignFolder, 'campaign.json'), 'w') as f: json.dump(summary, f, indent=1, default=str)
+    failed = sum(1 for e in summary if any(s['status'] != 'ok' for s in e['stages'].values()))
+    print('Campaign finished: {0} jobs ok, {1} failed. Summary is in {2}'.format(len(summary)-failed, failed, join(campaignFolder, 'campaign.json')))
+    return summary
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a campaign of WIEN2k calculations')
+    parser.add_argument('campaign', help='json file with the campaign')
+    parser.add_argument('--max-jobs', type=int, help='stages running at the same time')
+    parser.add_argument('--max-cores', type=int, help='cores used by the running stages')
+    args = parser.parse_args()
+    with open(args.campaign) as f: campaign = json.load(f)
+    if args.max_jobs is not None: campaign['maxJobs'] = args.max_jobs
+    if args.max_cores is not None: campaign['maxCores'] = args.max_cores
+    summary = runCampaign(campaign)
+    exit(0 if all(s['status'] == 'ok' for e in summary for s in e['stages'].values()) else 1)